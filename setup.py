@@ -160,6 +160,7 @@ setup (
 
     scripts=[
         'scripts/voc-dpm2pydro',
+        'scripts/pydro-serve',
     ],
     requires=[
         'msgpack',
@@ -16,66 +16,120 @@ static inline int max (int a, int b) { return a < b ? b : a; }
 
 static inline int square(int x) { return x*x; }
 
+/* cost[s+d] holds the deformation cost of displacement d so that scores are
+ * bit-identical whether or not the argmax is recorded. */
+static void deformation_costs(float *cost, int s, float a, float b) {
+  int d;
+  for (d = -s; d <= s; d++)
+    cost[s+d] = a*square(d) + b*d;
+}
+
+static inline float window_max(const float *vals, int i, int s, int step, int n,
+                               const float *cost, int *argmax) {
+  float max_val = -INFINITY;
+  int first     = max(0, i-s);
+  int last      = min(n-1, i+s);
+  int j;
+  *argmax = 0;
+  for (j = first; j <= last; j++) {
+    float val = *(vals + j*step) - cost[s+i-j];
+    if (val > max_val) {
+      max_val = val;
+      *argmax = j;
+    }
+  }
+  return max_val;
+}
+
 static void max_filter_1d(const float *vals, float *out_vals, int32_t *I, 
-                          int s, int step, int n, float a, float b) {
+                          int s, int step, int n, const float *cost) {
   int i;
   for (i = 0; i < n; i++) {
-    float max_val = -INFINITY;
-    int argmax     = 0;
-    int first      = max(0, i-s);
-    int last       = min(n-1, i+s);
-    int j;
-    for (j = first; j <= last; j++) {
-      float val = *(vals + j*step) - a*square(i-j) - b*(i-j);
-      if (val > max_val) {
-        max_val = val;
-        argmax  = j;
-      }
-    }
-    *(out_vals + i*step) = max_val;
-    *(I + i*step) = argmax;
+    int argmax;
+    *(out_vals + i*step) = window_max(vals, i, s, step, n, cost, &argmax);
+    if (I)
+      *(I + i*step) = argmax;
   }
 }
 
-PyObject * deformation_cost (PyArrayObject * pydata, float ax, float bx, float ay, float by, int s) {
+static int check_deformation_input (PyArrayObject * pydata, int s) {
   npy_intp * dims = PyArray_DIMS(pydata);
   npy_intp * stride = PyArray_STRIDES(pydata);
 
   if (PyArray_NDIM(pydata) != 2) {
     PyErr_SetString(PyExc_TypeError, "data must be 2 dimensional.");
-    return NULL;
+    return 0;
   }
 
   if (PyArray_DESCR(pydata)->type_num != NPY_FLOAT) {
     PyErr_SetString(PyExc_TypeError, "data must be single precision floating point.");
-    return NULL;
+    return 0;
   }
 
   if (stride[0] != dims[1]*sizeof(float)) {
     PyErr_SetString(PyExc_TypeError, "Stride[0] must be sizeof(float).");
-    return NULL;
+    return 0;
   }
 
   if (stride[1] != sizeof(float)) {
     PyErr_SetString(PyExc_TypeError, "Stride[1] must be Dims[0]*sizeof(float).");
-    return NULL;
+    return 0;
+  }
+
+  if (s < 0) {
+    PyErr_SetString(PyExc_ValueError, "s must be non-negative.");
+    return 0;
   }
+
+  return 1;
+}
+
+PyObject * deformation_cost (PyArrayObject * pydata, float ax, float bx, float ay, float by, int s, int argmax) {
+  npy_intp * dims = PyArray_DIMS(pydata);
+
+  if (!check_deformation_input(pydata, s))
+    return NULL;
   
   PyArrayObject * pydeformed = (PyArrayObject*)PyArray_SimpleNew((npy_intp)2, dims, NPY_FLOAT);
+
+  float *tmpM = (float *)calloc(dims[0]*dims[1], sizeof(float));
+  float *costx = (float *)calloc(2*s+1, sizeof(float));
+  float *costy = (float *)calloc(2*s+1, sizeof(float));
+
+  int x, y;
+
+  deformation_costs(costx, s, ax, bx);
+  deformation_costs(costy, s, ay, by);
+
+  if (!argmax) {
+    /* score only, never materialize the displacement maps */
+    Py_BEGIN_ALLOW_THREADS
+    for (y = 0; y < dims[0]; y++)
+      max_filter_1d((float*)PyArray_GETPTR2(pydata, y, 0), tmpM+y*dims[1], NULL, s, 1, dims[1], costx);
+
+    for (x = 0; x < dims[1]; x++)
+      max_filter_1d(tmpM+x, (float*)PyArray_GETPTR2(pydeformed, 0, x), NULL, s, dims[1], dims[0], costy);
+    Py_END_ALLOW_THREADS
+
+    free(tmpM);
+    free(costx);
+    free(costy);
+
+    return Py_BuildValue("N", pydeformed);
+  }
+
   PyArrayObject * pyIx = (PyArrayObject*)PyArray_SimpleNew((npy_intp)2, dims, NPY_INT32);
   PyArrayObject * pyIy = (PyArrayObject*)PyArray_SimpleNew((npy_intp)2, dims, NPY_INT32);
 
-  float *tmpM = (float *)calloc(dims[0]*dims[1], sizeof(float));
   int32_t *tmpIx = (int32_t*)calloc(dims[0]*dims[1], sizeof(int32_t));
   int32_t *tmpIy = (int32_t*)calloc(dims[0]*dims[1], sizeof(int32_t));
 
-  int x, y;
-
+  Py_BEGIN_ALLOW_THREADS
   for (y = 0; y < dims[0]; y++)
-    max_filter_1d((float*)PyArray_GETPTR2(pydata, y, 0), tmpM+y*dims[1], tmpIx+y*dims[1], s, 1, dims[1], ax, bx);
+    max_filter_1d((float*)PyArray_GETPTR2(pydata, y, 0), tmpM+y*dims[1], tmpIx+y*dims[1], s, 1, dims[1], costx);
 
   for (x = 0; x < dims[1]; x++)
-    max_filter_1d(tmpM+x, (float*)PyArray_GETPTR2(pydeformed, 0, x), tmpIy+x, s, dims[1], dims[0], ay, by);
+    max_filter_1d(tmpM+x, (float*)PyArray_GETPTR2(pydeformed, 0, x), tmpIy+x, s, dims[1], dims[0], costy);
 
   for (x = 0; x < dims[1]; ++x) {
     for (y = 0; y < dims[0]; ++y) {
@@ -83,24 +137,59 @@ PyObject * deformation_cost (PyArrayObject * pydata, float ax, float bx, float a
       *(int32_t*)PyArray_GETPTR2(pyIx, y, x) = tmpIx[tmpIy[y*dims[1]+x]*dims[1]+x];
     }
   }
+  Py_END_ALLOW_THREADS
 
   free(tmpM);
+  free(costx);
+  free(costy);
   free(tmpIx);
   free(tmpIy);
 
   return Py_BuildValue("NNN", pydeformed, pyIx, pyIy);
 }
 
-PyObject * filter_image (PyArrayObject * pyfeatures, PyArrayObject * pyfilter, float bias, int width, int height) {
+/* Recovers Ix[y, x] and Iy[y, x] of deformation_cost for a single location
+ * by redoing both 1d passes over the (2s+1)x(2s+1) window only. */
+PyObject * deformation_argmax (PyArrayObject * pydata, float ax, float bx, float ay, float by, int s, int x, int y) {
+  npy_intp * dims = PyArray_DIMS(pydata);
+
+  if (!check_deformation_input(pydata, s))
+    return NULL;
+
+  if (x < 0 || x >= dims[1] || y < 0 || y >= dims[0]) {
+    PyErr_SetString(PyExc_IndexError, "location is outside of data.");
+    return NULL;
+  }
+
+  float *costx = (float *)calloc(2*s+1, sizeof(float));
+  float *costy = (float *)calloc(2*s+1, sizeof(float));
+  float *column = (float *)calloc(dims[0], sizeof(float));
+  int *columnIx = (int *)calloc(dims[0], sizeof(int));
+
+  int yy, ix, iy;
+
+  deformation_costs(costx, s, ax, bx);
+  deformation_costs(costy, s, ay, by);
+
+  for (yy = max(0, y-s); yy <= min(dims[0]-1, y+s); ++yy)
+    column[yy] = window_max((float*)PyArray_GETPTR2(pydata, yy, 0), x, s, 1, dims[1], costx, columnIx+yy);
+
+  window_max(column, y, s, 1, dims[0], costy, &iy);
+  ix = columnIx[iy];
+
+  free(costx);
+  free(costy);
+  free(column);
+  free(columnIx);
+
+  return Py_BuildValue("ii", ix, iy);
+}
+
+/* validates the inputs and allocates the response map; needs the GIL */
+PyArrayObject * new_filtered (PyArrayObject * pyfeatures, PyArrayObject * pyfilter, int width, int height) {
     npy_intp * features_dims = PyArray_DIMS(pyfeatures);
     npy_intp * filter_dims = PyArray_DIMS(pyfilter);
-    int a, b, l;
-    PyArrayObject * pyfiltered = NULL;
-    npy_intp * features_stride = PyArray_STRIDES(pyfeatures);
-    npy_intp * filtered_stride = NULL;
     npy_intp filtered_dims[2] = {0, 0};
-    int tight_width;
-    int tight_height;
 
     if (PyArray_NDIM(pyfeatures) != 3) {
         PyErr_SetString(PyExc_TypeError, "Features must be 3 dimensional.");
@@ -132,21 +221,28 @@ PyObject * filter_image (PyArrayObject * pyfeatures, PyArrayObject * pyfilter, f
         return NULL;
     }
 
-    tight_height = features_dims[0]-filter_dims[0]+1;
-    tight_width = features_dims[1]-filter_dims[1]+1;
-
-    filtered_dims[0] = height ? height : tight_height;
-    filtered_dims[1] = width ? width : tight_width;
+    filtered_dims[0] = height ? height : features_dims[0]-filter_dims[0]+1;
+    filtered_dims[1] = width ? width : features_dims[1]-filter_dims[1]+1;
 
     if (filtered_dims[0] < 1 || filtered_dims[1] < 1) {
         PyErr_SetString(PyExc_TypeError, "Input features are too small for filter.");
         return NULL;
     }
 
-    #pragma omp critical
-    pyfiltered = (PyArrayObject*)PyArray_SimpleNew((npy_intp)2, filtered_dims, NPY_FLOAT);
+    return (PyArrayObject*)PyArray_SimpleNew((npy_intp)2, filtered_dims, NPY_FLOAT);
+}
 
-    filtered_stride = PyArray_STRIDES(pyfiltered);
+/* fills a map allocated by new_filtered; touches no python state so it can
+ * run with the GIL released */
+void filter_image_into (PyArrayObject * pyfeatures, PyArrayObject * pyfilter, float bias, PyArrayObject * pyfiltered) {
+    npy_intp * features_dims = PyArray_DIMS(pyfeatures);
+    npy_intp * filter_dims = PyArray_DIMS(pyfilter);
+    npy_intp * filtered_dims = PyArray_DIMS(pyfiltered);
+    npy_intp * features_stride = PyArray_STRIDES(pyfeatures);
+    npy_intp * filtered_stride = PyArray_STRIDES(pyfiltered);
+    int a, b, l;
+    int tight_height = min(filtered_dims[0], features_dims[0]-filter_dims[0]+1);
+    int tight_width = min(filtered_dims[1], features_dims[1]-filter_dims[1]+1);
 
     /* zero out array */
     for (a = 0; a < tight_height; ++a) {
@@ -186,8 +282,79 @@ PyObject * filter_image (PyArrayObject * pyfeatures, PyArrayObject * pyfilter, f
             *(float*)PyArray_GETPTR2(pyfiltered, a, b) = -INFINITY;
         }
     }
+}
 
-    return Py_BuildValue("N", pyfiltered);
+static inline void axpy_contiguous(int n, float a, const float * restrict x, float * restrict y) {
+    int i;
+    for (i = 0; i < n; ++i)
+        y[i] += a*x[i];
+}
+
+/* like filter_image_into but only for the row runs (row, x0, x1) of runs;
+ * every other response is -inf.  Runs are short, so a plain loop replaces
+ * the per row cblas_saxpy calls, whose overhead would otherwise dominate;
+ * responses can differ from the dense ones in the last bits. */
+void filter_image_runs_into (PyArrayObject * pyfeatures, PyArrayObject * pyfilter, float bias, PyArrayObject * pyfiltered, PyArrayObject * pyruns) {
+    npy_intp * features_dims = PyArray_DIMS(pyfeatures);
+    npy_intp * filter_dims = PyArray_DIMS(pyfilter);
+    npy_intp * filtered_dims = PyArray_DIMS(pyfiltered);
+    npy_intp * features_stride = PyArray_STRIDES(pyfeatures);
+    npy_intp * filtered_stride = PyArray_STRIDES(pyfiltered);
+    int numruns = PyArray_DIMS(pyruns)[0];
+    int a, b, r, l;
+    int tight_height = min(filtered_dims[0], features_dims[0]-filter_dims[0]+1);
+    int tight_width = min(filtered_dims[1], features_dims[1]-filter_dims[1]+1);
+    int stride_src = features_stride[1]/sizeof(float);
+    int stride_dst = filtered_stride[1]/sizeof(float);
+
+    for (a = 0; a < filtered_dims[0]; ++a) {
+        for (b = 0; b < filtered_dims[1]; ++b) {
+            *(float*)PyArray_GETPTR2(pyfiltered, a, b) = -INFINITY;
+        }
+    }
+
+    for (r = 0; r < numruns; ++r) {
+        int k = *(int32_t*)PyArray_GETPTR2(pyruns, r, 0);
+        int x0 = max(0, *(int32_t*)PyArray_GETPTR2(pyruns, r, 1));
+        int x1 = min(tight_width, *(int32_t*)PyArray_GETPTR2(pyruns, r, 2));
+        float * out;
+        int i, j;
+
+        if (k < 0 || k >= tight_height || x0 >= x1)
+            continue;
+
+        out = (float*)PyArray_GETPTR2(pyfiltered, k, x0);
+        for (b = 0; b < x1-x0; ++b)
+            out[b*stride_dst] = -bias;
+
+        for (i = 0; i < filter_dims[0]; ++i) {
+            for (j = 0; j < filter_dims[1]; ++j) {
+                for (l = 0; l < 32; ++l) {
+                    float weight = *(float*)PyArray_GETPTR3(pyfilter, i, j, l);
+                    float * in = (float*)PyArray_GETPTR3(pyfeatures, i+k, j+x0, l);
+                    if (stride_src == 1 && stride_dst == 1) {
+                        axpy_contiguous(x1-x0, weight, in, out);
+                    } else {
+                        for (b = 0; b < x1-x0; ++b)
+                            out[b*stride_dst] += weight*in[b*stride_src];
+                    }
+                }
+            }
+        }
+    }
+}
+
+PyObject * filter_image (PyArrayObject * pyfeatures, PyArrayObject * pyfilter, float bias, int width, int height) {
+    PyArrayObject * pyfiltered = new_filtered(pyfeatures, pyfilter, width, height);
+
+    if (!pyfiltered)
+        return NULL;
+
+    Py_BEGIN_ALLOW_THREADS
+    filter_image_into(pyfeatures, pyfilter, bias, pyfiltered);
+    Py_END_ALLOW_THREADS
+
+    return (PyObject*)pyfiltered;
 }
 
 static PyObject * DeformationCost(PyObject * self, PyObject * args)
@@ -195,9 +362,21 @@ static PyObject * DeformationCost(PyObject * self, PyObject * args)
     PyArrayObject * pydata;
     float ax = 0.0f, bx = 0.0f, ay = 0.0f, by = 0.0f;
     int s = 0;
-    if (!PyArg_ParseTuple(args, "O!ffffi", &PyArray_Type, &pydata, &ax, &bx, &ay, &by, &s)) 
+    int argmax = 1;
+    if (!PyArg_ParseTuple(args, "O!ffffi|i", &PyArray_Type, &pydata, &ax, &bx, &ay, &by, &s, &argmax)) 
         return NULL;
-    return deformation_cost(pydata, ax, bx, ay, by, s);
+    return deformation_cost(pydata, ax, bx, ay, by, s, argmax);
+}
+
+static PyObject * DeformationArgmax(PyObject * self, PyObject * args)
+{
+    PyArrayObject * pydata;
+    float ax = 0.0f, bx = 0.0f, ay = 0.0f, by = 0.0f;
+    int s = 0;
+    int x = 0, y = 0;
+    if (!PyArg_ParseTuple(args, "O!ffffiii", &PyArray_Type, &pydata, &ax, &bx, &ay, &by, &s, &x, &y)) 
+        return NULL;
+    return deformation_argmax(pydata, ax, bx, ay, by, s, x, y);
 }
 
 static PyObject * FilterImage(PyObject * self, PyObject * args)
@@ -212,6 +391,95 @@ static PyObject * FilterImage(PyObject * self, PyObject * args)
     return filter_image(pyfeatures, pyfilter, bias, width, height);
 }
 
+static PyObject * FilterImagesMasked(PyObject * self, PyObject * args)
+{
+    PyObject * pyfeatures_list;
+    PyObject * pyruns_list;
+    PyObject * pydims_list;
+    PyArrayObject * pyfilter;
+    float bias = 0.0f;
+    int numlevels;
+    int i;
+    int failed = 0;
+    PyObject ** features = NULL;
+    PyObject ** runs = NULL;
+    PyObject ** results = NULL;
+    PyObject * pyresults_list;
+    if (!PyArg_ParseTuple(args, "O!O!O!O!|f", &PyList_Type, &pyfeatures_list, &PyArray_Type, &pyfilter, &PyList_Type, &pyruns_list, &PyList_Type, &pydims_list, &bias)) 
+        return NULL;
+
+    numlevels = PyList_Size(pyfeatures_list);
+
+    if (PyList_Size(pyruns_list) != numlevels || PyList_Size(pydims_list) != numlevels) {
+        PyErr_SetString(PyExc_TypeError, "There must be one runs array and one pad dims tuple per level.");
+        return NULL;
+    }
+
+    features = (PyObject**)calloc(numlevels, sizeof(PyObject*));
+    runs = (PyObject**)calloc(numlevels, sizeof(PyObject*));
+    results = (PyObject**)calloc(numlevels, sizeof(PyObject*));
+
+    for (i = 0; i < numlevels && !failed; ++i) {
+        PyObject * dims = PyList_GetItem(pydims_list, i);
+        PyArrayObject * pyruns;
+
+        features[i] = PyList_GetItem(pyfeatures_list, i);
+        runs[i] = PyList_GetItem(pyruns_list, i);
+        if (!PyArray_Check(features[i]) || !PyArray_Check(runs[i])) {
+            PyErr_SetString(PyExc_TypeError, "Features and runs must be lists of numpy arrays.");
+            failed = 1;
+            break;
+        }
+
+        pyruns = (PyArrayObject*)runs[i];
+        if (PyArray_NDIM(pyruns) != 2 || PyArray_DIMS(pyruns)[1] != 3 || PyArray_DESCR(pyruns)->type_num != NPY_INT32) {
+            PyErr_SetString(PyExc_TypeError, "Runs must be an Nx3 int32 array of (row, x0, x1).");
+            failed = 1;
+            break;
+        }
+
+        if (!PyTuple_Check(dims) || 2 != PyTuple_Size(dims)) {
+            PyErr_SetString(PyExc_TypeError, "Pad dims must be a list of tuples.");
+            failed = 1;
+            break;
+        }
+
+        results[i] = (PyObject*)new_filtered((PyArrayObject*)features[i], pyfilter, PyInt_AsLong(PyTuple_GetItem(dims, 1)), PyInt_AsLong(PyTuple_GetItem(dims, 0)));
+        if (!results[i])
+            failed = 1;
+    }
+
+    if (!failed) {
+        Py_BEGIN_ALLOW_THREADS
+        kmp_set_blocktime(0);
+        #pragma omp parallel for schedule(dynamic) 
+        for (i = 0; i < numlevels; ++i) { 
+            filter_image_runs_into((PyArrayObject*)features[i], pyfilter, bias, (PyArrayObject*)results[i], (PyArrayObject*)runs[i]);
+        }
+        Py_END_ALLOW_THREADS
+    }
+
+    free(features);
+    free(runs);
+
+    if (failed) {
+        for (i = 0; i < numlevels; ++i)
+            Py_XDECREF(results[i]);
+        free(results);
+        return NULL;
+    }
+
+    pyresults_list = PyList_New(numlevels);
+
+    for (i = 0; i < numlevels; ++i) {
+        PyList_SetItem(pyresults_list, i, results[i]);
+    }
+
+    free(results);
+
+    return Py_BuildValue("N", pyresults_list);    
+}
+
 static PyObject * FilterImages(PyObject * self, PyObject * args)
 {
     PyObject * pyfeatures_list;
@@ -273,12 +541,30 @@ static PyObject * FilterImages(PyObject * self, PyObject * args)
         }
     }
 
+    for (i = 0; i < numfilters; ++i) {
+        results[i] = (PyObject*)new_filtered((PyArrayObject*)objs[i], pyfilter, widths[i], heights[i]);
+        if (!results[i])
+            break;
+    }
+
+    if (i < numfilters) {
+        for (i = 0; i < numfilters; ++i)
+            Py_XDECREF(results[i]);
+        free(objs);
+        free(widths);
+        free(heights);
+        free(results);
+        return NULL;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
     kmp_set_blocktime(0);
     #pragma omp parallel for schedule(dynamic) 
     for (i = 0; i < numfilters; ++i) { 
         PyArrayObject * pyfeatures = (PyArrayObject*)objs[i];
-        results[i] = filter_image(pyfeatures, pyfilter, bias, widths[i], heights[i]);
+        filter_image_into(pyfeatures, pyfilter, bias, (PyArrayObject*)results[i]);
     }
+    Py_END_ALLOW_THREADS
 
     free(objs);
     free(widths);
@@ -295,6 +581,139 @@ static PyObject * FilterImages(PyObject * self, PyObject * args)
     return Py_BuildValue("N", pyresults_list);    
 }
 
+static PyObject * FilterBank(PyObject * self, PyObject * args)
+{
+    PyObject * pyfeatures_list;
+    PyObject * pyfilters_list;
+    PyObject * pydims_lists = NULL;
+    int numlevels;
+    int numfilters;
+    int numjobs;
+    int i, j;
+    PyObject ** features = NULL;
+    PyObject ** filters = NULL;
+    PyObject ** results = NULL;
+    int * widths = NULL;
+    int * heights = NULL;
+    int failed = 0;
+    PyObject * pyresults_list;
+    if (!PyArg_ParseTuple(args, "O!O!|O!", &PyList_Type, &pyfeatures_list, &PyList_Type, &pyfilters_list, &PyList_Type, &pydims_lists)) 
+        return NULL;
+
+    numlevels = PyList_Size(pyfeatures_list);
+    numfilters = PyList_Size(pyfilters_list);
+    numjobs = numlevels*numfilters;
+
+    if (pydims_lists && PyList_Size(pydims_lists) != numfilters) {
+        PyErr_SetString(PyExc_TypeError, "If pad dims are specified, then there must be one list per filter.");
+        return NULL;
+    }
+
+    features = (PyObject**)calloc(numlevels, sizeof(PyObject*));
+    filters = (PyObject**)calloc(numfilters, sizeof(PyObject*));
+    widths = (int*)calloc(numjobs, sizeof(int));
+    heights = (int*)calloc(numjobs, sizeof(int));
+    results = (PyObject**)calloc(numjobs, sizeof(PyObject*));
+
+    for (i = 0; i < numlevels && !failed; ++i) {
+        features[i] = PyList_GetItem(pyfeatures_list, i);
+        if (!PyArray_Check(features[i])) {
+            PyErr_SetString(PyExc_TypeError, "Features must be a list of numpy arrays.");
+            failed = 1;
+        }
+    }
+
+    for (i = 0; i < numfilters && !failed; ++i) {
+        filters[i] = PyList_GetItem(pyfilters_list, i);
+        if (!PyArray_Check(filters[i])) {
+            PyErr_SetString(PyExc_TypeError, "Filters must be a list of numpy arrays.");
+            failed = 1;
+            break;
+        }
+
+        if (!pydims_lists)
+            continue;
+
+        PyObject * pydims_list = PyList_GetItem(pydims_lists, i);
+        if (!PyList_Check(pydims_list) || PyList_Size(pydims_list) != numlevels) {
+            PyErr_SetString(PyExc_TypeError, "Pad dims must be a list of tuples for each level.");
+            failed = 1;
+            break;
+        }
+
+        for (j = 0; j < numlevels; ++j) {
+            PyObject * dims = PyList_GetItem(pydims_list, j);
+            if (!PyTuple_Check(dims) || 2 != PyTuple_Size(dims)) {
+                PyErr_SetString(PyExc_TypeError, "Pad dims must be a list of tuples for each level.");
+                failed = 1;
+                break;
+            }
+
+            heights[i*numlevels+j] = PyInt_AsLong(PyTuple_GetItem(dims, 0));
+            widths[i*numlevels+j] = PyInt_AsLong(PyTuple_GetItem(dims, 1));
+        }
+    }
+
+    if (failed) {
+        free(features);
+        free(filters);
+        free(widths);
+        free(heights);
+        free(results);
+        return NULL;
+    }
+
+    /* allocate every response up front so the filtering itself can run
+     * without the GIL while other threads keep serving requests */
+    for (i = 0; i < numjobs && !failed; ++i) {
+        PyArrayObject * pyfilter = (PyArrayObject*)filters[i/numlevels];
+        PyArrayObject * pyfeatures = (PyArrayObject*)features[i%numlevels];
+        results[i] = (PyObject*)new_filtered(pyfeatures, pyfilter, widths[i], heights[i]);
+        if (!results[i])
+            failed = 1;
+    }
+
+    if (!failed) {
+        Py_BEGIN_ALLOW_THREADS
+        /* every (filter, level) pair is an independent job so that small
+         * filters and small levels from several models balance across threads */
+        kmp_set_blocktime(0);
+        #pragma omp parallel for schedule(dynamic) 
+        for (i = 0; i < numjobs; ++i) { 
+            PyArrayObject * pyfilter = (PyArrayObject*)filters[i/numlevels];
+            PyArrayObject * pyfeatures = (PyArrayObject*)features[i%numlevels];
+            filter_image_into(pyfeatures, pyfilter, 0.0f, (PyArrayObject*)results[i]);
+        }
+        Py_END_ALLOW_THREADS
+    }
+
+    free(features);
+    free(filters);
+    free(widths);
+    free(heights);
+
+    if (failed) {
+        for (i = 0; i < numjobs; ++i)
+            Py_XDECREF(results[i]);
+        free(results);
+        return NULL;
+    }
+
+    pyresults_list = PyList_New(numfilters);
+
+    for (i = 0; i < numfilters; ++i) {
+        PyObject * pylevels_list = PyList_New(numlevels);
+        for (j = 0; j < numlevels; ++j) {
+            PyList_SetItem(pylevels_list, j, results[i*numlevels+j]);
+        }
+        PyList_SetItem(pyresults_list, i, pylevels_list);
+    }
+
+    free(results);
+
+    return Py_BuildValue("N", pyresults_list);    
+}
+
 #if PY_MAJOR_VERSION >= 3
 static struct PyModuleDef moduledef = {
     PyModuleDef_HEAD_INIT,
@@ -313,7 +732,10 @@ static struct PyModuleDef moduledef = {
 static PyMethodDef _detection_methods[] = {
     {"FilterImage", FilterImage, METH_VARARGS, "Compute a 2D cross correlation between a filter and image features.  Optionally add bias term."},
     {"FilterImages", FilterImages, METH_VARARGS, "Compute a 2D cross correlation between a filter and several image features in parallel.  Optionally add bias term."},
-    {"DeformationCost", DeformationCost, METH_VARARGS, "Compute a fast bounded distance transform for the deformation cost."},
+    {"FilterImagesMasked", FilterImagesMasked, METH_VARARGS, "Like FilterImages but only computes the responses covered by per level (row, x0, x1) runs; the rest are -inf."},
+    {"FilterBank", FilterBank, METH_VARARGS, "Cross correlate several filters with several image features in one parallel pass.  Returns one list of responses per filter."},
+    {"DeformationCost", DeformationCost, METH_VARARGS, "Compute a fast bounded distance transform for the deformation cost.  Returns (scores, Ix, Iy), or only scores if argmax is false."},
+    {"DeformationArgmax", DeformationArgmax, METH_VARARGS, "Recover the (Ix, Iy) displacement of DeformationCost at a single location."},
     {NULL}
 };
 #endif
@@ -83,6 +83,9 @@ PyObject *process(PyArrayObject *pyimage, const int sbin, const int pad_x, const
   visible[0] = cells[0]*sbin;
   visible[1] = cells[1]*sbin;
 
+  // the rest only touches memory owned by this call
+  Py_BEGIN_ALLOW_THREADS
+
   for (x = 1; x < visible[1]-1; x++) {
     for (y = 1; y < visible[0]-1; y++) {
       int xpos = mini(x, dims[1]-2);
@@ -259,7 +262,7 @@ PyObject *process(PyArrayObject *pyimage, const int sbin, const int pad_x, const
         *(float*)PyArray_GETPTR3(pyfeat, y_op, x, 31) = 1;
       }
   }
-
+  Py_END_ALLOW_THREADS
 
   free(hist);
   free(norm);
@@ -286,20 +289,23 @@ void alphacopy(float *src, float *dst, struct alphainfo *ofs, int n) {
   }
 }
 
-// resize along each column
+// resize along each column, producing only rows d0 to d1 of the result
+// src holds source rows from soffset on, sstride pixels apart
 // result is transposed, so we can apply it twice for a complete resize
-void resize1dtran(float *src, int sheight, float *dst, int dheight, 
-		  int width, int chan) {
+void resize1dtran_window(float *src, int sheight, int soffset, int sstride,
+                         float *dst, int dheight, int d0, int d1,
+                         int width, int chan) {
   float scale = (float)dheight/(float)sheight;
   float invscale = (float)sheight/(float)dheight;
+  int dlen = d1 - d0;
   
   // we cache the interpolation values since they can be 
   // shared among different columns
-  int len = (int)ceil(dheight*invscale) + 2*dheight;
+  int len = (int)ceil(dlen*invscale) + 2*dlen + 2;
   struct alphainfo ofs[len];
   int k = 0;
   int dy, sy, c, x;
-  for (dy = 0; dy < dheight; dy++) {
+  for (dy = d0; dy < d1; dy++) {
     float fsy1 = dy * invscale;
     float fsy2 = fsy1 + invscale;
     int sy1 = (int)ceil(fsy1);
@@ -307,40 +313,54 @@ void resize1dtran(float *src, int sheight, float *dst, int dheight,
 
     if (sy1 - fsy1 > 1e-3) {
       assert(k < len);
-      ofs[k].di = chan*dy;
-      ofs[k].si = chan*(sy1-1)*width;
+      assert(sy1-1 >= soffset);
+      ofs[k].di = chan*(dy-d0);
+      ofs[k].si = chan*(sy1-1-soffset)*sstride;
       ofs[k++].alpha = (sy1 - fsy1) * scale;
     }
 
     for (sy = sy1; sy < sy2; sy++) {
       assert(k < len);
       assert(sy < sheight);
-      ofs[k].di = chan*dy;
-      ofs[k].si = chan*sy*width;
+      ofs[k].di = chan*(dy-d0);
+      ofs[k].si = chan*(sy-soffset)*sstride;
       ofs[k++].alpha = scale;
     }
 
     if (fsy2 - sy2 > 1e-3) {
       assert(k < len);
       assert(sy2 < sheight);
-      ofs[k].di = chan*dy;
-      ofs[k].si = chan*sy2*width;
+      ofs[k].di = chan*(dy-d0);
+      ofs[k].si = chan*(sy2-soffset)*sstride;
       ofs[k++].alpha = (fsy2 - sy2) * scale;
     }
   }
 
   // resize each column of each color channel
-  bzero(dst, chan*width*dheight*sizeof(float));
+  bzero(dst, chan*width*dlen*sizeof(float));
   for (c = 0; c < chan; c++) {
     for (x = 0; x < width; x++) {
       float *s = src + c + chan*x;
-      float *d = dst + c + chan*x*dheight;
+      float *d = dst + c + chan*x*dlen;
       alphacopy(s, d, ofs, k);
     }
   }
 }
 
-PyObject *resize_image(PyArrayObject * pyimage, int y, int x) {
+// resize along each column
+// result is transposed, so we can apply it twice for a complete resize
+void resize1dtran(float *src, int sheight, float *dst, int dheight, 
+		  int width, int chan) {
+  resize1dtran_window(src, sheight, 0, width, dst, dheight, 0, dheight, width, chan);
+}
+
+// rows y0 to y1 and columns x0 to x1 of the image resized to y by x; the
+// same as cropping the whole resized image, but only reads and computes
+// the pixels the window needs.  pyimage holds the rows from sy0 and the
+// columns from sx0 of an image of sheight by swidth pixels, and must
+// cover the pixels the window reads
+PyObject *resize_image(PyArrayObject * pyimage, int y, int x, int y0, int y1, int x0, int x1,
+                       int sy0, int sx0, int sheight, int swidth) {
   npy_intp * sdims = PyArray_DIMS(pyimage);
   npy_intp * strides = PyArray_STRIDES(pyimage);
   npy_intp ddims[3];
@@ -366,15 +386,50 @@ PyObject *resize_image(PyArrayObject * pyimage, int y, int x) {
     return NULL;
   }
 
-  ddims[0] = y;
-  ddims[1] = x;
+  if (sheight < 0)
+    sheight = sy0 + sdims[0];
+  if (swidth < 0)
+    swidth = sx0 + sdims[1];
+
+  if (y0 < 0 || y0 > y1 || y1 > y || x0 < 0 || x0 > x1 || x1 > x) {
+    PyErr_SetString(PyExc_ValueError, "Window must be within the resized image.");
+    return NULL;
+  }
+
+  ddims[0] = y1 - y0;
+  ddims[1] = x1 - x0;
   ddims[2] = sdims[2];
 
   pyresized = (PyArrayObject*)PyArray_SimpleNew((npy_intp)3, ddims, NPY_FLOAT);
+  if (ddims[0] == 0 || ddims[1] == 0)
+    return Py_BuildValue("N", pyresized);
+
+  // source rows and columns the window reads
+  float invscaley = (float)sheight/(float)y;
+  float invscalex = (float)swidth/(float)x;
+  int ry0 = maxi(0, (int)floor(y0 * invscaley) - 1);
+  int ry1 = mini(sheight, (int)ceil(y1 * invscaley) + 2);
+  int rx0 = maxi(0, (int)floor(x0 * invscalex) - 1);
+  int rx1 = mini(swidth, (int)ceil(x1 * invscalex) + 2);
+
+  if (ry0 < sy0 || ry1 > sy0 + sdims[0] || rx0 < sx0 || rx1 > sx0 + sdims[1]) {
+    Py_DECREF(pyresized);
+    PyErr_SetString(PyExc_ValueError, "Input image must cover the pixels the window reads.");
+    return NULL;
+  }
+
+  float *tmp = (float*)calloc(ddims[0]*(rx1-rx0)*sdims[2], sizeof(float));
+  if (!tmp) {
+    Py_DECREF(pyresized);
+    return PyErr_NoMemory();
+  }
 
-  float *tmp = (float*)calloc(ddims[0]*sdims[1]*sdims[2], sizeof(float));
-  resize1dtran((float*)PyArray_DATA(pyimage), sdims[0], tmp, ddims[0], sdims[1], sdims[2]);
-  resize1dtran(tmp, sdims[1], (float*)PyArray_DATA(pyresized), ddims[1], ddims[0], sdims[2]);
+  Py_BEGIN_ALLOW_THREADS
+  resize1dtran_window((float*)PyArray_DATA(pyimage) + sdims[2]*(rx0-sx0), sheight, sy0, sdims[1],
+                      tmp, y, y0, y1, rx1-rx0, sdims[2]);
+  resize1dtran_window(tmp, swidth, rx0, ddims[0],
+                      (float*)PyArray_DATA(pyresized), x, x0, x1, ddims[0], sdims[2]);
+  Py_END_ALLOW_THREADS
 
   free(tmp);
 
@@ -395,10 +450,14 @@ static PyObject * ResizeImage (PyObject * self, PyObject * args)
 {
     PyArrayObject * pyimage;
     int x, y;
-    if (!PyArg_ParseTuple(args, "O!ii", &PyArray_Type, &pyimage, &y, &x)) {
+    int y0 = 0, y1 = -1, x0 = 0, x1 = -1;
+    int sy0 = 0, sx0 = 0, sheight = -1, swidth = -1;
+    if (!PyArg_ParseTuple(args, "O!ii|iiiiiiii", &PyArray_Type, &pyimage, &y, &x, &y0, &y1, &x0, &x1,
+                          &sy0, &sx0, &sheight, &swidth)) {
         return NULL;
     }
-    return resize_image (pyimage, y, x);
+    return resize_image (pyimage, y, x, y0, y1 < 0 ? y : y1, x0, x1 < 0 ? x : x1,
+                         sy0, sx0, sheight, swidth);
 }
 
 #if PY_MAJOR_VERSION >= 3
@@ -418,7 +477,7 @@ static struct PyModuleDef moduledef = {
 #if PY_MAJOR_VERSION < 3
 static PyMethodDef _features_methods[] = {
     {"ComputeFeatures", ComputeFeatures, METH_VARARGS, "Compute Pedro's special HoG features."},
-    {"ResizeImage", ResizeImage, METH_VARARGS, "Resize image using Pedro's fast implementation."},
+    {"ResizeImage", ResizeImage, METH_VARARGS, "Resize image using Pedro's fast implementation.  Optionally only compute the rows y0 to y1 and columns x0 to x1 of the result, from an image holding the rows from sy0 and columns from sx0 of a sheight by swidth image."},
     {NULL}
 };
 #endif
@@ -3,6 +3,7 @@
 #include <numpy/arrayobject.h>
 
 #include <math.h>
+#include <stdlib.h>
 
 #ifdef __INTEL_COMPILER
 #include <mkl_cblas.h>
@@ -11,6 +12,13 @@
 #define kmp_set_blocktime(k) 
 #endif
 
+#ifdef _OPENMP
+#include <omp.h>
+#else
+#define omp_get_max_threads() 1
+#define omp_get_thread_num() 0
+#endif
+
 static inline float minf (float a, float b) { return a < b ? a : b; }
 static inline float maxf (float a, float b) { return a < b ? b : a; }
 
@@ -65,67 +73,108 @@ PyObject * compute_overlap (float bbx1, float bby1, float bbx2, float bby2,
     return Py_BuildValue("N", pyoverlap);
 }
 
-#if 0
-PyObject * objective_function (PyObject * pyexamples) {
-    int i;
-    int j;
-    int k;
-
-    for (i = 0; i < PyList_Size(pyexamples); ++i) {
-        PyObject * pyexample = PyList_GetItem (pyexamples, i);
-        if (!PyList_Check(pyexample)) {
-            PyErr_SetString(PyExc_TypeError, "example list elements must be list.");
-            return NULL;
-        }
-
-        for (j = 0; j < PyList_Size(pyexample); ++j) {
+/* latent svm objective over examples packed as the rows of a csr matrix
+ * laid out like the solution vector; the rows of example e are starts[e]
+ * up to the next start and belief[e] is the row of its belief.  fills
+ * gradient and value and returns 0, or -1 when out of memory.  touches no
+ * python state so it can run with the GIL released.  sums are taken in
+ * a fixed order so the result does not depend on thread timing */
+int objective_function (const double * data, const int * indices, const int * indptr,
+                        const double * loss, int num_rows,
+                        const int * starts, const int * belief, int num_examples,
+                        const double * regularization, const double * solution, int num_parms,
+                        double svm_c, double * gradient, double * value) {
+    /* every buffer has an element more so only failures give NULL */
+    int num_threads = omp_get_max_threads();
+    double * scores = (double*)malloc((num_rows+1)*sizeof(double));
+    double * margins = (double*)malloc((num_examples+1)*sizeof(double));
+    int * chosen = (int*)malloc((num_examples+1)*sizeof(int));
+    double * locals = (double*)calloc((size_t)num_threads*num_parms+1, sizeof(double));
+    int r, e, k;
+
+    if (scores == NULL || margins == NULL || chosen == NULL || locals == NULL) {
+        free(scores);
+        free(margins);
+        free(chosen);
+        free(locals);
+        return -1;
+    }
 
-            PyObject * pyentry = PyList_GetItem(pyexample, j);
-            if (!PyTuple_Check(pyentry)) {
-                PyErr_SetString(PyExc_TypeError, "entries must be tuples.");
-                return NULL;
-            }
+    kmp_set_blocktime(0);
 
-            if (PyTuple_Size(pyentry) != 2) {
-                PyErr_SetString(PyExc_TypeError, "entry tuples must be of size 2");
-                return NULL;
-            }
+    #pragma omp parallel for schedule(static)
+    for (r = 0; r < num_rows; ++r) {
+        double score = 0;
+        int j;
+        for (j = indptr[r]; j < indptr[r+1]; ++j)
+            score += data[j]*solution[indices[j]];
+        scores[r] = score;
+    }
 
-            PyObject * pyfeatures = PyTuple_GetItem(pyentry, 0);
-            if (!PyDict_Check(pyfeatures)) {
-                PyErr_SetString(PyExc_TypeError, "features must be a dict");
-                return NULL;
-            }
+    /* the first highest scoring entry of every example */
+    #pragma omp parallel for schedule(static)
+    for (e = 0; e < num_examples; ++e) {
+        int end = e+1 < num_examples ? starts[e+1] : num_rows;
+        int best = starts[e];
+        int i;
+        for (i = starts[e]+1; i < end; ++i) {
+            if (scores[i]+loss[i] > scores[best]+loss[best])
+                best = i;
+        }
+        chosen[e] = best;
+        margins[e] = svm_c*(scores[best]+loss[best]-scores[belief[e]]);
+    }
 
-            PyObject * pyfeatureslist = PyDict_Items(pyfeatures);
+    /* every thread sums its examples apart */
+    #pragma omp parallel num_threads(num_threads)
+    {
+        double * local = locals + (size_t)omp_get_thread_num()*num_parms;
+        int i, j;
+
+        #pragma omp for schedule(static)
+        for (i = 0; i < num_examples; ++i) {
+            if (chosen[i] == belief[i])
+                continue;
+            for (j = indptr[chosen[i]]; j < indptr[chosen[i]+1]; ++j)
+                local[indices[j]] += svm_c*data[j];
+            for (j = indptr[belief[i]]; j < indptr[belief[i]+1]; ++j)
+                local[indices[j]] -= svm_c*data[j];
+        }
+    }
 
-            float score = 0;
-            for (k = 0; k < PyDict_Size(pyfeatureslist); ++k) {
-                PyObject * pyfeature = PyList_GetItem(pyfeatureslist, k);
-                PyObject * pyblock = PyTuple_GetItem(pyfeature, 0);
+    /* then the threads are added in in order */
+    #pragma omp parallel for schedule(static)
+    for (k = 0; k < num_parms; ++k) {
+        double sum = regularization[k]*solution[k];
+        int t;
+        for (t = 0; t < num_threads; ++t)
+            sum += locals[(size_t)t*num_parms+k];
+        gradient[k] = sum;
+    }
 
-                PyObject * pyw = PyTuple_GetItem(pyfeature, 1);
-                if (!PyArray_Check(pyw)) {
-                    PyErr_SetString(PyExc_TypeError, "w must be a numpy array");
-                    return NULL;
-                }
+    *value = 0;
+    for (e = 0; e < num_examples; ++e)
+        *value += margins[e];
+    for (k = 0; k < num_parms; ++k)
+        *value += 0.5*regularization[k]*solution[k]*solution[k];
 
-                PyArrayObject * pywarray = (PyArrayObject*)pyw;
+    free(scores);
+    free(margins);
+    free(chosen);
+    free(locals);
 
-                
-            }
+    return 0;
+}
 
-            PyObject * pydetection = PyTuple_GetItem(pyentry, 1);
-        }
+static int check_vector (PyArrayObject * pyarray, int type, npy_intp size, const char * message) {
+    if (PyArray_NDIM(pyarray) != 1 || PyArray_DESCR(pyarray)->type_num != type ||
+            !PyArray_IS_C_CONTIGUOUS(pyarray) || (size >= 0 && PyArray_DIMS(pyarray)[0] != size)) {
+        PyErr_SetString(PyExc_TypeError, message);
+        return 0;
     }
-    return Py_BuildValue("i", 0);
+    return 1;
 }
 
-PyObject * gradient (PyObject * examples, PyObject * gradients) {
-    Py_RETURN_NONE;
-}
-#endif
-
 static PyObject * ComputeOverlap(PyObject * self, PyObject * args)
 {
     float x1, x2, y1, y2;
@@ -138,26 +187,81 @@ static PyObject * ComputeOverlap(PyObject * self, PyObject * args)
     return compute_overlap(x1, y1, x2, y2, fdimy, fdimx, dimy, dimx, scale, pady, padx, h, w);
 }
 
-#if 0
 static PyObject * ObjectiveFunction (PyObject * self, PyObject * args) {
-    PyObject * pyexamples;
-    if (!PyArg_ParseTuple (args, "O!", &PyList_Type, &pyexamples)) {
+    PyArrayObject * pydata, * pyindices, * pyindptr, * pyloss, * pystarts, * pybelief;
+    PyArrayObject * pyregularization, * pysolution, * pygradient;
+    double svm_c;
+    double value;
+    int num_rows, num_examples, num_parms, num_nonzeros, i, status;
+    const int * indptr, * indices, * starts, * belief;
+
+    if (!PyArg_ParseTuple(args, "O!O!O!O!O!O!O!O!dO!",
+                          &PyArray_Type, &pydata, &PyArray_Type, &pyindices, &PyArray_Type, &pyindptr,
+                          &PyArray_Type, &pyloss, &PyArray_Type, &pystarts, &PyArray_Type, &pybelief,
+                          &PyArray_Type, &pyregularization, &PyArray_Type, &pysolution,
+                          &svm_c, &PyArray_Type, &pygradient))
         return NULL;
-    }
 
-    return objective_function (pyexamples);
-}
+    if (!check_vector(pyloss, NPY_DOUBLE, -1, "loss must be a contiguous double vector.") ||
+        !check_vector(pysolution, NPY_DOUBLE, -1, "solution must be a contiguous double vector."))
+        return NULL;
+
+    num_rows = PyArray_DIMS(pyloss)[0];
+    num_parms = PyArray_DIMS(pysolution)[0];
 
-static PyObject * Gradient (PyObject * self, PyObject * args) {
-    PyObject * pyexamples;
-    PyObject * pygradients;
-    if (!PyArg_ParseTuple (args, "O!O!", &PyList_Type, &pyexamples, &PyDict_Type, &pygradients)) {
+    if (!check_vector(pyindptr, NPY_INT, num_rows+1, "indptr must be a contiguous int vector with a row more than loss.") ||
+        !check_vector(pystarts, NPY_INT, -1, "starts must be a contiguous int vector.") ||
+        !check_vector(pyregularization, NPY_DOUBLE, num_parms, "regularization must be a contiguous double vector like solution.") ||
+        !check_vector(pygradient, NPY_DOUBLE, num_parms, "gradient must be a contiguous double vector like solution."))
         return NULL;
+
+    num_examples = PyArray_DIMS(pystarts)[0];
+    indptr = (const int*)PyArray_DATA(pyindptr);
+    num_nonzeros = indptr[num_rows];
+
+    if (!check_vector(pybelief, NPY_INT, num_examples, "belief must be a contiguous int vector like starts.") ||
+        !check_vector(pydata, NPY_DOUBLE, num_nonzeros, "data must be a contiguous double vector of the nonzeros.") ||
+        !check_vector(pyindices, NPY_INT, num_nonzeros, "indices must be a contiguous int vector of the nonzeros."))
+        return NULL;
+
+    /* out of range rows or columns would read past the buffers */
+    indices = (const int*)PyArray_DATA(pyindices);
+    starts = (const int*)PyArray_DATA(pystarts);
+    belief = (const int*)PyArray_DATA(pybelief);
+    for (i = 0; i < num_rows; ++i) {
+        if (indptr[i] < 0 || indptr[i] > indptr[i+1]) {
+            PyErr_SetString(PyExc_ValueError, "indptr must be nondecreasing.");
+            return NULL;
+        }
     }
+    for (i = 0; i < num_nonzeros; ++i) {
+        if (indices[i] < 0 || indices[i] >= num_parms) {
+            PyErr_SetString(PyExc_ValueError, "indices out of range.");
+            return NULL;
+        }
+    }
+    for (i = 0; i < num_examples; ++i) {
+        int end = i+1 < num_examples ? starts[i+1] : num_rows;
+        if (starts[i] < 0 || starts[i] >= end || belief[i] < starts[i] || belief[i] >= end) {
+            PyErr_SetString(PyExc_ValueError, "every example needs its own rows, one of them its belief.");
+            return NULL;
+        }
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    status = objective_function((const double*)PyArray_DATA(pydata), indices, indptr,
+                                (const double*)PyArray_DATA(pyloss), num_rows,
+                                starts, belief, num_examples,
+                                (const double*)PyArray_DATA(pyregularization),
+                                (const double*)PyArray_DATA(pysolution), num_parms,
+                                svm_c, (double*)PyArray_DATA(pygradient), &value);
+    Py_END_ALLOW_THREADS
+
+    if (status != 0)
+        return PyErr_NoMemory();
 
-    return gradient (pyexamples, pygradients);
+    return Py_BuildValue("d", value);
 }
-#endif
 
 #if PY_MAJOR_VERSION >= 3
 static struct PyModuleDef moduledef = {
@@ -176,10 +280,7 @@ static struct PyModuleDef moduledef = {
 #if PY_MAJOR_VERSION < 3
 static PyMethodDef _train_methods[] = {
     {"compute_overlap", ComputeOverlap, METH_VARARGS, "Compute detection overlaps with bbox."},
-#if 0
-    {"ObjectiveFunction", ObjectiveFunction, METH_VARARGS, "WL-SSVM objective function."},
-    {"Gradient", Gradient, METH_VARARGS, "WL-SSVM gradient."},
-#endif
+    {"objective_function", ObjectiveFunction, METH_VARARGS, "WL-SSVM objective function.  Fills the gradient and returns the objective."},
     {NULL}
 };
 #endif
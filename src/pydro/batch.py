@@ -0,0 +1,110 @@
+"""Batch detection over a pool of forked worker processes.
+
+The model's weights are first moved into one shared memory segment so the
+workers, which inherit the model graph through fork, all read the same
+pages rather than each holding its own copy of every block.  Detections
+come back as lists of core.Detection, one per image, in input order.
+"""
+
+import itertools
+import multiprocessing
+
+import numpy
+import numpy.ctypeslib
+import scipy.misc
+
+from pydro.core import _Defs, _Unique
+from pydro.detection import NMS
+from pydro.features import BuildPyramid
+
+__all__ = [
+    'ShareWeights',
+    'BatchDetector',
+]
+
+
+def ShareWeights(model):
+    """Move every weight array of model into one shared memory segment.
+
+    Block.w and the flipped copies kept by Filter and Def become read-only
+    views of a multiprocessing.RawArray, which is returned.  Processes
+    forked afterwards share those pages.
+    """
+
+    blocks = _Unique(model.GetBlocks())
+    filters = model.GetFilters()
+    flipped = [filter for filter in filters if filter.flip]
+    defs = _Defs(model)
+
+    arrays = [block.w for block in blocks] + \
+        [filter._w for filter in flipped] + \
+        [df._w for df in defs]
+    for array in arrays:
+        if array.dtype != numpy.float32:
+            raise Exception('only single precision weights can be shared')
+
+    offsets = [0]
+    for array in arrays:
+        offsets += [offsets[-1] + array.size]
+
+    segment = multiprocessing.RawArray('f', max(1, offsets[-1]))
+    memory = numpy.ctypeslib.as_array(segment)
+
+    views = []
+    for array, offset in itertools.izip(arrays, offsets):
+        view = memory[offset:offset + array.size].reshape(array.shape)
+        view[...] = array
+        view.flags.writeable = False
+        views += [view]
+
+    views = iter(views)
+    for block in blocks:
+        block.w = next(views)
+    for filter in flipped:
+        filter._w = next(views)
+    for df in defs:
+        df._w = next(views)
+    for filter in filters:
+        if not filter.flip:
+            filter._w = filter.blocklabel.w
+
+    return segment
+
+
+_worker = None
+
+
+def _Initialize(model, threshold, nms_threshold):
+    global _worker
+    _worker = (model, threshold, nms_threshold)
+
+
+def _DetectFile(filename):
+    model, threshold, nms_threshold = _worker
+
+    image = scipy.misc.imread(filename)
+    pyramid = BuildPyramid(image, model=model)
+    detections = model.Filter(pyramid, score_only=True).Detect(threshold)
+    if nms_threshold is not None:
+        detections = NMS(detections, nms_threshold)
+
+    return list(detections)
+
+
+class BatchDetector(object):
+
+    def __init__(self, model, processes=None, threshold=-0.5,
+                 nms_threshold=0.5):
+        self.model = model
+        self.segment = ShareWeights(model)
+        self._pool = multiprocessing.Pool(
+            processes, _Initialize, (model, threshold, nms_threshold))
+
+    def Detect(self, filenames, chunksize=1):
+        """Detections for each image file, yielded in input order."""
+
+        return self._pool.imap(_DetectFile, filenames, chunksize)
+
+    def Close(self):
+        self._pool.close()
+        self._pool.join()
@@ -1,5 +1,7 @@
-from pydro.detection import FilterPyramid, DeformationCost, Score
+from pydro.detection import FilterPyramid, FilterPyramidBank, FilterPyramidMasked, DeformationCost, DeformationArgmax, NMS, Score
+from pydro.features import RoiIntegral, RoiMask, RoiWindows
 
+import heapq
 import itertools
 import numpy
 from collections import namedtuple
@@ -12,8 +14,11 @@ __all__ = [
     'DeformationRule',
     'Features',
     'Filter',
+    'Geometry',
     'Loc',
     'Model',
+    'ModelSet',
+    'FilteredModelSet',
     'Rule',
     'Stats',
     'StructuralRule',
@@ -23,11 +28,41 @@ __all__ = [
     'FilteredDeformationRule',
     'TreeNode',
     'Leaf',
+    'Detection',
 ]
 
 TreeRoot = namedtuple('TreeRoot', 'x1,x2,y1,y2,s,child,loss,model')
 TreeNode = namedtuple('TreeNode', 'x,y,l,symbol,ds,s,children,rule,loss')
 Leaf = namedtuple('Leaf', 'x1,x2,y1,y2,scale,x,y,l,s,ds,symbol')
+Detection = namedtuple('Detection', 'x1,x2,y1,y2,s,l,component')
+
+
+def _Unique(objects):
+    seen = set()
+    unique = []
+    for obj in objects:
+        if id(obj) not in seen:
+            seen.add(id(obj))
+            unique += [obj]
+    return unique
+
+
+def _Defs(model):
+    defs = []
+    symbols = [model.start]
+    visited = set()
+    while symbols:
+        symbol = symbols.pop()
+        if id(symbol) in visited:
+            continue
+        visited.add(id(symbol))
+
+        for rule in symbol.rules:
+            if isinstance(rule, DeformationRule):
+                defs += [rule.df]
+            symbols += rule.rhs
+
+    return _Unique(defs)
 
 
 class Model(object):
@@ -46,17 +81,326 @@ class Model(object):
         self.type = type
         self.features = features
         self.stats = stats
+        self._geometry = {}
+
+    def Filter(self, pyramid, loss_adjustment=None, score_only=False,
+               lazy_argmax=False, responses=None, masks=None, roi=None,
+               previous=None):
+        """Score the pyramid with the model.
 
-    def Filter(self, pyramid, loss_adjustment=None):
-        return FilteredModel(self, pyramid, loss_adjustment)
+        masks optionally holds one boolean array per level, shaped like the
+        start symbol's scores.  Only scores under them are then exact; the
+        filters are evaluated just where those scores depend on them and
+        everything else is -inf.
+
+        A region of interest (see features.RoiMask), by default the one the
+        pyramid was built with, limits the scores to detections whose root
+        window overlaps it.
+
+        previous, the model filtered on an earlier pyramid of the same shape
+        (see features.UpdatePyramid) without score_only, lends its filter
+        responses wherever the features under them did not change.
+        """
+
+        if roi is None:
+            roi = pyramid.roi
+        else:
+            roi = RoiMask(roi, pyramid.image.shape)
+
+        if previous is not None and responses is None:
+            responses = _UpdateResponses(pyramid, previous)
+
+        return FilteredModel(
+            self, pyramid, loss_adjustment, score_only, lazy_argmax, responses,
+            masks, roi)
+
+    def ScoreBoxes(self, pyramid, boxes, loss_adjustment=None):
+        """Parse trees of the model placed at boxes, (x1, y1, x2, y2) each.
+
+        Every component is placed at the level whose root window is closest
+        in size to the box and the best scoring placement is kept; boxes no
+        component can be placed at give None.  Parts are still searched
+        with their deformation costs, but the filters are only evaluated
+        where those placements need them.
+        """
+
+        size = self.GetGeometry(pyramid).size
+        scales = numpy.array([level.scale for level in pyramid.levels])
+        masks = [numpy.zeros(s, dtype=bool) for s in size]
+
+        placements = []
+        for x1, y1, x2, y2 in boxes:
+            found = []
+            for component, rule in enumerate(self.start.rules):
+                windows = numpy.array(rule.detwindow, dtype=float) * \
+                    pyramid.sbin / scales[:, None]
+                l = numpy.argmin(numpy.fabs(numpy.log(
+                    windows / [y2 - y1 + 1, x2 - x1 + 1])).sum(axis=1))
+
+                # invert FilteredModel._RootBox
+                cells = scales[l] / pyramid.sbin
+                x = int(round(x1 * cells)) + rule.shiftwindow[1] + pyramid.padx
+                y = int(round(y1 * cells)) + rule.shiftwindow[0] + pyramid.pady
+                if 0 <= y < size[l][0] and 0 <= x < size[l][1]:
+                    masks[l][y, x] = True
+                    found += [(component, x, y, l)]
+            placements += [found]
+
+        filtered = self.Filter(pyramid, loss_adjustment, lazy_argmax=True,
+                               masks=masks)
+
+        trees = []
+        for found in placements:
+            best = None
+            for component, x, y, l in found:
+                rule = filtered.start.rules[component]
+                s = rule.score[l].score[y, x]
+                if s > -numpy.inf and (best is None or s > best[0]):
+                    best = (s, rule, x, y, l)
+
+            if best is None:
+                trees += [None]
+                continue
+
+            s, rule, x, y, l = best
+            parsed = filtered.start.Parse(
+                x=x, y=y, l=l, s=s, ds=0, model=filtered, rule=rule)
+            x1, y1, x2, y2 = filtered._RootBox(rule, x, y, l, 0)
+
+            trees += [TreeRoot(
+                model=filtered,
+                x1=x1,
+                y1=y1,
+                x2=x2,
+                y2=y2,
+                s=parsed.s,
+                child=parsed,
+                loss=parsed.loss,
+            )]
+
+        return trees
 
     def GetBlocks(self):
         return self.start.GetBlocks()
 
+    def GetFilters(self):
+        filters = []
+        for filter in self.start.GetFilters():
+            if filter not in filters:
+                filters += [filter]
+        return filters
+
+    def GetGeometry(self, pyramid):
+        key = Geometry.Key(pyramid)
+
+        geometry = self._geometry.get(key)
+        if geometry is None:
+            if len(self._geometry) >= Geometry.max_cached:
+                self._geometry.clear()
+            geometry = Geometry(self, pyramid)
+            self._geometry[key] = geometry
+
+        return geometry
+
+
+class Geometry(object):
+
+    """Filtered sizes and anchor placements for one pyramid shape.
+
+    An anchor placement is (sy, oy, sx, ox): the child map is read through
+    the strided view [sy, sx] and lands at offset (oy, ox) in the parent.
+
+    Cached on the model, so edit the grammar before the first Filter call.
+    """
+
+    max_cached = 16
+
+    def __init__(self, model, pyramid):
+        self.padx = pyramid.padx
+        self.pady = pyramid.pady
+        self.interval = pyramid.interval
+        self.size = model.start.GetFilteredSize(pyramid)
+        self._anchors = {}
+
+    @staticmethod
+    def Key(pyramid):
+        return (
+            tuple(level.features.shape for level in pyramid.levels),
+            pyramid.padx,
+            pyramid.pady,
+            pyramid.interval,
+        )
+
+    def GetAnchor(self, anchor, shape, child_shape):
+        key = (anchor, shape, child_shape)
+
+        placement = self._anchors.get(key)
+        if placement is None:
+            placement = self._PlaceAnchor(anchor, shape, child_shape)
+            self._anchors[key] = placement
+
+        return placement
+
+    def _PlaceAnchor(self, anchor, shape, child_shape):
+        ax, ay, ds = anchor
+
+        step = 2 ** ds
+
+        virtpadx = (step - 1) * self.padx
+        virtpady = (step - 1) * self.pady
+
+        startx = ax - virtpadx + 1
+        starty = ay - virtpady + 1
+
+        endy = min(child_shape[0], starty + step * (shape[0] - 1))
+        endx = min(child_shape[1], startx + step * (shape[1] - 1))
+
+        iy = numpy.arange(starty, endy + 1, step)
+        oy = (iy < 1).sum()
+        iy = iy[numpy.where(iy >= 1)].flatten()
+
+        ix = numpy.arange(startx, endx + 1, step)
+        ox = (ix < 1).sum()
+        ix = ix[numpy.where(ix >= 1)].flatten()
+
+        return _Subsample(iy - 1, step), oy, _Subsample(ix - 1, step), ox
+
+
+def _Unchanged(previous, children, previous_children):
+    """True if previous was already filtered and no child score changed.
+
+    Re-filtering a FilteredModel (e.g. with a new loss adjustment) can then
+    reuse the previous maps instead of recomputing them.
+    """
+
+    return hasattr(previous, 'score') and all(
+        a.score is b.score
+        for a, b in itertools.izip(children, previous_children))
+
+
+def _Dilate(mask, s):
+    dilated = mask.copy()
+    for d in xrange(1, s + 1):
+        dilated[:, d:] |= mask[:, :-d]
+        dilated[:, :-d] |= mask[:, d:]
+
+    mask = dilated.copy()
+    for d in xrange(1, s + 1):
+        dilated[d:, :] |= mask[:-d, :]
+        dilated[:-d, :] |= mask[d:, :]
+
+    return dilated
+
+
+def _SearchMasks(model, start, masks):
+    """For each symbol, the positions whose scores the start masks need.
+
+    Masks are pushed from the start symbol down the grammar: a deformation
+    rule needs its child within the deformation window and a structural
+    rule needs each child where its anchor places it.
+    """
+
+    order = []
+    visited = set()
+
+    def visit(symbol):
+        if symbol in visited:
+            return
+        visited.add(symbol)
+        for rule in symbol.rules:
+            for child in rule.rhs:
+                visit(child)
+        order.append(symbol)
+
+    visit(start)
+
+    if [numpy.shape(mask) for mask in masks] != \
+            [tuple(size) for size in model.size]:
+        raise Exception('there must be one mask per level shaped like its scores')
+
+    search = {start: [numpy.array(mask, dtype=bool) for mask in masks]}
+    for symbol in reversed(order):
+        needed = search[symbol]
+
+        for rule in symbol.rules:
+            if isinstance(rule, DeformationRule):
+                child, = rule.rhs
+                required = [_Dilate(mask, 4) for mask in needed]
+                if child in search:
+                    for a, b in itertools.izip(search[child], required):
+                        a |= b
+                else:
+                    search[child] = required
+                continue
+
+            for anchor, child in itertools.izip(rule.anchor, rule.rhs):
+                if child not in search:
+                    search[child] = [
+                        numpy.zeros(size, dtype=bool) for size in model.size]
+                required = search[child]
+
+                for i in xrange(len(needed)):
+                    level = i - model.pyramid.interval * anchor[2]
+                    if level < 0 or not needed[i].any():
+                        continue
+
+                    sy, oy, sx, ox = model.geometry.GetAnchor(
+                        tuple(anchor), needed[i].shape, required[level].shape)
+
+                    view = required[level][sy, sx]
+                    view |= needed[i][oy:oy + view.shape[0],
+                                      ox:ox + view.shape[1]]
+
+    return search
+
+
+def _UpdateResponses(pyramid, previous):
+    """Responses of previous refiltered where the features of pyramid differ."""
+
+    if Geometry.Key(pyramid) != Geometry.Key(previous.pyramid):
+        raise Exception('previous was filtered on a pyramid of another shape')
+
+    changed = []
+    for level, old in itertools.izip(pyramid.levels, previous.pyramid.levels):
+        if level.features is old.features:
+            changed += [None]
+        else:
+            changed += [RoiIntegral(
+                (level.features != old.features).any(axis=2))]
+
+    responses = {}
+    for filter, score in previous.responses.iteritems():
+        w = filter.GetParameters()
+
+        # positions whose filter window covers a changed cell
+        masks = [
+            numpy.zeros(size, dtype=bool) if integral is None else
+            RoiWindows(integral, size, 1, (0, 0), w.shape[0:2])
+            for integral, size in itertools.izip(changed, previous.size)
+        ]
+        updated = FilterPyramidMasked(pyramid, w, previous.size, masks)
+
+        responses[filter] = [
+            old if not mask.any() else Score(
+                scale=old.scale,
+                score=numpy.where(mask, new.score, old.score),
+            )
+            for old, new, mask in itertools.izip(score, updated, masks)
+        ]
+
+    return responses
+
+
+def _Subsample(indices, step):
+    if len(indices) == 0:
+        return slice(0, 0)
+    return slice(indices[0], indices[-1] + 1, step)
+
 
 class FilteredModel (Model):
 
-    def __init__(self, model, pyramid, loss_adjustment):
+    def __init__(self, model, pyramid, loss_adjustment, score_only=False,
+                 lazy_argmax=False, responses=None, masks=None, roi=None):
         super(FilteredModel, self).__init__(
             clss=model.clss,
             year=model.year,
@@ -72,16 +416,74 @@ class FilteredModel (Model):
             stats=model.stats,
         )
 
-        self.size = self.start.GetFilteredSize(pyramid)
+        self._geometry = model._geometry
+        self.geometry = self.GetGeometry(pyramid)
+        self.size = self.geometry.size
         self.loss_adjustment = loss_adjustment
+        self.score_only = score_only
+        self.lazy_argmax = lazy_argmax
         self.pyramid = pyramid
+        self.responses = {} if responses is None else responses
+        self.masks = masks
+        self.roi = roi
+
+        if roi is not None:
+            windows = self._RoiWindows(model.start, roi)
+            masks = [numpy.logical_or.reduce(level) for level in
+                     itertools.izip(*windows)]
+            if self.masks is not None:
+                masks = [a & b for a, b in itertools.izip(masks, self.masks)]
+
+        self.search = None if masks is None else _SearchMasks(
+            self, model.start, masks)
 
         self.start = model.start.Filter(self)
 
+        if roi is not None:
+            self._Restrict(windows)
+
     def Filter(self, loss_adjustment=None):
-        return FilteredModel(self, self.pyramid, self.loss_adjustment)
+        if self.score_only:
+            raise Exception('score-only models cannot be refiltered')
+
+        return FilteredModel(self, self.pyramid, loss_adjustment,
+                             lazy_argmax=self.lazy_argmax,
+                             responses=self.responses,
+                             masks=self.masks,
+                             roi=self.roi)
+
+    def _RoiWindows(self, start, roi):
+        """Per start rule, the positions whose root window overlaps roi."""
+
+        integral = RoiIntegral(roi)
+
+        windows = []
+        for rule in start.rules:
+            windows += [[
+                # the window of _RootBox
+                RoiWindows(
+                    integral, size, self.pyramid.sbin / level.scale,
+                    (rule.shiftwindow[0] + self.pyramid.pady,
+                     rule.shiftwindow[1] + self.pyramid.padx),
+                    rule.detwindow)
+                for size, level in itertools.izip(self.size, self.pyramid.levels)
+            ]]
+
+        return windows
+
+    def _Restrict(self, windows):
+        for rule, masks in itertools.izip(self.start.rules, windows):
+            rule.score = [Score(
+                scale=level.scale,
+                score=numpy.where(mask, level.score, -numpy.inf).astype(numpy.float32),
+            )
+                for level, mask in itertools.izip(rule.score, masks)]
 
-    def Parse(self, threshold):
+        self.start.score = self.start._Max()
+        for s in self.start.score:
+            s.score.flags.writeable = False
+
+    def _Candidates(self, threshold):
         X = numpy.array([], dtype=numpy.uint32)
         Y = numpy.array([], dtype=numpy.uint32)
         L = numpy.array([], dtype=numpy.uint32)
@@ -109,23 +511,33 @@ class FilteredModel (Model):
         L.flags.writeable = False
         S.flags.writeable = False
 
-        detections = []
-
         assert len(X) == len(Y)
         assert len(X) == len(L)
         assert len(X) == len(S)
-        for x, y, l, s in itertools.izip(X, Y, L, S):
+
+        return itertools.izip(X, Y, L, S)
+
+    def _RootBox(self, rule, x, y, l, ds):
+        detwindow = rule.detwindow
+        shiftwindow = rule.shiftwindow
+        scale = self.pyramid.sbin / self.start.score[l].scale
+
+        x1 = (x - shiftwindow[1] - self.pyramid.padx * (1 << ds)) * scale
+        y1 = (y - shiftwindow[0] - self.pyramid.pady * (1 << ds)) * scale
+        x2 = x1 + detwindow[1] * scale - 1
+        y2 = y1 + detwindow[0] * scale - 1
+
+        return x1, y1, x2, y2
+
+    def Parse(self, threshold):
+        if self.score_only:
+            raise Exception('score-only models cannot be parsed')
+
+        for x, y, l, s in self._Candidates(threshold):
             parsed = self.start.Parse(x=x, y=y, l=l, s=s, ds=0, model=self)
-            detwindow = parsed.rule.detwindow
-            shiftwindow = parsed.rule.shiftwindow
-            scale = self.pyramid.sbin / self.start.score[parsed.l].scale
 
-            x1 = (parsed.x - shiftwindow[
-                  1] - self.pyramid.padx * (1 << parsed.ds)) * scale
-            y1 = (parsed.y - shiftwindow[
-                  0] - self.pyramid.pady * (1 << parsed.ds)) * scale
-            x2 = x1 + detwindow[1] * scale - 1
-            y2 = y1 + detwindow[0] * scale - 1
+            x1, y1, x2, y2 = self._RootBox(
+                parsed.rule, parsed.x, parsed.y, parsed.l, parsed.ds)
 
             root = TreeRoot(
                 model=self,
@@ -140,6 +552,153 @@ class FilteredModel (Model):
 
             yield root
 
+    def Detect(self, threshold):
+        for x, y, l, s in self._Candidates(threshold):
+            for component, rule in enumerate(self.start.rules):
+                if rule.score[l].score[y, x] == s:
+                    break
+            else:
+                raise Exception('Rule argmax not found')
+
+            x1, y1, x2, y2 = self._RootBox(rule, x, y, l, 0)
+
+            yield Detection(
+                x1=x1,
+                y1=y1,
+                x2=x2,
+                y2=y2,
+                s=s,
+                l=l,
+                component=component,
+            )
+
+
+class ModelSet(object):
+
+    """Several models detected over one shared pyramid.
+
+    The models must agree on sbin, interval and extra_octave.  The set can
+    be passed to BuildPyramid in place of a model; its maxsize is the
+    largest of the members' so the padding suits all of them.
+    """
+
+    def __init__(self, models):
+        if len(models) == 0:
+            raise Exception('a model set needs at least one model')
+
+        for model in models[1:]:
+            if model.sbin != models[0].sbin or \
+                    model.interval != models[0].interval or \
+                    model.features.extra_octave != \
+                    models[0].features.extra_octave:
+                raise Exception(
+                    'models must share sbin, interval and extra_octave')
+
+        self.models = models
+        self.sbin = models[0].sbin
+        self.interval = models[0].interval
+        self.features = models[0].features
+        self.maxsize = (
+            max(model.maxsize[0] for model in models),
+            max(model.maxsize[1] for model in models),
+        )
+
+    def Filter(self, pyramid, score_only=False, lazy_argmax=False):
+        return self.FilterBatch(
+            [pyramid], score_only=score_only, lazy_argmax=lazy_argmax)[0]
+
+    def FilterBatch(self, pyramids, score_only=False, lazy_argmax=False):
+        """Filter several pyramids with every member in one native call.
+
+        Returns one FilteredModelSet per pyramid.
+        """
+
+        filters = []
+        owners = []
+        for model in self.models:
+            for filter in model.GetFilters():
+                filters += [filter]
+                owners += [model]
+
+        # pyramids with a region of interest are filtered sparsely instead
+        dense = [pyramid for pyramid in pyramids if pyramid.roi is None]
+        sizes = [
+            [model.GetGeometry(pyramid).size for model in owners]
+            for pyramid in dense
+        ]
+
+        scores = iter(FilterPyramidBank(
+            dense, [filter.GetParameters() for filter in filters], sizes)
+            if dense else [])
+
+        filtered = []
+        for pyramid in pyramids:
+            responses = {model: None for model in self.models}
+            if pyramid.roi is None:
+                for model in self.models:
+                    responses[model] = {}
+                for model, filter, score in itertools.izip(
+                        owners, filters, next(scores)):
+                    responses[model][filter] = score
+
+            filtered += [FilteredModelSet([
+                model.Filter(
+                    pyramid,
+                    score_only=score_only,
+                    lazy_argmax=lazy_argmax,
+                    responses=responses[model],
+                )
+                for model in self.models
+            ])]
+
+        return filtered
+
+
+class FilteredModelSet(object):
+
+    def __init__(self, models):
+        self.models = models
+
+    def Parse(self, threshold, nms_threshold=None):
+        """One detection generator per model, optionally with per-class NMS."""
+
+        detections = [model.Parse(threshold) for model in self.models]
+        if nms_threshold is not None:
+            detections = [NMS(d, nms_threshold) for d in detections]
+
+        return detections
+
+    def ParseAll(self, threshold, nms_threshold=None, across_classes=True):
+        """Detections of all models merged in decreasing score order.
+
+        With across_classes, NMS is applied to the merged stream so that a
+        detection suppresses overlapping detections of any class; otherwise
+        each model is suppressed separately before merging.
+        """
+
+        if across_classes:
+            detections = self.Parse(threshold)
+        else:
+            detections = self.Parse(threshold, nms_threshold)
+
+        merged = _MergeByScore(detections)
+
+        if across_classes and nms_threshold is not None:
+            merged = NMS(merged, nms_threshold)
+
+        return merged
+
+
+def _MergeByScore(generators):
+    counter = itertools.count()
+
+    def _Keyed(generator):
+        for detection in generator:
+            yield -detection.s, next(counter), detection
+
+    for _, _, detection in heapq.merge(*[_Keyed(g) for g in generators]):
+        yield detection
+
 
 class Filter(object):
 
@@ -152,16 +711,28 @@ class Filter(object):
     ])
     _p.flags.writeable = False
 
-    def __init__(self, blocklabel, size, flip, symbol):
+    def __init__(self, blocklabel, size, flip, symbol, w=None):
         self.blocklabel = blocklabel
         self.size = size
         self.flip = flip
         self.symbol = symbol
 
-        if self.flip:
-            self._w = self.blocklabel.w[:, ::-1, Filter._p]
-        else:
-            self._w = self.blocklabel.w
+        # w is the precomputed flipped filter, as saved with the model;
+        # otherwise it is derived from the block when first needed
+        self._weights = w if self.flip else None
+
+    @property
+    def _w(self):
+        if self._weights is None:
+            if not self.flip:
+                self._weights = self.blocklabel.w
+            else:
+                self._weights = self.blocklabel.w[:, ::-1, Filter._p]
+        return self._weights
+
+    @_w.setter
+    def _w(self, w):
+        self._weights = w
 
     def GetFeatures(self, model, node):
         fy = node.y - model.pyramid.pady * ((1 << node.ds) - 1)
@@ -304,7 +875,26 @@ class FilteredDeformationRule(DeformationRule):
         )
 
         self.rhs = [s.Filter(model) for s in deformation_rule.rhs]
+        self.unfiltered = getattr(
+            deformation_rule, 'unfiltered', deformation_rule)
+
+        if _Unchanged(deformation_rule, self.rhs, deformation_rule.rhs):
+            self.score = getattr(
+                deformation_rule, 'score_original', deformation_rule.score)
+            self.Ix = deformation_rule.Ix
+            self.Iy = deformation_rule.Iy
+        else:
+            self.score, self.Ix, self.Iy = self._Deform(model)
+
+        if model.loss_adjustment:
+            self.score_original = self.score
+            self.score = model.loss_adjustment(self.unfiltered, self.score)
+
+        if model.score_only:
+            for symbol in self.rhs:
+                symbol.Release()
 
+    def _Deform(self, model):
         def_w = self.df.GetParameters()
 
         assert len(self.rhs) == 1
@@ -326,32 +916,68 @@ class FilteredDeformationRule(DeformationRule):
         ax, bx, ay, by = def_w.flatten().tolist()
 
         assert len(loc_scores.flatten()) == len(score)
-        deformations = [
-            DeformationCost(bias + s + ss.score, ax, bx, ay, by, 4)
-            for s, ss in itertools.izip(loc_scores.flatten(), score)
-        ]
+        if model.score_only or model.lazy_argmax:
+            deformations = [
+                (DeformationCost(
+                    bias + s + ss.score, ax, bx, ay, by, 4, False), None, None)
+                for s, ss in itertools.izip(loc_scores.flatten(), score)
+            ]
+        else:
+            deformations = [
+                DeformationCost(bias + s + ss.score, ax, bx, ay, by, 4)
+                for s, ss in itertools.izip(loc_scores.flatten(), score)
+            ]
 
         assert len(score) == len(deformations)
-        self.score = [
+        deformed = [
             Score(scale=s.scale, score=d[0])
             for s, d in itertools.izip(score, deformations)
         ]
-        self.Ix = [d[1] for d in deformations]
-        self.Iy = [d[2] for d in deformations]
+        if model.score_only or model.lazy_argmax:
+            return deformed, None, None
 
-        if model.loss_adjustment:
-            self.score_original = self.score
-            self.score = model.loss_adjustment(deformation_rule, self.score)
+        Ix = [d[1] for d in deformations]
+        Iy = [d[2] for d in deformations]
 
-    def Parse(self, x, y, l, s, ds, model):
-        Ix = self.Ix[l]
-        Iy = self.Iy[l]
+        return deformed, Ix, Iy
 
+    def _Argmax(self, x, y, l, model):
+        if self.Ix is not None:
+            return self.Ix[l][y, x], self.Iy[l][y, x]
+
+        s = 4
+
+        bias = self.offset.GetParameters()
+        loc_w = self.loc.GetParameters()
+
+        loc_f = numpy.zeros((3,), dtype=numpy.float32)
+        if l < model.pyramid.interval:
+            loc_f[0] = 1
+        elif l < 2 * model.pyramid.interval:
+            loc_f[1] = 1
+        else:
+            loc_f[2] = 1
+
+        loc_score = loc_w.dot(loc_f).flatten()[0]
+
+        ax, bx, ay, by = self.df.GetParameters().flatten().tolist()
+
+        score = self.rhs[0].score[l].score
+
+        y0 = max(0, y - s)
+        x0 = max(0, x - s)
+        window = bias + loc_score + score[y0:y + s + 1, x0:x + s + 1]
+
+        ix, iy = DeformationArgmax(
+            window, ax, bx, ay, by, s, x - x0, y - y0)
+
+        return ix + x0, iy + y0
+
+    def Parse(self, x, y, l, s, ds, model):
         nvp_y = y - model.pyramid.pady * ((1 << ds) - 1)
         nvp_x = x - model.pyramid.padx * ((1 << ds) - 1)
 
-        rhs_nvp_x = Ix[nvp_y, nvp_x]
-        rhs_nvp_y = Iy[nvp_y, nvp_x]
+        rhs_nvp_x, rhs_nvp_y = self._Argmax(nvp_x, nvp_y, l, model)
 
         rhs_x = rhs_nvp_x + model.pyramid.padx * ((1 << ds) - 1)
         rhs_y = rhs_nvp_y + model.pyramid.pady * ((1 << ds) - 1)
@@ -406,7 +1032,24 @@ class FilteredStructuralRule(StructuralRule):
         )
 
         self.rhs = [s.Filter(model) for s in structural_rule.rhs]
+        self.unfiltered = getattr(
+            structural_rule, 'unfiltered', structural_rule)
+
+        if _Unchanged(structural_rule, self.rhs, structural_rule.rhs):
+            self.score = getattr(
+                structural_rule, 'score_original', structural_rule.score)
+        else:
+            self.score = self._Accumulate(model)
 
+        if model.loss_adjustment:
+            self.score_original = self.score
+            self.score = model.loss_adjustment(self.unfiltered, self.score)
+
+        if model.score_only:
+            for symbol in self.rhs:
+                symbol.Release()
+
+    def _Accumulate(self, model):
         bias = self.offset.GetParameters() * model.features.bias
         loc_w = self.loc.GetParameters()
 
@@ -419,23 +1062,15 @@ class FilteredStructuralRule(StructuralRule):
         loc_scores = loc_w.dot(loc_f).flatten()
 
         assert len(model.size) == len(loc_scores.flatten())
-        self.score = [
-            float(bias + loc_score) * numpy.ones(size, dtype=numpy.float32)
-            for size, loc_score
-            in itertools.izip(model.size, loc_scores.flatten())
+        accumulated = [
+            numpy.empty(size, dtype=numpy.float32) for size in model.size
         ]
+        for s, loc_score in itertools.izip(accumulated, loc_scores.flatten()):
+            s.fill(float(bias + loc_score))
 
         assert len(self.anchor) == len(self.rhs)
         for anchor, symbol in itertools.izip(self.anchor, self.rhs):
-            ax, ay, ds = anchor
-
-            step = 2 ** ds
-
-            virtpadx = (step - 1) * model.pyramid.padx
-            virtpady = (step - 1) * model.pyramid.pady
-
-            startx = ax - virtpadx + 1
-            starty = ay - virtpady + 1
+            ds = anchor[2]
 
             score = [s.score for s in symbol.score]
 
@@ -443,52 +1078,37 @@ class FilteredStructuralRule(StructuralRule):
                 level = i - model.pyramid.interval * ds
 
                 if level >= 0:
-                    endy = min(
-                        score[level].shape[0],
-                        starty + step * (self.score[i].shape[0] - 1)
-                    )
+                    sy, oy, sx, ox = model.geometry.GetAnchor(
+                        tuple(anchor), accumulated[i].shape, score[level].shape)
 
-                    endx = min(
-                        score[level].shape[1],
-                        startx + step * (self.score[i].shape[1] - 1)
-                    )
-
-                    iy = numpy.arange(starty, endy + 1, step)
-                    oy = (iy < 1).sum()
-                    iy = iy[numpy.where(iy >= 1)].flatten()
-
-                    ix = numpy.arange(startx, endx + 1, step)
-                    ox = (ix < 1).sum()
-                    ix = ix[numpy.where(ix >= 1)].flatten()
-
-                    sp = score[level][iy - 1, :][:, ix - 1]
+                    sp = score[level][sy, sx]
                     sz = sp.shape
 
-                    stmp = (-numpy.inf * numpy.ones(self.score[i].shape)).astype(
-                        numpy.float32)
+                    out = accumulated[i]
                     assert oy >= 0
                     assert ox >= 0
-                    assert oy + sz[0] - 1 < stmp.shape[0]
-                    assert ox + sz[1] - 1 < stmp.shape[1]
-                    stmp[oy:oy + sz[0], ox:ox + sz[1]] = sp
+                    assert oy + sz[0] - 1 < out.shape[0]
+                    assert ox + sz[1] - 1 < out.shape[1]
 
-                    self.score[i] += stmp
+                    region = out[oy:oy + sz[0], ox:ox + sz[1]]
+                    numpy.add(region, sp, out=region)
+
+                    out[:oy, :] = -numpy.inf
+                    out[oy + sz[0]:, :] = -numpy.inf
+                    out[:, :ox] = -numpy.inf
+                    out[:, ox + sz[1]:] = -numpy.inf
                 else:
-                    self.score[i][:] = -numpy.inf
+                    accumulated[i][:] = -numpy.inf
 
-        for s in self.score:
+        for s in accumulated:
             s.flags.writeable = False
 
-        assert len(model.pyramid.levels) == len(self.score)
-        self.score = [
+        assert len(model.pyramid.levels) == len(accumulated)
+        return [
             Score(scale=l.scale, score=s)
-            for l, s in itertools.izip(model.pyramid.levels, self.score)
+            for l, s in itertools.izip(model.pyramid.levels, accumulated)
         ]
 
-        if model.loss_adjustment:
-            self.score_original = self.score
-            self.score = model.loss_adjustment(structural_rule, self.score)
-
     def Parse(self, x, y, l, s, ds, model):
         assert len(self.anchor) == len(self.rhs)
         children = []
@@ -559,6 +1179,16 @@ class Symbol(object):
                 blocks += rule.GetBlocks()
             return blocks
 
+    def GetFilters(self):
+        if self.type == 'T':
+            return [self.filter]
+        else:
+            filters = []
+            for rule in self.rules:
+                for symbol in rule.rhs:
+                    filters += symbol.GetFilters()
+            return filters
+
     def GetFilteredSize(self, pyramid):
         if self.type == 'T':
             return [(
@@ -596,29 +1226,52 @@ class FilteredSymbol(Symbol):
         if self.filter is not None:
             if isinstance(symbol, FilteredSymbol):
                 self.score = symbol.score
+            elif self.filter in model.responses:
+                if model.score_only:
+                    self.score = model.responses.pop(self.filter)
+                else:
+                    self.score = model.responses[self.filter]
+            elif model.search is not None:
+                filter = self.filter.GetParameters()
+                self.score = FilterPyramidMasked(
+                    model.pyramid, filter, model.size, model.search[symbol])
             else:
                 filter = self.filter.GetParameters()
                 self.score = FilterPyramid(model.pyramid, filter, model.size)
+                if not model.score_only:
+                    model.responses[self.filter] = self.score
 
             self.rules = []
         else:
             self.rules = [r.Filter(model) for r in symbol.rules]
 
-            self.score = self.rules[0].score
-            for rule in self.rules[1:]:
-                self.score = [Score(
-                    scale=level.scale,
-                    score=numpy.max(
-                        numpy.dstack((level.score, f.score)), axis=2),
-                )
-                    for level, f in itertools.izip(self.score, rule.score)]
+            if _Unchanged(symbol, self.rules, symbol.rules):
+                self.score = symbol.score
+            else:
+                self.score = self._Max()
 
         for s in self.score:
             s.score.flags.writeable = False
 
         assert self.score is not None
 
-    def Parse(self, x, y, l, s, ds, model):
+    def Release(self):
+        self.score = None
+        self.rules = []
+
+    def _Max(self):
+        score = self.rules[0].score
+        for rule in self.rules[1:]:
+            score = [Score(
+                scale=level.scale,
+                score=numpy.max(
+                    numpy.dstack((level.score, f.score)), axis=2),
+            )
+                for level, f in itertools.izip(score, rule.score)]
+
+        return score
+
+    def Parse(self, x, y, l, s, ds, model, rule=None):
         if self.type == 'T':
             scale = model.pyramid.sbin / self.score[l].scale
 
@@ -643,17 +1296,18 @@ class FilteredSymbol(Symbol):
 
             return leaf
         else:
-            selected_rule = None
-            for rule in self.rules:
-                nvp_y = y - model.pyramid.pady * ((1 << ds) - 1)
-                nvp_x = x - model.pyramid.padx * ((1 << ds) - 1)
+            nvp_y = y - model.pyramid.pady * ((1 << ds) - 1)
+            nvp_x = x - model.pyramid.padx * ((1 << ds) - 1)
 
+            # the caller may ask for a rule other than the argmax
+            selected_rule = rule
+            for rule in [selected_rule] if selected_rule is not None else self.rules:
                 score = rule.score[l].score[nvp_y, nvp_x]
 
                 if score == s:
                     selected_rule = rule
                     break
-            if selected_rule is None:
+            else:
                 raise Exception('Rule argmax not found')
             rule = selected_rule
 
@@ -685,14 +1339,35 @@ class FilteredSymbol(Symbol):
 
 class Block(object):
 
-    def __init__(self, w, lb, learn, reg_mult, dim, type):
-        self.w = w
+    """Weights of a part of the model.
+
+    Without w, load is called for it when w is first used.
+    """
+
+    def __init__(self, w, lb, learn, reg_mult, dim, type, load=None):
+        self._w = w
+        self._load = load
         self.lb = lb
         self.learn = learn
         self.reg_mult = reg_mult
         self.dim = dim
         self.type = type
 
+    @property
+    def w(self):
+        if self._w is None and self._load is not None:
+            self._w = self._load()
+            self._load = None
+        return self._w
+
+    @w.setter
+    def w(self, w):
+        self._w = w
+        self._load = None
+
+    def Loaded(self):
+        return self._load is None
+
 
 class Features(object):
 
@@ -716,13 +1391,22 @@ class Stats(object):
 
 class Def(object):
 
-    def __init__(self, blocklabel, flip):
+    def __init__(self, blocklabel, flip, w=None):
         self.blocklabel = blocklabel
         self.flip = flip
-
-        self._w = self.blocklabel.w.copy()
-        if self.flip:
-            self._w[0][1] *= -1
+        self._weights = w
+
+    @property
+    def _w(self):
+        if self._weights is None:
+            self._weights = self.blocklabel.w.copy()
+            if self.flip:
+                self._weights[0][1] *= -1
+        return self._weights
+
+    @_w.setter
+    def _w(self, w):
+        self._weights = w
 
     def GetFeatures(self, model, node):
         child_node, = node.children
@@ -1,12 +1,16 @@
 from pydro._detection import *
 import multiprocessing
+import numpy
 import itertools
 from collections import namedtuple
 
 __all__ = [
     'FilterPyramid',
+    'FilterPyramidBank',
+    'FilterPyramidMasked',
     'FilterImage',
     'DeformationCost',
+    'DeformationArgmax',
     'NMS',
     'Score',
 ]
@@ -31,6 +35,74 @@ def FilterPyramid(pyramid, filter, size):
     return score
 
 
+def _Runs(mask):
+    """(row, x0, x1) of each horizontal run of True in a 2d mask."""
+
+    padded = numpy.zeros((mask.shape[0], mask.shape[1] + 2), dtype=numpy.int8)
+    padded[:, 1:-1] = mask
+    edges = numpy.diff(padded, axis=1)
+
+    rows, starts = numpy.where(edges == 1)
+    _, ends = numpy.where(edges == -1)
+
+    return numpy.column_stack((rows, starts, ends)).astype(numpy.int32)
+
+
+def FilterPyramidMasked(pyramid, filter, size, masks):
+    """FilterPyramid restricted to the True entries of one mask per level.
+
+    Responses outside the masks are -inf and are never computed.
+    """
+
+    filtered = FilterImagesMasked(
+        [level.features for level in pyramid.levels], filter,
+        [_Runs(mask) for mask in masks], size)
+
+    for level in filtered:
+        level.flags.writeable = False
+
+    assert len(pyramid.levels) == len(filtered)
+    score = [
+        Score(scale=level.scale, score=filtered)
+        for level, filtered in itertools.izip(pyramid.levels, filtered)
+    ]
+
+    return score
+
+
+def FilterPyramidBank(pyramids, filters, sizes):
+    """Filter every pyramid with every filter in one native call.
+
+    sizes[i][j] holds the per level response sizes of filters[j] on
+    pyramids[i]; the returned score lists are indexed the same way.
+    """
+    features = [
+        level.features for pyramid in pyramids for level in pyramid.levels]
+    dims = [
+        list(itertools.chain(*[size[j] for size in sizes]))
+        for j in xrange(len(filters))
+    ]
+    filtered = FilterBank(features, filters, dims)
+
+    assert len(filters) == len(filtered)
+    scores = [[] for pyramid in pyramids]
+    for responses in filtered:
+        assert len(features) == len(responses)
+        for level in responses:
+            level.flags.writeable = False
+
+        offset = 0
+        for pyramid, score in itertools.izip(pyramids, scores):
+            levels = responses[offset:offset + len(pyramid.levels)]
+            offset += len(pyramid.levels)
+            score += [[
+                Score(scale=level.scale, score=filtered)
+                for level, filtered in itertools.izip(pyramid.levels, levels)
+            ]]
+
+    return scores
+
+
 def _intersection(detection1, detection2):
     return max(0, min(detection1.x2, detection2.x2) - max(detection1.x1, detection2.x1)) * \
         max(0, min(detection1.y2, detection2.y2)
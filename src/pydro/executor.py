@@ -0,0 +1,292 @@
+"""Non-blocking detection on a bounded pool of threads.
+
+BuildPyramid, Model.Filter and the native kernels under them release the
+GIL, so running them on an Executor keeps the submitting thread free, for
+instance an event loop.  Results come back as Futures whose done callbacks
+can be forwarded to the loop, and parse trees are streamed through a
+bounded ParseStream instead of a generator that must be pulled on the
+calling thread.
+"""
+
+import Queue
+import collections
+import threading
+
+from pydro.detection import NMS
+from pydro.features import BuildPyramid
+
+__all__ = [
+    'CancelledError',
+    'Future',
+    'ParseStream',
+    'Executor',
+]
+
+
+class CancelledError(Exception):
+    pass
+
+
+class Future(object):
+
+    """The eventual result of a task.
+
+    Cancel stops a pending task from running at all; a running task stops
+    at its next checkpoint.  Done callbacks run on the thread that
+    completes the future, or immediately if it is already done.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._state = 'pending'
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+    def Cancel(self):
+        with self._condition:
+            if self._state == 'finished':
+                return False
+            if self._state == 'running':
+                self._state = 'cancelling'
+                return True
+            if self._state != 'pending':
+                return True
+
+        self._Complete('cancelled', None, CancelledError())
+        return True
+
+    def Cancelled(self):
+        return self._state in ('cancelling', 'cancelled')
+
+    def Done(self):
+        return self._state in ('finished', 'cancelled')
+
+    def Result(self, timeout=None):
+        with self._condition:
+            if not self.Done():
+                self._condition.wait(timeout)
+            if not self.Done():
+                raise Exception('timed out waiting for result')
+
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def AddDoneCallback(self, callback):
+        with self._condition:
+            if not self.Done():
+                self._callbacks += [callback]
+                return
+
+        callback(self)
+
+    def _Start(self):
+        with self._condition:
+            if self._state != 'pending':
+                return False
+            self._state = 'running'
+            return True
+
+    def _Checkpoint(self):
+        if self._state == 'cancelling':
+            raise CancelledError()
+
+    def _Finish(self, result):
+        if self._state == 'cancelling':
+            self._Complete('cancelled', None, CancelledError())
+        else:
+            self._Complete('finished', result, None)
+
+    def _Fail(self, error):
+        if isinstance(error, CancelledError):
+            self._Complete('cancelled', None, error)
+        else:
+            self._Complete('finished', None, error)
+
+    def _Complete(self, state, result, error):
+        with self._condition:
+            if self.Done():
+                return
+            self._state = state
+            self._result = result
+            self._error = error
+            callbacks = self._callbacks
+            self._callbacks = []
+            self._condition.notify_all()
+
+        for callback in callbacks:
+            callback(self)
+
+
+class ParseStream(object):
+
+    """Parse trees produced on a worker and consumed as they arrive.
+
+    At most depth trees are buffered; the producer waits when the consumer
+    falls behind.  Next returns a Future of the next tree, which fails with
+    StopIteration at the end, and plain iteration blocks on it.  Close
+    abandons the rest of the parse.
+    """
+
+    def __init__(self, depth):
+        self.depth = depth
+        self._condition = threading.Condition()
+        self._trees = collections.deque()
+        self._waiters = collections.deque()
+        self._closed = False
+        self._end = None
+
+    def Next(self):
+        future = Future()
+
+        with self._condition:
+            if self._trees:
+                tree = self._trees.popleft()
+                self._condition.notify_all()
+            elif self._end is not None:
+                tree = None
+            else:
+                self._waiters.append(future)
+                return future
+
+        if tree is None:
+            future._Fail(self._end)
+        else:
+            future._Finish(tree)
+
+        return future
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.Next().Result()
+
+    def Close(self):
+        with self._condition:
+            self._closed = True
+            self._trees.clear()
+            waiters = list(self._waiters)
+            self._waiters.clear()
+            if self._end is None:
+                self._end = CancelledError()
+            self._condition.notify_all()
+
+        for waiter in waiters:
+            waiter._Fail(CancelledError())
+
+    def _Put(self, tree):
+        with self._condition:
+            while len(self._trees) >= self.depth and not self._closed:
+                self._condition.wait()
+            if self._closed:
+                return False
+
+            if not self._waiters:
+                self._trees.append(tree)
+                return True
+            waiter = self._waiters.popleft()
+
+        waiter._Finish(tree)
+        return True
+
+    def _End(self, error):
+        with self._condition:
+            if self._end is None:
+                self._end = error
+            waiters = list(self._waiters)
+            self._waiters.clear()
+
+        for waiter in waiters:
+            waiter._Fail(self._end)
+
+
+class Executor(object):
+
+    """Runs detection steps on max_workers threads.
+
+    With max_pending, submitting beyond that many waiting tasks raises
+    Queue.Full rather than blocking the caller.
+    """
+
+    def __init__(self, max_workers=2, max_pending=None):
+        self._queue = Queue.Queue(maxsize=max_pending or 0)
+        self._threads = []
+        for i in xrange(max_workers):
+            thread = threading.Thread(target=self._Work)
+            thread.daemon = True
+            thread.start()
+            self._threads += [thread]
+
+    def Submit(self, function, *args, **kwargs):
+        return self._Submit(lambda future: function(*args, **kwargs))
+
+    def BuildPyramid(self, image, *args, **kwargs):
+        return self.Submit(BuildPyramid, image, *args, **kwargs)
+
+    def Filter(self, model, pyramid, *args, **kwargs):
+        return self.Submit(model.Filter, pyramid, *args, **kwargs)
+
+    def Parse(self, filtered_model, threshold, depth=16):
+        stream = ParseStream(depth)
+
+        def task(future):
+            try:
+                for tree in filtered_model.Parse(threshold):
+                    future._Checkpoint()
+                    if not stream._Put(tree):
+                        break
+                stream._End(StopIteration())
+            except Exception as e:
+                stream._End(e)
+                raise
+
+        self._Submit(task)
+
+        return stream
+
+    def Detect(self, model, image, threshold, nms_threshold=None):
+        """Pyramid, score-only filtering and detection as one cancellable task."""
+
+        def task(future):
+            pyramid = BuildPyramid(image, model=model)
+            future._Checkpoint()
+            filtered = model.Filter(pyramid, score_only=True)
+            future._Checkpoint()
+            detections = filtered.Detect(threshold)
+            if nms_threshold is not None:
+                detections = NMS(detections, nms_threshold)
+            return list(detections)
+
+        return self._Submit(task)
+
+    def Shutdown(self, wait=True):
+        for thread in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    def _Submit(self, task):
+        future = Future()
+        self._queue.put((future, task), block=False)
+        return future
+
+    def _Work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            future, task = item
+            if not future._Start():
+                continue
+
+            try:
+                result = task(future)
+            except Exception as e:
+                future._Fail(e)
+            else:
+                future._Finish(result)
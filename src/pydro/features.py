@@ -2,14 +2,283 @@ from pydro._features import *
 
 import numpy
 import math
+import scipy.ndimage
 from collections import namedtuple
-import sys
 
 Level = namedtuple('Level', 'features,scale')
-Pyramid = namedtuple('Pyramid', 'levels,image,pady,padx,sbin,interval')
+Pyramid = namedtuple('Pyramid', 'levels,image,pady,padx,sbin,interval,roi')
+# pyramids built without a region of interest
+Pyramid.__new__.__defaults__ = (None,)
+LevelSpec = namedtuple('LevelSpec', 'y,x,sbin,scale')
 
+_plans = {}
+_max_plans = 16
+
+
+def _PyramidPlan(shape, sbin, interval, extra_octave, min_scale=None):
+    """Level sizes and scales for an image shape, in generation order.
+
+    Consecutive entries that share a size reuse the same resized image.
+    Levels coarser than min_scale are left out.
+    """
+
+    key = (tuple(shape), sbin, interval, bool(extra_octave), min_scale)
+    plan = _plans.get(key)
+    if plan is not None:
+        return plan
+
+    sc = 2 ** (1.0 / interval)
+    max_scale = 1 + \
+        int(math.floor(
+            math.log(min(shape) / (5.0 * sbin)) / math.log(sc)))
+
+    plan = []
+    for i in xrange(interval):
+        scale = 1 / (sc ** i)
+        x = int(round(shape[1] * scale))
+        y = int(round(shape[0] * scale))
+
+        if extra_octave:
+            plan += [LevelSpec(y=y, x=x, sbin=sbin / 4, scale=4 * scale)]
+
+        plan += [LevelSpec(y=y, x=x, sbin=sbin / 2, scale=2 * scale)]
+        plan += [LevelSpec(y=y, x=x, sbin=sbin, scale=scale)]
+
+        for j in xrange(i + interval, max_scale, interval):
+            scale *= 0.5
+            x = int(round(x * 0.5))
+            y = int(round(y * 0.5))
+
+            plan += [LevelSpec(y=y, x=x, sbin=sbin, scale=scale)]
+
+    if min_scale is not None:
+        plan = [spec for spec in plan if spec.scale >= min_scale]
+
+    plan = tuple(plan)
+
+    if len(_plans) >= _max_plans:
+        _plans.clear()
+    _plans[key] = plan
+
+    return plan
+
+
+def RoiMask(roi, shape):
+    """Boolean image mask of a region of interest.
+
+    roi is either a mask shaped like the image or a list of inclusive
+    (x1, y1, x2, y2) rectangles.
+    """
+
+    if isinstance(roi, numpy.ndarray) and roi.ndim == 2:
+        if roi.shape != tuple(shape[0:2]):
+            raise Exception('region of interest mask must be shaped like the image')
+        return roi.astype(bool)
+
+    mask = numpy.zeros(shape[0:2], dtype=bool)
+    for x1, y1, x2, y2 in roi:
+        mask[max(0, int(math.floor(y1))):max(0, int(math.floor(y2)) + 1),
+             max(0, int(math.floor(x1))):max(0, int(math.floor(x2)) + 1)] = True
+
+    return mask
+
+
+def RoiIntegral(roi):
+    """Integral image of a region of interest mask, for RoiWindows."""
+
+    integral = numpy.zeros((roi.shape[0] + 1, roi.shape[1] + 1), dtype=numpy.int32)
+    numpy.cumsum(roi, axis=0, dtype=numpy.int32, out=integral[1:, 1:])
+    numpy.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+
+    return integral
+
+
+def RoiWindows(integral, shape, size, offset, extent):
+    """Which windows of a grid overlap the region of interest.
+
+    Index (y, x) of a grid shaped shape stands for the image window from
+    ((y, x) - offset) * size to ((y, x) - offset + extent) * size.
+    """
+
+    def bounds(n, axis):
+        limit = integral.shape[axis] - 1
+        start = (numpy.arange(n) - offset[axis]) * size
+        lo = numpy.clip(numpy.floor(start), 0, limit).astype(int)
+        hi = numpy.clip(numpy.ceil(start + extent[axis] * size), 0, limit).astype(int)
+        return lo, hi
+
+    y0, y1 = bounds(shape[0], 0)
+    x0, x1 = bounds(shape[1], 1)
+
+    counts = integral[y1][:, x1] - integral[y0][:, x1] - \
+        integral[y1][:, x0] + integral[y0][:, x0]
+
+    return counts > 0
+
+
+def _RoiMargin(model):
+    """Cells around the region of interest a detection in it can reach.
+
+    A root window overlapping the region extends up to maxsize cells out of
+    it, and on the level below, where its parts are placed, twice that plus
+    the part displacement.
+    """
+
+    models = getattr(model, 'models', [model])
+    shift = max(max(numpy.fabs(rule.shiftwindow))
+                for member in models for rule in member.start.rules)
+    return int(2 * (max(model.maxsize) + shift) + 6)
+
+
+def _Crop(length, start, end, sbin):
+    """Pixel range whose features reproduce cells start to end exactly.
+
+    A cell depends on one cell before it and three after it, through the
+    gradients, the interpolation into histograms and the block
+    normalization.  Ranges reaching the last cells run to the image end.
+    """
+
+    first = max(0, start - 1)
+    last = (end + 3) * sbin
+    if last >= length - 2 * sbin:
+        last = length
+
+    return first, first * sbin, last
+
+
+def _Cells(spec):
+    """Size of the unpadded feature map of a level."""
+
+    return (max(int(round(float(spec.y) / spec.sbin)) - 2, 0),
+            max(int(round(float(spec.x) / spec.sbin)) - 2, 0))
+
+
+def _RoiCells(integral, spec, sbin, margin):
+    """Unpadded cells within margin cells of the region of interest."""
+
+    # unpadded cell i covers pixels (i + 1) * sbin onwards
+    return RoiWindows(
+        integral, _Cells(spec), float(sbin) / spec.scale,
+        (margin - 1, margin - 1), (2 * margin + 1, 2 * margin + 1))
+
+
+def _FillFeatures(features, scaled, sbin, padx, pady, needed):
+    """Compute the needed unpadded cells of features in place.
+
+    Features are computed over the bounding boxes of needed.
+    """
+
+    labels, count = scipy.ndimage.label(needed)
+    for sy, sx in scipy.ndimage.find_objects(labels):
+        fy, y0, y1 = _Crop(scaled.shape[0], sy.start, sy.stop, sbin)
+        fx, x0, x1 = _Crop(scaled.shape[1], sx.start, sx.stop, sbin)
+
+        crop = ComputeFeatures(
+            numpy.ascontiguousarray(scaled[y0:y1, x0:x1]), sbin, 0, 0)
+        features[pady + sy.start:pady + sy.stop,
+                 padx + sx.start:padx + sx.stop] = \
+            crop[sy.start - fy:sy.stop - fy, sx.start - fx:sx.stop - fx]
+
+
+def _RoiFeatures(scaled, sbin, padx, pady, needed):
+    """ComputeFeatures, but only over the needed cells.
+
+    Cells outside needed are left empty.
+    """
+
+    out = (needed.shape[0] + 2 * pady, needed.shape[1] + 2 * padx)
+
+    # (y, l, x) memory layout like the native features
+    features = numpy.zeros((out[0], 32, out[1]), dtype=numpy.float32)
+    features = features.transpose(0, 2, 1)
+    features[:pady, :, 31] = 1
+    features[out[0] - pady:, :, 31] = 1
+    features[:, :padx, 31] = 1
+    features[:, out[1] - padx:, 31] = 1
+
+    _FillFeatures(features, scaled, sbin, padx, pady, needed)
+
+    return features
+
+
+def _ResizeWindow(image, spec, y0, y1, x0, x1):
+    """Rows y0 to y1 and columns x0 to x1 of image resized for a level.
+
+    Only the pixels of image the window reads are converted to floats.
+    """
+
+    # the source pixels the window reads, with a pixel to spare
+    height, width = image.shape[0:2]
+    ry0 = max(0, int(math.floor(y0 * float(height) / spec.y)) - 2)
+    ry1 = min(height, int(math.ceil(y1 * float(height) / spec.y)) + 3)
+    rx0 = max(0, int(math.floor(x0 * float(width) / spec.x)) - 2)
+    rx1 = min(width, int(math.ceil(x1 * float(width) / spec.x)) + 3)
+    source = image[ry0:ry1, rx0:rx1]
+    if len(source.shape) == 2:
+        source = numpy.dstack((source, source, source))
+    source = numpy.ascontiguousarray(source, dtype=numpy.float32)
+
+    return ResizeImage(source, spec.y, spec.x, y0, y1, x0, x1,
+                       ry0, rx0, height, width)
+
+
+def _WindowFeatures(image, spec, pady, padx, ywindow, xwindow,
+                    max_pixels=None):
+    """Padded features of a level of image's pyramid, cropped to windows.
+
+    The windows are (start, end) ranges of padded cells.  The features are
+    the same as cropping the whole level, but only the pixels they need
+    are converted and resized, so image can be of any type.  With
+    max_pixels, they are resized in blocks that read about that many
+    pixels of image each.
+    """
+
+    out = (ywindow[1] - ywindow[0], xwindow[1] - xwindow[0])
+
+    # (y, l, x) memory layout like the native features
+    features = numpy.zeros((out[0], 32, out[1]), dtype=numpy.float32)
+    features = features.transpose(0, 2, 1)
+    features[:, :, 31] = 1
+
+    cells = _Cells(spec)
+    sy = slice(max(ywindow[0] - pady, 0), min(ywindow[1] - pady, cells[0]))
+    sx = slice(max(xwindow[0] - padx, 0), min(xwindow[1] - padx, cells[1]))
+    if sy.start >= sy.stop or sx.start >= sx.stop:
+        return features
+
+    fy, y0, y1 = _Crop(spec.y, sy.start, sy.stop, spec.sbin)
+    fx, x0, x1 = _Crop(spec.x, sx.start, sx.stop, spec.sbin)
+
+    ystep, xstep = y1 - y0, x1 - x0
+    if max_pixels is not None:
+        side = math.sqrt(max_pixels)
+        ystep = max(1, int(side * spec.y / image.shape[0]))
+        xstep = max(1, int(side * spec.x / image.shape[1]))
+
+    scaled = numpy.empty((y1 - y0, x1 - x0, 3), dtype=numpy.float32)
+    for by in xrange(y0, y1, ystep):
+        for bx in xrange(x0, x1, xstep):
+            ey, ex = min(by + ystep, y1), min(bx + xstep, x1)
+            scaled[by - y0:ey - y0, bx - x0:ex - x0] = \
+                _ResizeWindow(image, spec, by, ey, bx, ex)
+
+    crop = ComputeFeatures(scaled, spec.sbin, 0, 0)
+    features[sy.start + pady - ywindow[0]:sy.stop + pady - ywindow[0],
+             sx.start + padx - xwindow[0]:sx.stop + padx - xwindow[0]] = \
+        crop[sy.start - fy:sy.stop - fy, sx.start - fx:sx.stop - fx]
+
+    return features
+
+
+def BuildPyramid(image, model=None, sbin=None, interval=None, extra_octave=None, padx=None, pady=None, min_scale=None, roi=None):
+    """Feature pyramid of image.
+
+    With a region of interest (see RoiMask), which needs the model, only
+    the cells that detections overlapping it can use are computed; the
+    rest are empty.  The region is kept in the pyramid and Model.Filter
+    restricts its scores to it.
+    """
 
-def BuildPyramid(image, model=None, sbin=None, interval=None, extra_octave=None, padx=None, pady=None):
     if sbin is None:
         sbin = model.sbin
     if interval is None:
@@ -26,47 +295,36 @@ def BuildPyramid(image, model=None, sbin=None, interval=None, extra_octave=None,
     image = image.astype(numpy.float32)
     image.flags.writeable = False
 
-    sc = 2 ** (1.0 / interval)
-    max_scale = 1 + \
-        int(math.floor(
-            math.log(min(image.shape[0:2]) / (5.0 * sbin)) / math.log(sc)))
+    if roi is not None:
+        if model is None:
+            raise Exception('a region of interest needs the model')
+        roi = RoiMask(roi, image.shape)
+        roi.flags.writeable = False
+        integral = RoiIntegral(roi)
+        margin = _RoiMargin(model)
+
+    plan = _PyramidPlan(
+        image.shape[0:2], sbin, interval, extra_octave, min_scale)
 
     def level_generator():
-        for i in xrange(interval):
-            scale = 1 / (sc ** i)
-            x = int(round(image.shape[1] * scale))
-            y = int(round(image.shape[0] * scale))
-            sys.stdout.flush()
-            scaled = ResizeImage(image, y, x)
-
-            if extra_octave:
-                yield Level(
-                    features=ComputeFeatures(
-                        scaled, sbin / 4, padx + 1, pady + 1),
-                    scale=4 * scale,
-                )
+        scaled = None
+        for spec in plan:
+            if scaled is None or scaled.shape[0:2] != (spec.y, spec.x):
+                scaled = ResizeImage(image, spec.y, spec.x)
 
-            yield Level(
-                features=ComputeFeatures(scaled, sbin / 2, padx + 1, pady + 1),
-                scale=2 * scale,
-            )
+            if roi is None:
+                features = ComputeFeatures(
+                    scaled, spec.sbin, padx + 1, pady + 1)
+            else:
+                features = _RoiFeatures(
+                    scaled, spec.sbin, padx + 1, pady + 1,
+                    _RoiCells(integral, spec, sbin, margin))
 
             yield Level(
-                features=ComputeFeatures(scaled, sbin, padx + 1, pady + 1),
-                scale=scale,
+                features=features,
+                scale=spec.scale,
             )
 
-            for j in xrange(i + interval, max_scale, interval):
-                scale *= 0.5
-                x = int(round(x * 0.5))
-                y = int(round(y * 0.5))
-                scaled = ResizeImage(image, y, x)
-
-                yield Level(
-                    features=ComputeFeatures(scaled, sbin, padx + 1, pady + 1),
-                    scale=scale,
-                )
-
     levels = list(level_generator())
     levels.sort(key=lambda k: -k.scale)
 
@@ -77,6 +335,78 @@ def BuildPyramid(image, model=None, sbin=None, interval=None, extra_octave=None,
         sbin=sbin,
         interval=interval,
         image=image,
+        roi=roi,
     )
 
     return pyramid
+
+
+def UpdatePyramid(previous, image, model=None, tolerance=0):
+    """Pyramid of the next frame of a static camera.
+
+    image must be shaped like the image of previous.  Only the cells near
+    pixels that moved by more than tolerance are computed again, with
+    their normalization neighbourhood; the rest are shared with previous.
+    A region of interest carries over, which needs the model.
+    """
+
+    if len(image.shape) == 2:
+        image = numpy.dstack((image, image, image))
+    image = image.astype(numpy.float32)
+    image.flags.writeable = False
+
+    if image.shape != previous.image.shape:
+        raise Exception('frames must have the same shape')
+
+    changed = (numpy.fabs(image - previous.image) > tolerance).any(axis=2)
+    integral = RoiIntegral(changed)
+
+    if previous.roi is not None:
+        if model is None:
+            raise Exception('a region of interest needs the model')
+        roi_integral = RoiIntegral(previous.roi)
+        margin = _RoiMargin(model)
+
+    sbin = previous.sbin
+    plan = _PyramidPlan(
+        image.shape[0:2], sbin, previous.interval,
+        previous.levels[0].scale > 2,
+        min(level.scale for level in previous.levels))
+    reused = dict((level.scale, level) for level in previous.levels)
+    if len(plan) != len(reused) or \
+            any(spec.scale not in reused for spec in plan):
+        raise Exception('previous pyramid does not match the frame')
+
+    def level_generator():
+        scaled = None
+        for spec in plan:
+            level = reused[spec.scale]
+
+            # a cell reads pixels from one cell before it to three after
+            # it, plus a cell of slack for the resizing
+            needed = RoiWindows(
+                integral, _Cells(spec), float(sbin) / spec.scale,
+                (2, 2), (7, 7))
+            if previous.roi is not None:
+                needed &= _RoiCells(roi_integral, spec, sbin, margin)
+
+            if not needed.any():
+                yield level
+                continue
+
+            if scaled is None or scaled.shape[0:2] != (spec.y, spec.x):
+                scaled = ResizeImage(image, spec.y, spec.x)
+
+            features = level.features.copy(order='K')
+            _FillFeatures(features, scaled, spec.sbin,
+                          previous.padx + 1, previous.pady + 1, needed)
+
+            yield Level(
+                features=features,
+                scale=spec.scale,
+            )
+
+    levels = list(level_generator())
+    levels.sort(key=lambda k: -k.scale)
+
+    return previous._replace(levels=levels, image=image)
@@ -1,13 +1,54 @@
+import collections
+import contextlib
 import copy
+import hashlib
 import itertools
-import Queue
+import logging
+import mmap
 import msgpack
+import multiprocessing
+import multiprocessing.pool
 import numpy
+import os
+import struct
+import tempfile
+import threading
+import time
 import zlib
 
 from pydro.core import *
-
-__all__ = ['LoadModel', 'SaveModel']
+from pydro.detection import Score
+from pydro.features import Level, Pyramid
+
+__all__ = [
+    'LoadModel',
+    'SaveModel',
+    'ConvertModel',
+    'ModelRegistry',
+    'GetModel',
+    'SavePyramid',
+    'LoadPyramid',
+    'SaveResponses',
+    'LoadResponses',
+]
+
+# mapped files: magic, version and structure length, the msgpack structure,
+# then the weights, each aligned so that they can be viewed in place
+_magic = 'PYDROMAP'
+_version = 1
+_preamble = struct.Struct('<8sII')
+_alignment = 64
+
+# chunked files: magic, version and table length, a msgpack table of the
+# compressed chunks, then the structure and every weight array as its own
+# zlib chunk, so that they can be decompressed in parallel
+_chunked_magic = 'PYDROCHK'
+
+_pyramid_magic = 'PYDROPYR'
+_responses_magic = 'PYDRORSP'
+
+# bumped whenever the derived weights are computed differently
+_artifacts_version = 1
 
 
 def _type_handler(obj):
@@ -73,15 +114,14 @@ def _type_unpacker(obj):
         return obj
 
 
-def _denormalize_model(model):
+def _denormalize_model(model, artifacts=False):
     symbols = {}
-    symbol_queue = Queue.Queue()
-    symbol_queue.put(model.start)
+    symbol_queue = collections.deque([model.start])
 
     old_symbols = []
 
-    while not symbol_queue.empty():
-        symbol = symbol_queue.get()
+    while symbol_queue:
+        symbol = symbol_queue.popleft()
 
         if symbol in symbols:
             raise Exception('cycle in symbols detected')
@@ -94,8 +134,7 @@ def _denormalize_model(model):
             if rule.lhs() not in symbols:
                 raise Exception('lhs should have already been touched')
 
-            for rhs_symbol in rule.rhs:
-                symbol_queue.put(rhs_symbol)
+            symbol_queue.extend(rule.rhs)
 
     filters = {}
     filters[None] = None
@@ -229,16 +268,96 @@ def _denormalize_model(model):
 
         new_model['rules'] += [new_rules]
 
+    if artifacts:
+        new_model['artifacts'] = _Artifacts(new_model, old_symbols, filters, blocks)
+
     return new_model
 
 
+def _Checksum(model, blocklabels):
+    checksum = 0
+    for blocklabel in blocklabels:
+        w = model['blocks'][blocklabel - 1]['w']
+        checksum = zlib.crc32(numpy.ascontiguousarray(w), checksum)
+
+    return checksum & 0xffffffff
+
+
+def _Artifacts(new_model, old_symbols, filters, blocks):
+    """Weights derived from the blocks, so that loading can skip them.
+
+    The checksum covers the blocks they were derived from.
+    """
+
+    flipped = []
+    for filter, index in sorted(filters.items(), key=lambda item: item[1]):
+        if filter is not None and filter.flip:
+            flipped += [[index, filter.GetParameters()]]
+
+    deformations = []
+    seen = set()
+    for symbol in old_symbols:
+        for rule in symbol.rules:
+            if isinstance(rule, DeformationRule):
+                key = (blocks[rule.df.blocklabel], rule.df.flip)
+                if key not in seen:
+                    seen.add(key)
+                    deformations += [[key[0], key[1], rule.df.GetParameters()]]
+
+    blocklabels = [new_model['filters'][index - 1]['blocklabel']
+                   for index, w in flipped] + \
+        [blocklabel for blocklabel, flip, w in deformations]
+
+    return {
+        'version': _artifacts_version,
+        'checksum': _Checksum(new_model, blocklabels),
+        'filters': flipped,
+        'defs': deformations,
+    }
+
+
+def _LoadArtifacts(model):
+    """Flipped filters by index and deformations by (blocklabel, flip).
+
+    Artifacts of another version or whose blocks changed are ignored.
+    """
+
+    artifacts = model.get('artifacts')
+    if artifacts is None:
+        return {}, {}
+    if artifacts['version'] != _artifacts_version:
+        logging.info('ignoring model artifacts of version %s', artifacts['version'])
+        return {}, {}
+
+    blocklabels = [model['filters'][index - 1]['blocklabel']
+                   for index, w in artifacts['filters']] + \
+        [blocklabel for blocklabel, flip, w in artifacts['defs']]
+    if _Checksum(model, blocklabels) != artifacts['checksum']:
+        logging.warning('ignoring model artifacts that do not match the weights')
+        return {}, {}
+
+    flipped = dict((index, w) for index, w in artifacts['filters'])
+    deformations = dict(((blocklabel, flip), w)
+                        for blocklabel, flip, w in artifacts['defs'])
+
+    return flipped, deformations
+
+
+def _NewBlock(block):
+    if callable(block['w']):
+        return Block(**dict(block, w=None, load=block['w']))
+    return Block(**block)
+
+
 def _normalize_model(model):
-    new_blocks = {i + 1: Block(**block)
+    new_blocks = {i + 1: _NewBlock(block)
                   for i, block in enumerate(model['blocks'])}
 
     new_rules = {}
     new_symbols = {}
 
+    flipped, deformations = _LoadArtifacts(model)
+
     new_filters = {
         None: None,
     }
@@ -251,6 +370,7 @@ def _normalize_model(model):
             size=filter['size'],
             flip=filter['flip'],
             symbol=None,
+            w=flipped.get(pos + 1),
         )
 
         new_filters[pos + 1] = new_filter
@@ -261,21 +381,23 @@ def _normalize_model(model):
     symbol_rule_list = list(
         enumerate(itertools.izip(model['symbols'], model['rules'])))
 
-    untaken = set(range(1,1+len(symbol_rule_list)))
-    symbol_queue = Queue.Queue()
-
+    # symbols are built after everything on their right hand sides: count
+    # each symbol's distinct children and release its parents as they finish
+    pending = {}
+    parents = collections.defaultdict(list)
     for pos, (symbol, rules) in symbol_rule_list:
-        okay = True
-        for rule in rules:
-            if len(rule['rhs']) != 0:
-                okay = False
-                break
-        if okay:
-            symbol_queue.put ((pos, (symbol, rules)))
-            untaken.remove (pos+1)
-
-    while not symbol_queue.empty():
-        pos, (symbol, rules) = symbol_queue.get()
+        children = set(a for rule in rules for a in rule['rhs'])
+        pending[pos + 1] = len(children)
+        for child in children:
+            parents[child].append(pos)
+
+    symbol_queue = collections.deque(
+        (pos, (symbol, rules)) for pos, (symbol, rules) in symbol_rule_list
+        if pending[pos + 1] == 0)
+
+    built = 0
+    while symbol_queue:
+        pos, (symbol, rules) = symbol_queue.popleft()
         new_rules = []
         for rule in rules:
             rhs_idx = rule['rhs']
@@ -307,6 +429,7 @@ def _normalize_model(model):
                 new_df = Def(
                     blocklabel=block,
                     flip=rule['df']['flip'],
+                    w=deformations.get((df_idx, rule['df']['flip'])),
                 )
 
                 new_rule = DeformationRule(
@@ -350,20 +473,15 @@ def _normalize_model(model):
         )
 
         new_symbols[pos + 1] = new_symbol
+        built += 1
 
-        for pos, (symbol, rules) in symbol_rule_list:
-            if pos+1 not in untaken:
-                continue
-            okay = True
-            for rule in rules:
-                if len(set(rule['rhs']).intersection(untaken)) != 0:
-                    okay = False
-                    break
-            if okay:
-                symbol_queue.put ((pos, (symbol, rules)))
-                untaken.remove (pos+1)
+        for parent in parents[pos + 1]:
+            pending[parent + 1] -= 1
+            if pending[parent + 1] == 0:
+                symbol_queue.append(symbol_rule_list[parent])
 
-    assert len(untaken) == 0
+    if built != len(symbol_rule_list):
+        raise Exception('cycle in symbols detected')
 
     for pos, (symbol, rules) in symbol_rule_list:
         new_symbol = new_symbols[pos + 1]
@@ -403,18 +521,524 @@ def _normalize_model(model):
     return new_model
 
 
-def SaveModel(filename, model):
-    model = _denormalize_model(model)
+def _Align(offset):
+    return (offset + _alignment - 1) // _alignment * _alignment
+
+
+@contextlib.contextmanager
+def _Replacing(filename):
+    """A new file that replaces filename once it is fully written.
+
+    Processes that still map the old file keep its pages, rather than
+    seeing it truncated under them.
+    """
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temporary = tempfile.mkstemp(
+        dir=directory, prefix='.' + os.path.basename(filename) + '.')
+    try:
+        if os.path.exists(filename):
+            mode = os.stat(filename).st_mode & 0o7777
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.fchmod(fd, mode)
+
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temporary, filename)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def _SaveContainer(filename, magic, structure, compress=0):
+    """Write structure with its arrays as aligned chunks after it.
+
+    Arrays are stored in their memory order, so that loading can view
+    them in place, or zlib compressed at level compress.
+    """
+
+    chunks = []
+
+    def handler(obj):
+        if isinstance(obj, numpy.ndarray):
+            axes = sorted(xrange(obj.ndim), key=lambda i: -obj.strides[i])
+            data = numpy.ascontiguousarray(obj.transpose(axes)).tostring()
+            if compress:
+                data = zlib.compress(data, compress)
+
+            packed = {
+                '__ndarray__': True,
+                'shape': obj.shape,
+                'type': obj.dtype.str,
+                'axes': axes,
+                'offset': sum(_Align(len(chunk)) for chunk in chunks),
+                'size': len(data),
+                'compressed': bool(compress),
+            }
+            chunks.append(data)
+            return packed
+        return _type_handler(obj)
+
+    header = msgpack.packb(structure, default=handler)
+    start = _Align(_preamble.size + len(header))
+
+    with _Replacing(filename) as f:
+        f.write(_preamble.pack(magic, _version, len(header)))
+        f.write(header)
+        f.write('\0' * (start - _preamble.size - len(header)))
+        for chunk in chunks:
+            f.write(chunk)
+            f.write('\0' * (_Align(len(chunk)) - len(chunk)))
+
+
+def _LoadContainer(f, magic, hook=None):
+    found, version, length = _preamble.unpack(f.read(_preamble.size))
+    if found != magic:
+        raise Exception('not a %s file' % magic)
+    if version != _version:
+        raise Exception('unsupported file version (%d)' % version)
+    header = f.read(length)
+
+    # uncompressed arrays are read-only views of the mapping, which they
+    # keep open
+    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    start = _Align(_preamble.size + length)
+
+    def unpacker(obj):
+        if '__ndarray__' in obj and 'offset' in obj:
+            dtype = numpy.dtype(obj['type'])
+            axes = obj.get('axes', range(len(obj['shape'])))
+            stored = [obj['shape'][axis] for axis in axes]
+            count = int(numpy.prod(stored))
+            position = start + obj['offset']
+
+            if count == 0:
+                array = numpy.zeros(stored, dtype=dtype)
+            elif obj.get('compressed'):
+                data = zlib.decompress(mapped[position:position + obj['size']])
+                array = numpy.frombuffer(data, dtype=dtype).reshape(stored)
+            else:
+                array = numpy.frombuffer(
+                    mapped, dtype=dtype, count=count,
+                    offset=position).reshape(stored)
+
+            array = array.transpose(numpy.argsort(axes))
+            array.flags.writeable = False
+            return array
+        return obj if hook is None else hook(obj)
+
+    return msgpack.unpackb(header, object_hook=unpacker)
+
+
+def _SaveMapped(filename, model):
+    _SaveContainer(filename, _magic, model)
+
+
+def _LoadMapped(f):
+    return _LoadContainer(f, _magic, _type_unpacker)
+
+
+def _SaveChunked(filename, model, compress=6):
+    chunks = []
+
+    def handler(obj):
+        if isinstance(obj, numpy.ndarray):
+            chunks.append(zlib.compress(
+                numpy.ascontiguousarray(obj).tostring(), compress))
+            return {
+                '__ndarray__': True,
+                'shape': obj.shape,
+                'type': obj.dtype.str,
+                'chunk': len(chunks),
+            }
+        return _type_handler(obj)
+
+    # the structure is chunk 0
+    structure = msgpack.packb(model, default=handler)
+    chunks.insert(0, zlib.compress(structure, compress))
+
+    table = []
+    offset = 0
+    for chunk in chunks:
+        table += [(offset, len(chunk))]
+        offset += _Align(len(chunk))
+    header = msgpack.packb(table)
+    start = _Align(_preamble.size + len(header))
+
+    with _Replacing(filename) as f:
+        f.write(_preamble.pack(_chunked_magic, _version, len(header)))
+        f.write(header)
+        f.write('\0' * (start - _preamble.size - len(header)))
+        for chunk in chunks:
+            f.write(chunk)
+            f.write('\0' * (_Align(len(chunk)) - len(chunk)))
+
+
+class _Deferred(object):
+
+    """An array of a chunked file, decompressed when called."""
+
+    def __init__(self, load, obj):
+        self.load = load
+        self.obj = obj
+
+    def __call__(self):
+        return self.load(self.obj)
+
+
+def _LoadChunked(f, threads=None, lazy=False):
+    found, version, length = _preamble.unpack(f.read(_preamble.size))
+    if found != _chunked_magic:
+        raise Exception('not a %s file' % _chunked_magic)
+    if version != _version:
+        raise Exception('unsupported file version (%d)' % version)
+    table = msgpack.unpackb(f.read(length))
+
+    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    start = _Align(_preamble.size + length)
+
+    def decompress(chunk):
+        offset, size = table[chunk]
+        return zlib.decompress(mapped[start + offset:start + offset + size])
+
+    # the weights are decompressed by the pool while this thread unpacks
+    # the structure; zlib releases the GIL
+    if threads is None:
+        threads = multiprocessing.cpu_count()
+    threads = min(threads, len(table) - 1)
+    pool = None
+    if threads > 1 and not lazy:
+        pool = multiprocessing.pool.ThreadPool(threads)
+        pending = pool.map_async(decompress, xrange(1, len(table)), chunksize=1)
+
+    try:
+        structure = decompress(0)
+        if pool is not None:
+            weights = [None] + pending.get()
+        else:
+            weights = None
+
+        def array(obj):
+            if weights is not None:
+                data = weights[obj['chunk']]
+            else:
+                data = decompress(obj['chunk'])
+            # owned like the arrays of packed files, so they can be trained
+            array = numpy.fromstring(
+                data, dtype=numpy.dtype(obj['type'])).reshape(obj['shape'])
+            array.flags.writeable = False
+            return array
+
+        def unpacker(obj):
+            if '__ndarray__' in obj and 'chunk' in obj:
+                return _Deferred(array, obj) if lazy else array(obj)
+
+            # only block weights stay deferred
+            if lazy:
+                block = 'w' in obj and 'reg_mult' in obj
+                for key, value in obj.items():
+                    if isinstance(value, _Deferred) and not (block and key == 'w'):
+                        obj[key] = value()
+            return _type_unpacker(obj)
+
+        model = msgpack.unpackb(structure, object_hook=unpacker)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        # deferred weights read the mapping later
+        if not lazy:
+            mapped.close()
+
+    if lazy:
+        # checking them would read every block
+        model.pop('artifacts', None)
+
+    return model
+
+
+def SaveModel(filename, model, mapped=False, artifacts=False, chunked=False):
+    """Write model to filename.
+
+    mapped files are larger but LoadModel maps their weights instead of
+    reading them, so processes loading the same file share its pages.
+    chunked files compress the structure and every weight array apart,
+    so LoadModel can decompress them in parallel.  With artifacts the
+    flipped filter and deformation weights are saved too, and used by
+    LoadModel as long as they match the weights.
+
+    The file is written next to filename and renamed over it, so
+    processes still using the old file, even mapped, are not disturbed.
+    """
+
+    if mapped and chunked:
+        raise Exception('a model file is either mapped or chunked')
+
+    model = _denormalize_model(model, artifacts)
+    if mapped:
+        return _SaveMapped(filename, model)
+    if chunked:
+        return _SaveChunked(filename, model)
+
     packed = msgpack.packb(model, default=_type_handler)
     compressed = zlib.compress(packed)
-    with open(filename, 'wb') as f:
+    with _Replacing(filename) as f:
         f.write(compressed)
 
 
-def LoadModel(filename):
+def _LoadFile(f, threads=None, lazy=False):
+    magic = f.read(len(_magic))
+    f.seek(0)
+    if magic == _magic:
+        model = _LoadMapped(f)
+    elif magic == _chunked_magic:
+        model = _LoadChunked(f, threads, lazy)
+    else:
+        packed = zlib.decompress(f.read())
+        model = msgpack.unpackb(packed, object_hook=_type_unpacker)
+    return _normalize_model(model)
+
+
+def LoadModel(filename, threads=None, lazy=False):
+    """Model in filename, in any of the formats SaveModel writes.
+
+    The chunks of chunked files are decompressed on threads threads, by
+    default one per core.  With lazy, the block weights of chunked files
+    are only read when first used, and flipped filters and deformations
+    are derived then too, so the grammar and filter sizes can be
+    inspected cheaply; mapped files are always read on demand.
+    """
+
     with open(filename, 'rb') as f:
-        compressed = f.read()
-    packed = zlib.decompress(compressed)
-    model = msgpack.unpackb(packed, object_hook=_type_unpacker)
-    model = _normalize_model(model)
-    return model
+        return _LoadFile(f, threads, lazy)
+
+
+def ConvertModel(source, destination, mapped=True, chunked=False):
+    """Rewrite a model file of any format in the mapped, chunked or packed one."""
+
+    SaveModel(destination, LoadModel(source), mapped=mapped and not chunked,
+              chunked=chunked)
+
+
+class _Entry(object):
+
+    def __init__(self, model, stat, digest):
+        self.model = model
+        self.stat = stat
+        self.digest = digest
+        self.lock = threading.Lock()
+
+
+def _Stat(stat):
+    return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+
+class ModelRegistry(object):
+
+    """Loaded models shared by every thread, keyed by path.
+
+    Get checks the file on each call and loads it again once its mtime or
+    size changed and its content hash differs; until the new model is
+    fully built, callers keep getting the old one.  A file that fails to
+    load is logged and the old model stays in use.
+
+    Models of mapped files keep reading the file they were loaded from, so
+    files must be replaced, never rewritten in place, while they are in
+    use; SaveModel does so.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._stats = {
+            'hits': 0,
+            'loads': 0,
+            'reloads': 0,
+            'errors': 0,
+            'load_seconds': 0.0,
+        }
+
+    def Get(self, filename):
+        filename = os.path.abspath(filename)
+        stat = _Stat(os.stat(filename))
+
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is None:
+                entry = self._entries[filename] = _Entry(None, None, None)
+            elif entry.model is not None and entry.stat == stat:
+                self._stats['hits'] += 1
+                return entry.model
+
+        # one thread loads a path while the others wait for its result
+        with entry.lock:
+            if entry.model is not None and \
+                    entry.stat == _Stat(os.stat(filename)):
+                with self._lock:
+                    self._stats['hits'] += 1
+                return entry.model
+
+            return self._Load(filename, entry)
+
+    def Reload(self, filename):
+        """Load filename again even if it looks unchanged."""
+
+        filename = os.path.abspath(filename)
+        with self._lock:
+            entry = self._entries.setdefault(filename, _Entry(None, None, None))
+        with entry.lock:
+            entry.digest = None
+            return self._Load(filename, entry)
+
+    def Evict(self, filename):
+        with self._lock:
+            self._entries.pop(os.path.abspath(filename), None)
+
+    def Stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['models'] = sum(
+                1 for entry in self._entries.itervalues()
+                if entry.model is not None)
+
+        return stats
+
+    def _Load(self, filename, entry):
+        started = time.time()
+        try:
+            with open(filename, 'rb') as f:
+                stat = _Stat(os.fstat(f.fileno()))
+                digest = hashlib.sha1()
+                for chunk in iter(lambda: f.read(1 << 20), ''):
+                    digest.update(chunk)
+                digest = digest.hexdigest()
+
+                if digest == entry.digest:
+                    # touched but not changed
+                    entry.stat = stat
+                    with self._lock:
+                        self._stats['hits'] += 1
+                    return entry.model
+
+                f.seek(0)
+                model = _LoadFile(f)
+        except Exception:
+            with self._lock:
+                self._stats['errors'] += 1
+            if entry.model is None:
+                raise
+            logging.exception('reloading %s failed', filename)
+            return entry.model
+
+        with self._lock:
+            self._stats['reloads' if entry.model is not None else 'loads'] += 1
+            self._stats['load_seconds'] += time.time() - started
+            entry.model, entry.stat, entry.digest = model, stat, digest
+
+        return model
+
+
+_registry = ModelRegistry()
+
+
+def GetModel(filename):
+    """LoadModel through a registry shared by the whole process."""
+
+    return _registry.Get(filename)
+
+
+def SavePyramid(filename, pyramid, compress=0):
+    """Write pyramid to filename.
+
+    compress is a zlib level; with 0, LoadPyramid maps the features
+    instead of reading them.
+    """
+
+    structure = {
+        'levels': [
+            {'scale': level.scale, 'features': level.features}
+            for level in pyramid.levels
+        ],
+        'image': pyramid.image,
+        'pady': pyramid.pady,
+        'padx': pyramid.padx,
+        'sbin': pyramid.sbin,
+        'interval': pyramid.interval,
+        'roi': pyramid.roi,
+    }
+
+    _SaveContainer(filename, _pyramid_magic, structure, compress)
+
+
+def LoadPyramid(filename):
+    with open(filename, 'rb') as f:
+        structure = _LoadContainer(f, _pyramid_magic)
+
+    return Pyramid(
+        levels=[
+            Level(features=level['features'], scale=level['scale'])
+            for level in structure['levels']
+        ],
+        image=structure['image'],
+        pady=structure['pady'],
+        padx=structure['padx'],
+        sbin=structure['sbin'],
+        interval=structure['interval'],
+        roi=structure.get('roi'),
+    )
+
+
+def SaveResponses(filename, filtered, compress=0):
+    """Write the filter responses of a FilteredModel to filename.
+
+    The model must not have been filtered score_only.  Passing the loaded
+    responses to Model.Filter along with the pyramid skips the filters.
+    """
+
+    filters = filtered.GetFilters()
+    if not any(filter in filtered.responses for filter in filters):
+        raise Exception('the filtered model kept no responses')
+
+    structure = {
+        'filters': [
+            {
+                'shape': filter.GetParameters().shape,
+                'levels': [
+                    {'scale': level.scale, 'score': level.score}
+                    for level in filtered.responses[filter]
+                ] if filter in filtered.responses else None,
+            }
+            for filter in filters
+        ],
+    }
+
+    _SaveContainer(filename, _responses_magic, structure, compress)
+
+
+def LoadResponses(filename, model):
+    """Responses saved by SaveResponses, for model.Filter(responses=...)."""
+
+    with open(filename, 'rb') as f:
+        structure = _LoadContainer(f, _responses_magic)
+
+    filters = model.GetFilters()
+    if len(filters) != len(structure['filters']):
+        raise Exception('responses were saved for another model')
+
+    responses = {}
+    for filter, saved in itertools.izip(filters, structure['filters']):
+        if tuple(saved['shape']) != filter.GetParameters().shape:
+            raise Exception('responses were saved for another model')
+        if saved['levels'] is not None:
+            responses[filter] = [
+                Score(scale=level['scale'], score=level['score'])
+                for level in saved['levels']
+            ]
+
+    return responses
@@ -0,0 +1,383 @@
+"""Long running detection service.
+
+Models are loaded once and shared by a pool of worker threads.  Each worker
+drains up to batch_size waiting requests and filters all of their pyramids
+with every model in a single native call, which runs with the GIL released
+so that the other workers keep building pyramids and parsing meanwhile.
+Requests arrive over HTTP or over a local unix socket speaking HTTP and
+detections are returned as JSON.
+"""
+
+import BaseHTTPServer
+import Queue
+import SocketServer
+import StringIO
+import httplib
+import itertools
+import json
+import logging
+import os
+import socket
+import stat
+import threading
+import time
+import urlparse
+
+import numpy
+import scipy.misc
+
+from pydro.core import ModelSet
+from pydro.detection import NMS
+from pydro.features import BuildPyramid
+
+__all__ = [
+    'DetectionService',
+    'MakeServer',
+    'Request',
+    'Benchmark',
+]
+
+
+class _Request(object):
+
+    def __init__(self, image, threshold):
+        self.image = image
+        self.threshold = threshold
+        self.submitted = time.time()
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def Wait(self, timeout=None):
+        if not self.done.wait(timeout):
+            raise Exception('request timed out')
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class DetectionService(object):
+
+    """Detects with a fixed set of models on images submitted from any thread.
+
+    At most queue_depth requests wait at a time; Submit raises Queue.Full
+    beyond that so that callers can shed load instead of queueing forever.
+    A worker waits up to batch_wait seconds for a batch to fill.
+    """
+
+    def __init__(self, models, names=None, threshold=-0.5, nms_threshold=0.5,
+                 workers=2, queue_depth=32, batch_size=4, batch_wait=0.005):
+        if names is None:
+            names = [model.clss for model in models]
+        if len(names) != len(models):
+            raise Exception('there must be one name per model')
+
+        self.model_set = ModelSet(models)
+        self.names = names
+        self.threshold = threshold
+        self.nms_threshold = nms_threshold
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+
+        self._queue = Queue.Queue(maxsize=queue_depth)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._stats = {
+            'requests': 0,
+            'errors': 0,
+            'rejected': 0,
+            'batches': 0,
+            'latency': 0.0,
+        }
+
+    def Start(self):
+        if self._threads:
+            raise Exception('service already started')
+
+        for i in xrange(self.workers):
+            thread = threading.Thread(target=self._Work)
+            thread.daemon = True
+            thread.start()
+            self._threads += [thread]
+
+    def Stop(self):
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def Submit(self, image, threshold=None):
+        if threshold is None:
+            threshold = self.threshold
+
+        request = _Request(image, threshold)
+        try:
+            self._queue.put(request, block=False)
+        except Queue.Full:
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise
+
+        return request
+
+    def Detect(self, image, threshold=None, timeout=None):
+        return self.Submit(image, threshold).Wait(timeout)
+
+    def Stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+
+        stats['queued'] = self._queue.qsize()
+        stats['mean_batch'] = stats['requests'] / float(max(1, stats['batches']))
+        stats['mean_latency'] = stats['latency'] / max(1, stats['requests'])
+
+        return stats
+
+    def _Work(self):
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+
+            batch = [request]
+            stop = False
+            deadline = time.time() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    request = self._queue.get(
+                        timeout=max(0, deadline - time.time()))
+                except Queue.Empty:
+                    break
+
+                if request is None:
+                    stop = True
+                    break
+
+                batch += [request]
+
+            self._Process(batch)
+
+            if stop:
+                return
+
+    def _Process(self, batch):
+        pending = []
+        pyramids = []
+        for request in batch:
+            try:
+                pyramids += [BuildPyramid(request.image, model=self.model_set)]
+                pending += [request]
+            except Exception as e:
+                request.error = e
+
+        try:
+            if pending:
+                filtered = self.model_set.FilterBatch(pyramids, score_only=True)
+                for request, filtered_set in itertools.izip(pending, filtered):
+                    request.result = self._Detections(
+                        filtered_set, request.threshold)
+        except Exception as e:
+            logging.exception('detection failed')
+            for request in pending:
+                if request.result is None:
+                    request.error = e
+
+        finished = time.time()
+        with self._lock:
+            self._stats['batches'] += 1
+            for request in batch:
+                self._stats['requests'] += 1
+                self._stats['latency'] += finished - request.submitted
+                if request.error is not None:
+                    self._stats['errors'] += 1
+
+        for request in batch:
+            request.done.set()
+
+    def _Detections(self, filtered_set, threshold):
+        detections = []
+        for name, filtered in itertools.izip(self.names, filtered_set.models):
+            for detection in NMS(filtered.Detect(threshold), self.nms_threshold):
+                detections += [{
+                    'model': name,
+                    'x1': float(detection.x1),
+                    'y1': float(detection.y1),
+                    'x2': float(detection.x2),
+                    'y2': float(detection.y2),
+                    'score': float(detection.s),
+                    'component': detection.component,
+                }]
+
+        detections.sort(key=lambda d: -d['score'])
+
+        return detections
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != '/detect':
+            return self._Reply(404, {'error': 'unknown path'})
+
+        query = urlparse.parse_qs(url.query)
+        try:
+            threshold = float(query['threshold'][0]) \
+                if 'threshold' in query else None
+            length = int(self.headers.getheader('Content-Length', 0))
+            image = scipy.misc.imread(
+                StringIO.StringIO(self.rfile.read(length)), mode='RGB')
+        except Exception as e:
+            return self._Reply(400, {'error': str(e)})
+
+        try:
+            request = self.server.service.Submit(image, threshold)
+        except Queue.Full:
+            return self._Reply(503, {'error': 'queue full'})
+
+        try:
+            detections = request.Wait(self.server.request_timeout)
+        except Exception as e:
+            return self._Reply(500, {'error': str(e)})
+
+        self._Reply(200, {'detections': detections})
+
+    def do_GET(self):
+        if urlparse.urlparse(self.path).path != '/stats':
+            return self._Reply(404, {'error': 'unknown path'})
+
+        self._Reply(200, self.server.service.Stats())
+
+    def _Reply(self, code, content):
+        body = json.dumps(content)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix socket peers have no (host, port) address
+        if isinstance(self.client_address, tuple):
+            return BaseHTTPServer.BaseHTTPRequestHandler.address_string(self)
+        return 'unix'
+
+    def log_message(self, format, *args):
+        logging.debug('%s %s', self.address_string(), format % args)
+
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def MakeServer(service, address, request_timeout=60):
+    """A server for service on a (host, port) tuple or a unix socket path.
+
+    The caller drives it with serve_forever.  A stale socket file left by a
+    previous server is removed.
+    """
+
+    if isinstance(address, tuple):
+        server = _HTTPServer(address, _Handler)
+    else:
+        if os.path.exists(address) and \
+                stat.S_ISSOCK(os.stat(address).st_mode):
+            os.unlink(address)
+        server = _UnixServer(address, _Handler)
+
+    server.service = service
+    server.request_timeout = request_timeout
+
+    return server
+
+
+class _UnixConnection(httplib.HTTPConnection):
+
+    def __init__(self, path, timeout):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def _Connect(address, timeout):
+    if isinstance(address, tuple):
+        return httplib.HTTPConnection(address[0], address[1], timeout=timeout)
+    return _UnixConnection(address, timeout)
+
+
+def Request(address, data, threshold=None, timeout=60):
+    """Post encoded image data to a server and return its detections."""
+
+    path = '/detect'
+    if threshold is not None:
+        path += '?threshold=%f' % threshold
+
+    connection = _Connect(address, timeout)
+    try:
+        connection.request('POST', path, data)
+        response = connection.getresponse()
+        content = json.loads(response.read())
+    finally:
+        connection.close()
+
+    if response.status != 200:
+        raise Exception('server replied %d: %s' % (
+            response.status, content.get('error')))
+
+    return content['detections']
+
+
+def Benchmark(address, data, requests=100, concurrency=4, threshold=None):
+    """Replay one image against a server from several client threads.
+
+    Returns throughput and latency percentiles in seconds.
+    """
+
+    counter = itertools.count()
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def client():
+        while next(counter) < requests:
+            started = time.time()
+            try:
+                Request(address, data, threshold)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            with lock:
+                latencies.append(time.time() - started)
+
+    started = time.time()
+    threads = [threading.Thread(target=client) for i in xrange(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    result = {
+        'requests': requests,
+        'errors': len(errors),
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed,
+    }
+    if latencies:
+        result['latency_mean'] = float(numpy.mean(latencies))
+        for percentile in (50, 90, 99):
+            result['latency_p%d' % percentile] = float(
+                numpy.percentile(latencies, percentile))
+
+    return result
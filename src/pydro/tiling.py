@@ -0,0 +1,246 @@
+"""Detection on images too large to hold a single pyramid for.
+
+The image is cut into tiles, and every tile gets a pyramid with the same
+levels as the pyramid of the whole image, each cropped to the cells around
+the tile.  The margin around a tile covers the root and part filters, the
+part displacements and the block normalization of every detection whose
+root window starts in the tile.  The crops are computed from windows of
+the resized image, so their features are exactly those of the whole
+levels, and each octave is cropped at twice the cell offset of the next
+coarser one, so that parts are placed as in the whole pyramid.  Every
+detection is kept by the one tile its root window starts in, which makes
+the tiled detections those of the whole pyramid.
+"""
+
+import collections
+import math
+
+import numpy
+
+from pydro.detection import NMS
+from pydro.features import BuildPyramid, Level, Pyramid, _Cells, \
+    _PyramidPlan, _WindowFeatures
+
+__all__ = [
+    'DetectTiled',
+]
+
+# feature channels plus roughly as many live score maps per cell
+_bytes_per_cell = 4 * (32 + 32)
+
+# three float channels per resized pixel
+_bytes_per_pixel = 3 * 4
+
+
+def _PyramidBytes(shape, model, min_scale):
+    """Peak bytes of the pyramid of the whole image, with its float copy."""
+
+    pady, padx = model.maxsize
+
+    total = 0
+    for spec in _PyramidPlan(shape, model.sbin, model.interval,
+                             model.features.extra_octave, min_scale):
+        y = max(int(round(float(spec.y) / spec.sbin)) - 2, 0) + 2 * (pady + 1)
+        x = max(int(round(float(spec.x) / spec.sbin)) - 2, 0) + 2 * (padx + 1)
+        total += y * x * _bytes_per_cell
+
+    return total + shape[0] * shape[1] * 3 * 4
+
+
+def _Margins(model):
+    """Cells before and after a tile along each axis that its detections read.
+
+    A root starting in the tile reads up to its shift before it.  Its
+    parts, on the level below, are anchored up to twice the root size
+    after it and move up to four cells either way.
+    """
+
+    margins = []
+    for axis in (0, 1):
+        shift = int(max(numpy.fabs(rule.shiftwindow[axis])
+                        for rule in model.start.rules))
+        margins += [(shift + 6, 2 * (model.maxsize[axis] + shift) + 6)]
+
+    return margins
+
+
+def _Chains(plan, interval):
+    """Level indices of every octave chain, finest first."""
+
+    chains = collections.defaultdict(list)
+    for index, spec in enumerate(plan):
+        chains[int(round(math.log(spec.scale, 2) * interval)) % interval] += [index]
+
+    return [sorted(chain, key=lambda i: -plan[i].scale)
+            for chain in chains.itervalues()]
+
+
+def _Windows(plan, chains, axis, start, end, pad, margins, sbin):
+    """Padded cell range of every level for the tile from start to end.
+
+    start and end are pixels along axis, None at the image edges.
+    """
+
+    before, after = margins[axis]
+
+    windows = []
+    for spec in plan:
+        cells = _Cells(spec)[axis] + 2 * pad
+        ratio = spec.scale / sbin
+
+        # pixel p is in unpadded cell floor(p * ratio) - 1
+        lo = 0 if start is None else \
+            max(0, int(math.floor(start * ratio)) + pad - 1 - before)
+        hi = cells if end is None else \
+            min(cells, int(math.ceil(end * ratio)) + pad + after)
+        windows += [[lo, hi]]
+
+    # parts are read at twice the cell of their parent
+    for chain in chains:
+        octaves = len(chain) - 1
+        base = min(windows[i][0] // 2 ** (octaves - j)
+                   for j, i in enumerate(chain))
+        for j, i in enumerate(chain):
+            windows[i][0] = base * 2 ** (octaves - j)
+
+    return windows
+
+
+def _TileBytes(model, plan, chains, size, margins):
+    """Peak bytes of the pyramid of a size by size tile, an estimate.
+
+    Besides the features, one level's window is held resized, and a block
+    of the image it reads as floats.
+    """
+
+    pads = (model.maxsize[0] + 1, model.maxsize[1] + 1)
+
+    slack = {}
+    for chain in chains:
+        for j, i in enumerate(chain):
+            slack[i] = 2 ** (len(chain) - 1 - j)
+
+    total = 0
+    largest = 0
+    for index, spec in enumerate(plan):
+        cells = 1
+        for axis in (0, 1):
+            cells *= min(
+                _Cells(spec)[axis] + 2 * pads[axis],
+                int(math.ceil(size * spec.scale / model.sbin)) +
+                sum(margins[axis]) + 2 + slack[index])
+        total += cells * _bytes_per_cell
+        largest = max(largest, cells * spec.sbin ** 2 * _bytes_per_pixel)
+
+    # windows are resized in blocks reading about a tile of image pixels
+    largest += (size + 5) ** 2 * _bytes_per_pixel
+
+    return total + largest
+
+
+def _Plan(model, shape, max_bytes):
+    """Largest tile size whose pyramid fits max_bytes."""
+
+    plan = _PyramidPlan(shape, model.sbin, model.interval,
+                        model.features.extra_octave)
+    chains = _Chains(plan, model.interval)
+    margins = _Margins(model)
+
+    size = max(shape)
+    while size >= model.sbin:
+        if _TileBytes(model, plan, chains, size, margins) <= max_bytes:
+            return size
+
+        size = int(size * 0.9)
+
+    raise Exception('memory budget is too small for this model')
+
+
+def _Spans(length, size):
+    """Tiles along an axis as (start, end), None at the image edges."""
+
+    count = max(1, int(math.ceil(float(length) / size)))
+    bounds = [int(round(i * float(length) / count)) for i in xrange(count + 1)]
+
+    return [(None if i == 0 else bounds[i],
+             None if i == count - 1 else bounds[i + 1])
+            for i in xrange(count)]
+
+
+def _Inside(value, span):
+    start, end = span
+    return (start is None or value >= start) and (end is None or value < end)
+
+
+def DetectTiled(model, image, threshold, nms_threshold=0.5,
+                max_bytes=256 << 20):
+    """Detections over the whole image in decreasing score order.
+
+    Peak memory of a tile's pyramid and score maps, along with the part of
+    the image it reads, is kept below max_bytes (an estimate); image itself
+    is not copied.  Images that fit the budget are processed in one piece.
+    The detections are those of the pyramid of the whole image.
+    """
+
+    # tiles convert only the pixels they read, so image is not copied
+    height, width = image.shape[0:2]
+    if _PyramidBytes((height, width), model, None) <= max_bytes:
+        pyramid = BuildPyramid(image, model=model)
+        detections = model.Filter(pyramid, score_only=True).Detect(threshold)
+        if nms_threshold is not None:
+            detections = NMS(detections, nms_threshold)
+        return detections
+
+    size = _Plan(model, (height, width), max_bytes)
+    plan = _PyramidPlan((height, width), model.sbin, model.interval,
+                        model.features.extra_octave)
+    chains = _Chains(plan, model.interval)
+    margins = _Margins(model)
+    pady, padx = model.maxsize
+
+    kept = []
+    for yspan in _Spans(height, size):
+        ywindows = _Windows(plan, chains, 0, yspan[0], yspan[1],
+                            pady + 1, margins, model.sbin)
+        for xspan in _Spans(width, size):
+            xwindows = _Windows(plan, chains, 1, xspan[0], xspan[1],
+                                padx + 1, margins, model.sbin)
+
+            levels = sorted(
+                ((Level(features=_WindowFeatures(
+                    image, spec, pady + 1, padx + 1, ywindow, xwindow,
+                    size * size),
+                    scale=spec.scale), ywindow[0], xwindow[0])
+                 for spec, ywindow, xwindow in zip(plan, ywindows, xwindows)),
+                key=lambda level: -level[0].scale)
+
+            pyramid = Pyramid(
+                levels=[level for level, oy, ox in levels],
+                image=image,
+                pady=pady,
+                padx=padx,
+                sbin=model.sbin,
+                interval=model.interval,
+                roi=None,
+            )
+            filtered = model.Filter(pyramid, score_only=True)
+
+            for d in filtered.Detect(threshold):
+                level, oy, ox = levels[d.l]
+                scale = model.sbin / level.scale
+                d = d._replace(
+                    x1=d.x1 + ox * scale,
+                    x2=d.x2 + ox * scale,
+                    y1=d.y1 + oy * scale,
+                    y2=d.y2 + oy * scale,
+                )
+
+                # every detection belongs to the tile its root starts in
+                if _Inside(d.x1, xspan) and _Inside(d.y1, yspan):
+                    kept += [d]
+
+    kept.sort(key=lambda d: -d.s)
+    if nms_threshold is not None:
+        return NMS(kept, nms_threshold)
+
+    return iter(kept)
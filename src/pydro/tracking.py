@@ -0,0 +1,93 @@
+"""Detection in video restricted to the neighbourhood of earlier detections.
+
+Objects rarely move far between frames, so instead of scoring the whole
+pyramid the model is only evaluated within a few cells and levels of the
+previous frame's detections (see the masks argument of Model.Filter).
+Every full_every frames the whole pyramid is searched again to pick up
+new objects.
+"""
+
+import numpy
+
+from pydro.detection import NMS
+from pydro.features import BuildPyramid
+
+__all__ = [
+    'SearchMasks',
+    'Tracker',
+]
+
+
+def SearchMasks(model, pyramid, roots, radius=3, levels=2):
+    """Start symbol masks around the boxes of roots (TreeRoots or Detections).
+
+    Each box is searched within radius cells of its position on the levels
+    up to levels away from the scale it was found at.
+    """
+
+    size = model.GetGeometry(pyramid).size
+    masks = [numpy.zeros(s, dtype=bool) for s in size]
+    scales = numpy.array([level.scale for level in pyramid.levels])
+
+    for root in roots:
+        if hasattr(root, 'child'):
+            rule = root.child.rule
+        else:
+            rule = model.start.rules[root.component]
+
+        # the level whose boxes are closest in size
+        heights = rule.detwindow[0] * pyramid.sbin / scales
+        found = numpy.argmin(numpy.fabs(numpy.log(
+            heights / (root.y2 - root.y1 + 1))))
+
+        for l in xrange(max(0, found - levels),
+                        min(len(masks), found + levels + 1)):
+            # invert FilteredModel._RootBox
+            cells = scales[l] / pyramid.sbin
+            x = int(round(root.x1 * cells)) + rule.shiftwindow[1] + pyramid.padx
+            y = int(round(root.y1 * cells)) + rule.shiftwindow[0] + pyramid.pady
+
+            masks[l][max(0, y - radius):max(0, y + radius + 1),
+                     max(0, x - radius):max(0, x + radius + 1)] = True
+
+    return masks
+
+
+class Tracker(object):
+
+    """Detects on consecutive frames, searching near the last detections.
+
+    Frames are searched fully every full_every frames, and whenever the
+    previous frame had no detections.
+    """
+
+    def __init__(self, model, threshold, nms_threshold=0.5, full_every=10,
+                 radius=3, levels=2):
+        self.model = model
+        self.threshold = threshold
+        self.nms_threshold = nms_threshold
+        self.full_every = full_every
+        self.radius = radius
+        self.levels = levels
+        self.previous = []
+        self._frame = 0
+
+    def Track(self, image):
+        """NMS'd parse trees of the next frame."""
+
+        pyramid = BuildPyramid(image, model=self.model)
+
+        masks = None
+        if self._frame % self.full_every != 0 and self.previous:
+            masks = SearchMasks(
+                self.model, pyramid, self.previous, self.radius, self.levels)
+
+        filtered = self.model.Filter(pyramid, lazy_argmax=True, masks=masks)
+        trees = filtered.Parse(self.threshold)
+        if self.nms_threshold is not None:
+            trees = NMS(trees, self.nms_threshold)
+
+        self.previous = list(trees)
+        self._frame += 1
+
+        return self.previous
@@ -1,13 +1,14 @@
 """Routines for training DPM."""
 
-from pydro.core import Score
-from pydro._train import compute_overlap
+from pydro.core import Score, _Defs, _Unique
+from pydro._train import compute_overlap, objective_function
 
 import numpy
 import itertools
 from collections import namedtuple
 import scipy.misc
 import scipy.optimize
+import scipy.sparse
 
 __all__ = [
     'build_feature_vector',
@@ -23,6 +24,8 @@ __all__ = [
 __BBox__ = namedtuple('__BBox__', 'x1,y1,x2,y2')
 __TrainingExample__ = namedtuple(
     '__TrainingExample__', 'features,belief,loss,score')
+__PackedExamples__ = namedtuple(
+    '__PackedExamples__', 'features,loss,starts,belief,regularization')
 
 
 def build_feature_vector(detection, belief, positive):
@@ -131,88 +134,149 @@ def overlap_loss_adjustment(model, pyramid, threshold, value, rules, bbox):
     return _overlap_loss_adjustment
 
 
-def optimize(model, examples, svm_c):
-    """Reoptimizes model given training examples."""
+def _block_sections(blocks):
+    """Where each block's weights are in the solution vector.
+
+    A block listed more than once gets the section of its last listing;
+    the sections of the others are left unused."""
 
-    blocks = model.GetBlocks()
     num_parms = 0
     block_sections = {}
-
     for block in blocks:
-        block.w.flags.writeable = True
         end = num_parms + block.w.size
         block_sections[block] = (num_parms, end)
         num_parms = end
 
-    initial_solution = numpy.zeros((num_parms,))
+    return block_sections, num_parms
+
+
+def _pack_examples(examples, blocks, block_sections, num_parms):
+    """Packs the entries of all examples into the rows of a sparse matrix.
+
+       Each row is laid out like the solution vector, so the scores of all
+       entries are one product with it.  The entries of example i are the
+       rows from starts[i] on, and belief[i] is the row of its belief."""
+
+    data = []
+    indices = []
+    indptr = [0]
+    loss = []
+    starts = []
+    belief = []
+
+    for example in examples:
+        starts += [len(loss)]
+        belief_row = None
+
+        for entry in example:
+            nonzeros = indptr[-1]
+            for block, feature in entry.features.iteritems():
+                start, end = block_sections[block]
+                data += [numpy.asarray(feature, dtype=numpy.float64).flatten()]
+                indices += [numpy.arange(start, end)]
+                nonzeros += end - start
+            indptr += [nonzeros]
+
+            if entry.belief:
+                belief_row = len(loss)
+            loss += [entry.loss]
+
+        assert len(loss) > starts[-1]
+        assert belief_row is not None
+        belief += [belief_row]
+
+    features = scipy.sparse.csr_matrix(
+        (numpy.concatenate(data) if data else numpy.zeros((0,)),
+         numpy.concatenate(indices).astype(numpy.int32) if indices
+         else numpy.zeros((0,), dtype=numpy.int32),
+         numpy.array(indptr, dtype=numpy.int32)),
+        shape=(len(loss), num_parms))
+
+    regularization = numpy.zeros((num_parms,))
     for block in blocks:
         start, end = block_sections[block]
-        initial_solution[start:end] = block.w.flatten()
+        regularization[start:end] += block.reg_mult
 
-    def _objective_function(solution):
-        """Objective function for training."""
+    return __PackedExamples__(
+        features=features,
+        loss=numpy.array(loss, dtype=numpy.float64),
+        starts=numpy.array(starts, dtype=numpy.int32),
+        belief=numpy.array(belief, dtype=numpy.int32),
+        regularization=regularization,
+    )
+
+
+def _objective(packed, solution, svm_c):
+    """Objective value and gradient at solution for packed examples."""
+
+    scores = packed.features.dot(solution)
+    adjusted = scores + packed.loss
+
+    # the first highest scoring entry of every example
+    maxima = numpy.maximum.reduceat(adjusted, packed.starts)
+    lengths = numpy.diff(numpy.append(packed.starts, len(adjusted)))
+    candidates = numpy.flatnonzero(adjusted == numpy.repeat(maxima, lengths))
+    _, first = numpy.unique(
+        numpy.searchsorted(packed.starts, candidates, side='right'),
+        return_index=True)
+    chosen = candidates[first]
 
-        gradient_packed = {block: numpy.zeros((block.w.size,))
-                           for block in blocks}
-        for block in blocks:
-            start, end = block_sections[block]
-            block.w[:] = solution[start:end].reshape(block.w.shape)
+    objective_value = svm_c * (maxima - scores[packed.belief]).sum()
+    objective_value += 0.5 * (packed.regularization * solution).dot(solution)
 
-        objective_value = 0
-        for example in examples:
-            loss_adjusted_score = -numpy.inf
-            max_nonbelief_score = -numpy.inf
-            max_entry = None
-            belief_entry = None
+    weights = numpy.bincount(chosen, minlength=len(adjusted)) - \
+        numpy.bincount(packed.belief, minlength=len(adjusted))
+    gradient = svm_c * packed.features.T.dot(weights.astype(numpy.float64))
+    gradient += packed.regularization * solution
 
-            for entry in example:
-                score = score_vector(entry)
+    return objective_value, gradient
 
-                loss_adjusted = score + entry.loss
 
-                if entry.belief:
-                    belief_score = score
-                    belief_entry = entry
-                elif loss_adjusted > max_nonbelief_score:
-                    max_nonbelief_score = loss_adjusted
+def _native_objective(packed, solution, svm_c):
+    """Like _objective, but in parallel in _train.c without the GIL."""
 
-                if loss_adjusted > loss_adjusted_score:
-                    max_entry = entry
-                    loss_adjusted_score = loss_adjusted
+    solution = numpy.ascontiguousarray(solution, dtype=numpy.float64)
+    gradient = numpy.empty_like(solution)
+    objective_value = objective_function(
+        packed.features.data, packed.features.indices, packed.features.indptr,
+        packed.loss, packed.starts, packed.belief, packed.regularization,
+        solution, svm_c, gradient)
 
-            assert max_entry is not None
-            assert belief_entry is not None
+    return objective_value, gradient
 
-            objective_value += svm_c * (loss_adjusted_score - belief_score)
 
-            if max_entry != belief_entry:
-                for block in max_entry.features:
-                    gradient_packed[block] += svm_c * \
-                        max_entry.features[block].flatten()
+def optimize(model, examples, svm_c):
+    """Reoptimizes model given training examples."""
 
-                for block in belief_entry.features:
-                    gradient_packed[block] -= svm_c * \
-                        belief_entry.features[block].flatten()
+    # a block shared by several rules is one set of weights, regularized once
+    blocks = _Unique(model.GetBlocks())
+    block_sections, num_parms = _block_sections(blocks)
 
-        for block in blocks:
-            objective_value += 0.5 * block.reg_mult * \
-                block.w.flatten().T.dot(block.w.flatten())
-            gradient_packed[block] += block.reg_mult * block.w.flatten()
+    initial_solution = numpy.zeros((num_parms,))
+    for block in blocks:
+        start, end = block_sections[block]
+        initial_solution[start:end] = block.w.flatten()
 
-        #f = ObjectiveFunction (examples)
+    packed = _pack_examples(examples, blocks, block_sections, num_parms)
 
-        gradient = numpy.zeros(solution.shape)
-        #Gradient (examples, gradient_packed)
-        for block in blocks:
-            start, end = block_sections[block]
-            gradient[start:end] = gradient_packed[block]
+    def _objective_function(solution):
+        """Objective function for training."""
 
-        return objective_value, gradient
+        return _native_objective(packed, solution, svm_c)
 
     solution, _, _ = scipy.optimize.fmin_l_bfgs_b(
         _objective_function, initial_solution)
 
+    # the weights may be read-only views of a mapped file, so new arrays
+    # replace them, and the flipped filters and deformations derived from
+    # the old ones are derived again when next used
     for block in blocks:
         start, end = block_sections[block]
-        block.w[:] = solution[start:end].reshape(block.w.shape)
-        block.w.flags.writeable = False
+        w = solution[start:end].reshape(block.w.shape).astype(block.w.dtype)
+        w.flags.writeable = False
+        block.w = w
+
+    for filter in model.GetFilters():
+        filter._w = None
+    for df in _Defs(model):
+        df._w = None
@@ -0,0 +1,238 @@
+"""Pipelined detection over a stream of frames.
+
+Decoding, BuildPyramid, Model.Filter and Parse with NMS run as separate
+stages connected by bounded queues, so consecutive frames are in
+different stages at the same time.  A stage can have several workers;
+the native kernels release the GIL, so workers of different stages use
+different cores.  When a queue is full its producers wait, which bounds
+the number of frames in flight.  Results are reordered and yielded in
+frame order and are the same as running the stages one after another.
+"""
+
+import Queue
+import itertools
+import threading
+import time
+
+from pydro.detection import NMS
+from pydro.features import BuildPyramid
+
+__all__ = [
+    'VideoPipeline',
+]
+
+_poll = 0.1
+
+
+class _Stage(object):
+
+    def __init__(self, name, function, workers):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.frames = 0
+        self.busy = 0.0
+        self.waiting = 0.0
+        self._lock = threading.Lock()
+
+    def Record(self, busy, waiting):
+        with self._lock:
+            self.frames += 1
+            self.busy += busy
+            self.waiting += waiting
+
+
+class VideoPipeline(object):
+
+    """Detects with model on every frame of an iterable of images.
+
+    workers maps a stage name ('pyramid', 'filter' or 'parse') to its
+    number of threads; decoding, i.e. pulling from the frame iterable,
+    always has one.  queue_depth bounds each queue between stages.
+    """
+
+    stages = ('decode', 'pyramid', 'filter', 'parse')
+
+    def __init__(self, model, threshold, nms_threshold=0.5, workers=None,
+                 queue_depth=4):
+        counts = {'pyramid': 2, 'filter': 1, 'parse': 1}
+        counts.update(workers or {})
+        for name in counts:
+            if name not in self.stages[1:]:
+                raise Exception('unknown stage (%s)' % name)
+
+        self.model = model
+        self.threshold = threshold
+        self.nms_threshold = nms_threshold
+        self.queue_depth = queue_depth
+        self._counts = counts
+        self._stages = None
+        self._started = None
+        self._finished = None
+
+    def Run(self, frames):
+        """Generator of the NMS'd parse trees of each frame, in frame order."""
+
+        self._stages = [
+            _Stage('decode', None, 1),
+            _Stage('pyramid', self._Pyramid, self._counts['pyramid']),
+            _Stage('filter', self._Filter, self._counts['filter']),
+            _Stage('parse', self._Parse, self._counts['parse']),
+        ]
+        queues = [Queue.Queue(maxsize=self.queue_depth) for stage in self._stages]
+        stop = threading.Event()
+        errors = []
+
+        def put(queue, item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=_poll)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def get(queue):
+            while not stop.is_set():
+                try:
+                    return queue.get(timeout=_poll)
+                except Queue.Empty:
+                    pass
+            return None
+
+        def fail(e):
+            errors.append(e)
+            stop.set()
+
+        def decode():
+            stage = self._stages[0]
+            frames_iter = iter(frames)
+            try:
+                for index in itertools.count():
+                    started = time.time()
+                    try:
+                        frame = next(frames_iter)
+                    except StopIteration:
+                        break
+                    decoded = time.time()
+
+                    if not put(queues[0], (index, frame)):
+                        return
+                    stage.Record(decoded - started, time.time() - decoded)
+            except Exception as e:
+                fail(e)
+                return
+
+            for i in xrange(self._stages[1].workers):
+                put(queues[0], None)
+
+        remaining = [stage.workers for stage in self._stages]
+        lock = threading.Lock()
+
+        def work(position):
+            stage = self._stages[position]
+            source = queues[position - 1]
+            sink = queues[position]
+
+            while True:
+                waited = time.time()
+                item = get(source)
+                if item is None:
+                    break
+
+                started = time.time()
+                index, value = item
+                try:
+                    result = stage.function(value)
+                except Exception as e:
+                    fail(e)
+                    return
+                finished = time.time()
+
+                if not put(sink, (index, result)):
+                    return
+                stage.Record(
+                    finished - started,
+                    (started - waited) + (time.time() - finished))
+
+            # the last worker of a stage to finish passes the end on
+            with lock:
+                remaining[position] -= 1
+                last = remaining[position] == 0
+            if last:
+                downstream = self._stages[position + 1].workers \
+                    if position + 1 < len(self._stages) else 1
+                for i in xrange(downstream):
+                    put(sink, None)
+
+        threads = [threading.Thread(target=decode)]
+        for position, stage in enumerate(self._stages):
+            if position > 0:
+                threads += [
+                    threading.Thread(target=work, args=(position,))
+                    for i in xrange(stage.workers)
+                ]
+
+        self._started = time.time()
+        self._finished = None
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            pending = {}
+            expected = 0
+            while True:
+                item = get(queues[-1])
+                if item is None:
+                    break
+
+                index, result = item
+                pending[index] = result
+                while expected in pending:
+                    yield pending.pop(expected)
+                    expected += 1
+
+            if errors:
+                raise errors[0]
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            self._finished = time.time()
+
+    def Stats(self):
+        """Per stage frames, busy and waiting seconds and throughput.
+
+        throughput is frames per second of wall time; capacity is what
+        the stage's workers could sustain if they never waited, which
+        points at the stage to give more workers.
+        """
+
+        elapsed = (self._finished or time.time()) - self._started
+
+        stats = {}
+        for stage in self._stages:
+            stats[stage.name] = {
+                'workers': stage.workers,
+                'frames': stage.frames,
+                'busy': stage.busy,
+                'waiting': stage.waiting,
+                'throughput': stage.frames / elapsed if elapsed else 0.0,
+                'capacity': stage.frames * stage.workers / stage.busy
+                if stage.busy else 0.0,
+            }
+
+        return stats
+
+    def _Pyramid(self, frame):
+        return BuildPyramid(frame, model=self.model)
+
+    def _Filter(self, pyramid):
+        return self.model.Filter(pyramid, lazy_argmax=True)
+
+    def _Parse(self, filtered):
+        trees = filtered.Parse(self.threshold)
+        if self.nms_threshold is not None:
+            trees = NMS(trees, self.nms_threshold)
+        return list(trees)
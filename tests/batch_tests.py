@@ -0,0 +1,53 @@
+import scipy.misc
+import numpy
+import os
+import shutil
+import tempfile
+
+from pydro.detection import *
+from pydro.features import *
+from pydro.io import *
+from pydro.batch import *
+
+def share_weights_test():
+    model = LoadModel('tests/example.dpm')
+    image = scipy.misc.imresize(scipy.misc.imread('tests/000034.jpg'), 0.4)
+
+    pyramid = BuildPyramid(image, model=model)
+    reference = list(model.Filter(pyramid).Detect(-1))
+
+    segment = ShareWeights(model)
+    memory = numpy.ctypeslib.as_array(segment)
+    for block in model.GetBlocks():
+        assert numpy.may_share_memory(block.w, memory)
+    for filter in model.GetFilters():
+        assert numpy.may_share_memory(filter.GetParameters(), memory)
+
+    assert list(model.Filter(pyramid).Detect(-1)) == reference
+
+def batch_detector_test():
+    model = LoadModel('tests/example.dpm')
+    image = scipy.misc.imread('tests/000034.jpg')
+
+    directory = tempfile.mkdtemp()
+    try:
+        filenames = []
+        for scale in (0.5, 0.3, 0.4):
+            filename = os.path.join(directory, '%f.png' % scale)
+            scipy.misc.imsave(filename, scipy.misc.imresize(image, scale))
+            filenames += [filename]
+
+        reference = [
+            list(NMS(model.Filter(BuildPyramid(scipy.misc.imread(filename), model=model)).Detect(-1), 0.5))
+            for filename in filenames
+        ]
+
+        detector = BatchDetector(model, processes=2, threshold=-1)
+        try:
+            results = list(detector.Detect(filenames))
+        finally:
+            detector.Close()
+
+        assert results == reference
+    finally:
+        shutil.rmtree(directory)
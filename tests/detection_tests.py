@@ -1,9 +1,11 @@
 import scipy.io
 import numpy
+import itertools
 
 from pydro.detection import *
 from pydro.features import *
 from pydro.io import *
+from pydro.core import Leaf, ModelSet
 
 from pydro.io import _type_handler
 
@@ -169,3 +171,211 @@ def deformation2_test():
     assert (numpy.fabs(deformed - data['A2']) < 1e-6).all()
     assert (Ix + 1 == data['Ix2']).all()
     assert (Iy + 1 == data['Iy2']).all()
+
+def geometry_cache_test():
+    model = LoadModel('tests/example.dpm')
+
+    image = scipy.misc.imresize(scipy.misc.imread('tests/000034.jpg'), 0.5)
+    pyramid1 = BuildPyramid(image, model=model)
+    pyramid2 = BuildPyramid(image, model=model)
+
+    filtered_model1 = model.Filter(pyramid1)
+    filtered_model2 = model.Filter(pyramid2)
+
+    assert filtered_model1.geometry is filtered_model2.geometry
+    assert filtered_model1.size == filtered_model1.start.GetFilteredSize(pyramid1)
+
+    for level1, level2 in itertools.izip(filtered_model1.start.score, filtered_model2.start.score):
+        assert (level1.score == level2.score).all()
+
+def deformation_score_only_test():
+    data = scipy.io.loadmat('tests/deformation_example.mat')
+
+    values = numpy.array(data['values'], dtype=numpy.float32, order='C')
+    deformed, Ix, Iy = DeformationCost(values, 0.1, 0.2, 0.1, 0.02, 4)
+    deformed_only = DeformationCost(values, 0.1, 0.2, 0.1, 0.02, 4, False)
+
+    assert (deformed == deformed_only).all()
+
+def score_only_test():
+    model = LoadModel('tests/example.dpm')
+
+    image = scipy.misc.imresize(scipy.misc.imread('tests/000034.jpg'), 0.5)
+    pyramid = BuildPyramid(image, model=model)
+
+    filtered_model = model.Filter(pyramid)
+    score_only_model = model.Filter(pyramid, score_only=True)
+
+    for rule in score_only_model.start.rules:
+        for symbol in rule.rhs:
+            assert symbol.score is None
+
+    parsed = list(itertools.islice(filtered_model.Parse(-0.5), 10))
+    detected = list(itertools.islice(score_only_model.Detect(-0.5), 10))
+
+    assert len(parsed) == len(detected)
+    for tree, detection in itertools.izip(parsed, detected):
+        assert tree.s == detection.s
+        assert tree.child.rule is filtered_model.start.rules[detection.component]
+        assert (tree.x1, tree.y1, tree.x2, tree.y2) == (detection.x1, detection.y1, detection.x2, detection.y2)
+
+def deformation_argmax_test():
+    data = scipy.io.loadmat('tests/deformation_example.mat')
+
+    values = numpy.array(data['values'], dtype=numpy.float32, order='C')
+    deformed, Ix, Iy = DeformationCost(values, 0.1, 0.2, 0.1, 0.02, 4)
+
+    for y in xrange(values.shape[0]):
+        for x in xrange(values.shape[1]):
+            assert DeformationArgmax(values, 0.1, 0.2, 0.1, 0.02, 4, x, y) == (Ix[y, x], Iy[y, x])
+
+def lazy_argmax_test():
+    model = LoadModel('tests/example.dpm')
+
+    image = scipy.misc.imresize(scipy.misc.imread('tests/000034.jpg'), 0.5)
+    pyramid = BuildPyramid(image, model=model)
+
+    filtered_model = model.Filter(pyramid)
+    lazy_model = model.Filter(pyramid, lazy_argmax=True)
+
+    def leaves(node):
+        if isinstance(node, Leaf):
+            return [(node.x, node.y, node.l, node.s)]
+        return sum((leaves(child) for child in node.children), [])
+
+    parsed = list(itertools.islice(filtered_model.Parse(-0.5), 10))
+    lazy_parsed = list(itertools.islice(lazy_model.Parse(-0.5), 10))
+
+    assert len(parsed) == len(lazy_parsed)
+    for tree, lazy_tree in itertools.izip(parsed, lazy_parsed):
+        assert tree.s == lazy_tree.s
+        assert leaves(tree.child) == leaves(lazy_tree.child)
+
+def model_set_test():
+    model1 = LoadModel('tests/example.dpm')
+    model2 = LoadModel('tests/example.dpm')
+    model2.start.rules = model2.start.rules[:1]
+
+    model_set = ModelSet([model1, model2])
+
+    image = scipy.misc.imresize(scipy.misc.imread('tests/000034.jpg'), 0.5)
+    pyramid = BuildPyramid(image, model=model_set)
+
+    filtered_set = model_set.Filter(pyramid)
+
+    for model, filtered_model in itertools.izip(model_set.models, filtered_set.models):
+        reference = model.Filter(pyramid)
+        for level, reference_level in itertools.izip(filtered_model.start.score, reference.start.score):
+            assert (level.score == reference_level.score).all()
+
+    per_model = [list(d) for d in filtered_set.Parse(-1, 0.3)]
+    assert all(len(d) > 0 for d in per_model)
+
+    merged = list(filtered_set.ParseAll(-1, 0.3, across_classes=False))
+    assert len(merged) == sum(len(d) for d in per_model)
+    assert all(a.s >= b.s for a, b in itertools.izip(merged, merged[1:]))
+
+    merged = list(filtered_set.ParseAll(-1, 0.3))
+    assert len(merged) <= len(per_model[0]) + len(per_model[1])
+    assert set(d.model for d in merged) <= set(filtered_set.models)
+
+def model_set_batch_test():
+    model_set = ModelSet([LoadModel('tests/example.dpm')])
+
+    image = scipy.misc.imread('tests/000034.jpg')
+    pyramids = [
+        BuildPyramid(scipy.misc.imresize(image, 0.5), model=model_set),
+        BuildPyramid(scipy.misc.imresize(image, 0.4), model=model_set),
+    ]
+
+    batch = model_set.FilterBatch(pyramids)
+    assert len(batch) == len(pyramids)
+
+    for pyramid, filtered_set in itertools.izip(pyramids, batch):
+        reference = model_set.Filter(pyramid)
+        for level, reference_level in itertools.izip(filtered_set.models[0].start.score, reference.models[0].start.score):
+            assert (level.score == reference_level.score).all()
+
+def masked_filter_test():
+    model = LoadModel('tests/example.dpm')
+
+    image = scipy.misc.imresize(scipy.misc.imread('tests/000034.jpg'), 0.4)
+    pyramid = BuildPyramid(image, model=model)
+
+    dense = model.Filter(pyramid, lazy_argmax=True)
+
+    masks = [numpy.zeros(size, dtype=bool) for size in dense.size]
+    for mask in masks[model.interval:]:
+        mask[mask.shape[0] / 3:, 5:mask.shape[1] / 2] = True
+
+    masked = model.Filter(pyramid, lazy_argmax=True, masks=masks)
+    for mask, level, reference in itertools.izip(masks, masked.start.score, dense.start.score):
+        assert numpy.isneginf(level.score[numpy.logical_not(mask)]).all()
+        assert (numpy.isfinite(level.score[mask]) == numpy.isfinite(reference.score[mask])).all()
+        finite = numpy.isfinite(reference.score) & mask
+        assert (numpy.fabs(level.score[finite] - reference.score[finite]) < 1e-4).all()
+
+def score_boxes_test():
+    model = LoadModel('tests/example.dpm')
+
+    image = scipy.misc.imresize(scipy.misc.imread('tests/000034.jpg'), 0.4)
+    pyramid = BuildPyramid(image, model=model)
+
+    dense = list(itertools.islice(
+        model.Filter(pyramid, lazy_argmax=True).Parse(-1.5), 5))
+    assert len(dense) > 0
+
+    boxes = [(t.x1, t.y1, t.x2, t.y2) for t in dense] + [(-1e4, -1e4, -9e3, -9e3)]
+    scored = model.ScoreBoxes(pyramid, boxes)
+    assert len(scored) == len(boxes)
+    assert scored[-1] is None
+
+    for tree, reference in itertools.izip(scored, dense):
+        assert tree.s >= reference.s - 1e-4
+        if tree.model.start.rules.index(tree.child.rule) == \
+                reference.model.start.rules.index(reference.child.rule):
+            assert abs(tree.s - reference.s) < 1e-4
+            assert (tree.x1, tree.y1, tree.x2, tree.y2) == \
+                (reference.x1, reference.y1, reference.x2, reference.y2)
+
+def roi_filter_test():
+    model = LoadModel('tests/example.dpm')
+
+    image = scipy.misc.imresize(scipy.misc.imread('tests/000034.jpg'), 0.4)
+    roi = [(0, image.shape[0] / 2, image.shape[1] / 3, image.shape[0] - 1)]
+    mask = RoiMask(roi, image.shape)
+
+    dense = model.Filter(BuildPyramid(image, model=model), lazy_argmax=True)
+    masked = model.Filter(BuildPyramid(image, model=model, roi=roi), lazy_argmax=True)
+
+    def key(tree):
+        return (tree.x1, tree.y1, tree.child.l,
+                tree.model.start.rules.index(tree.child.rule))
+
+    def overlaps(tree):
+        return mask[max(0, int(numpy.floor(tree.y1))):max(0, int(numpy.ceil(tree.y2 + 1))),
+                    max(0, int(numpy.floor(tree.x1))):max(0, int(numpy.ceil(tree.x2 + 1)))].any()
+
+    expected = dict((key(tree), tree.s) for tree in dense.Parse(-1.0) if overlaps(tree))
+    found = dict((key(tree), tree.s) for tree in masked.Parse(-1.0))
+    assert len(expected) > 0
+    assert sorted(expected.keys()) == sorted(found.keys())
+    for k, s in expected.iteritems():
+        assert abs(found[k] - s) < 1e-4
+
+def update_filter_test():
+    model = LoadModel('tests/example.dpm')
+
+    image = scipy.misc.imresize(scipy.misc.imread('tests/000034.jpg'), 0.4)
+    frame = image.copy()
+    frame[100:130, 120:150] = image[60:90, 40:70]
+
+    previous = BuildPyramid(image, model=model)
+    pyramid = UpdatePyramid(previous, frame)
+
+    dense = model.Filter(BuildPyramid(frame, model=model))
+    updated = model.Filter(pyramid, previous=model.Filter(previous))
+    for level, reference in itertools.izip(updated.start.score, dense.start.score):
+        finite = numpy.isfinite(reference.score)
+        assert (numpy.isfinite(level.score) == finite).all()
+        assert (numpy.fabs(level.score[finite] - reference.score[finite]) < 1e-4).all()
@@ -0,0 +1,72 @@
+import scipy.misc
+import threading
+
+from pydro.detection import *
+from pydro.features import *
+from pydro.io import *
+from pydro.executor import *
+
+def executor_detect_test():
+    model = LoadModel('tests/example.dpm')
+    image = scipy.misc.imresize(scipy.misc.imread('tests/000034.jpg'), 0.5)
+
+    pyramid = BuildPyramid(image, model=model)
+    filtered = model.Filter(pyramid)
+    reference = list(NMS(filtered.Detect(-1), 0.5))
+
+    executor = Executor(max_workers=2)
+    try:
+        futures = [executor.Detect(model, image, -1, 0.5) for i in xrange(3)]
+        for future in futures:
+            assert future.Result() == reference
+
+        pyramid_future = executor.BuildPyramid(image, model=model)
+        filtered_future = executor.Filter(model, pyramid_future.Result())
+        trees = list(executor.Parse(filtered_future.Result(), -1, depth=2))
+        expected = list(filtered.Parse(-1))
+        assert len(trees) == len(expected)
+        assert [t.s for t in trees] == [t.s for t in expected]
+
+        stream = executor.Parse(filtered, -1, depth=1)
+        first = stream.Next().Result()
+        assert first.s == expected[0].s
+        stream.Close()
+        try:
+            stream.next()
+            assert False
+        except CancelledError:
+            pass
+    finally:
+        executor.Shutdown()
+
+def executor_cancel_test():
+    executor = Executor(max_workers=1)
+    try:
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+            return 1
+
+        running = executor.Submit(block)
+        pending = executor.Submit(lambda: 2)
+        started.wait()
+
+        called = []
+        pending.AddDoneCallback(lambda future: called.append(future.Cancelled()))
+        assert pending.Cancel()
+        assert called == [True]
+
+        release.set()
+        assert running.Result() == 1
+        try:
+            pending.Result()
+            assert False
+        except CancelledError:
+            pass
+
+        assert executor.Submit(lambda: 3).Result() == 3
+    finally:
+        executor.Shutdown()
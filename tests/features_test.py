@@ -6,6 +6,7 @@ import itertools
 
 from pydro.features import *
 from pydro.io import *
+from pydro import features
 
 def resize_test():
     image = scipy.misc.imread('tests/lenna.png').astype(numpy.float32)
@@ -89,3 +90,35 @@ def resize_test():
     im_small_mine = ResizeImage(im.astype(numpy.float32), im_small_correct.shape[0], im_small_correct.shape[1])
 
     assert numpy.fabs(im_small_correct - im_small_mine).max() < 1e-2
+
+def pyramid_plan_test():
+    image = scipy.misc.imread('tests/lenna.png')
+
+    pyramid1 = BuildPyramid(image, sbin=8, interval=5, extra_octave=True, padx=4, pady=4)
+    pyramid2 = BuildPyramid(image, sbin=8, interval=5, extra_octave=True, padx=4, pady=4)
+
+    plan = features._PyramidPlan(image.shape[0:2], 8, 5, True)
+    assert plan is features._PyramidPlan(image.shape[0:2], 8, 5, True)
+    assert len(plan) == len(pyramid1.levels)
+
+    for level1, level2 in itertools.izip(pyramid1.levels, pyramid2.levels):
+        assert level1.scale == level2.scale
+        assert (level1.features == level2.features).all()
+
+def update_pyramid_test():
+    image = scipy.misc.imread('tests/lenna.png').astype(numpy.float32)
+    frame = image.copy()
+    frame[200:260, 300:340] = image[100:160, 50:90]
+
+    previous = BuildPyramid(image, sbin=8, interval=5, extra_octave=True, padx=4, pady=4)
+    updated = UpdatePyramid(previous, frame)
+    full = BuildPyramid(frame, sbin=8, interval=5, extra_octave=True, padx=4, pady=4)
+
+    assert len(updated.levels) == len(full.levels)
+    for level1, level2 in itertools.izip(updated.levels, full.levels):
+        assert level1.scale == level2.scale
+        assert (level1.features == level2.features).all()
+
+    unchanged = UpdatePyramid(updated, frame)
+    for level1, level2 in itertools.izip(unchanged.levels, updated.levels):
+        assert level1.features is level2.features
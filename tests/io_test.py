@@ -1,6 +1,17 @@
 from pydro.io import *
+from pydro.features import BuildPyramid
+from pydro.io import _normalize_model, _denormalize_model, _LoadArtifacts
+from pydro.io import _SaveContainer, _pyramid_magic
+from pydro.features import Pyramid
 
 import itertools
+import numpy
+import os
+import scipy.misc
+import shutil
+import tempfile
+import threading
+import time
 
 def read_test():
     model = LoadModel('tests/example.dpm')
@@ -45,3 +56,289 @@ def wr_test():
     model2 = LoadModel('tests/wr_test.dpm')
     assert compare(model, model2)
     assert compare(model, model3)
+
+def mapped_test():
+    model = LoadModel('tests/example.dpm')
+    SaveModel('tests/mapped_test.dpm', model, mapped=True)
+    mapped = LoadModel('tests/mapped_test.dpm')
+    assert compare(model, mapped)
+
+    for block, mapped_block in itertools.izip(model.GetBlocks(), mapped.GetBlocks()):
+        assert block.w.shape == mapped_block.w.shape
+        assert (block.w == mapped_block.w).all()
+        assert not mapped_block.w.flags.writeable
+        assert not mapped_block.w.flags.owndata
+
+    ConvertModel('tests/mapped_test.dpm', 'tests/wr_test.dpm', mapped=False)
+    packed = LoadModel('tests/wr_test.dpm')
+    for block, packed_block in itertools.izip(model.GetBlocks(), packed.GetBlocks()):
+        assert (block.w == packed_block.w).all()
+
+def overwrite_mapped_test():
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'model.dpm')
+        SaveModel(filename, LoadModel('tests/example.dpm'), mapped=True)
+        os.chmod(filename, 0o640)
+        mapped = LoadModel(filename)
+        before = [block.w.copy() for block in mapped.GetBlocks()]
+
+        changed = LoadModel('tests/example.dpm')
+        for block in changed.GetBlocks():
+            block.w = block.w + 1
+        SaveModel(filename, changed, mapped=True)
+
+        # the old model still reads the old weights
+        for block, w in itertools.izip(mapped.GetBlocks(), before):
+            assert (block.w == w).all()
+        for block, w in itertools.izip(LoadModel(filename).GetBlocks(), before):
+            assert (block.w == w + 1).all()
+
+        assert os.listdir(directory) == ['model.dpm']
+        assert os.stat(filename).st_mode & 0o777 == 0o640
+    finally:
+        shutil.rmtree(directory)
+
+def chunked_test():
+    model = LoadModel('tests/example.dpm')
+    SaveModel('tests/chunked_test.dpm', model, chunked=True)
+
+    for threads in (1, 4):
+        chunked = LoadModel('tests/chunked_test.dpm', threads=threads)
+        assert compare(model, chunked)
+        for block, chunked_block in itertools.izip(model.GetBlocks(), chunked.GetBlocks()):
+            assert block.w.dtype == chunked_block.w.dtype
+            assert (block.w == chunked_block.w).all()
+            assert not chunked_block.w.flags.writeable
+
+    ConvertModel('tests/chunked_test.dpm', 'tests/wr_test.dpm', mapped=False)
+    assert compare(model, LoadModel('tests/wr_test.dpm'))
+
+def lazy_test():
+    model = LoadModel('tests/example.dpm')
+    SaveModel('tests/chunked_test.dpm', model, chunked=True, artifacts=True)
+
+    lazy = LoadModel('tests/chunked_test.dpm', lazy=True)
+    blocks = lazy.GetBlocks()
+    assert not any(block.Loaded() for block in blocks)
+
+    # the grammar is there without the weights
+    sizes = [filter.size for filter in model.GetFilters()]
+    assert [filter.size for filter in lazy.GetFilters()] == sizes
+    assert not any(block.Loaded() for block in blocks)
+
+    for block, lazy_block in itertools.izip(model.GetBlocks(), blocks):
+        assert (block.w == lazy_block.w).all()
+        assert lazy_block.Loaded()
+    assert compare(model, lazy)
+    for filter, lazy_filter in itertools.izip(model.GetFilters(), lazy.GetFilters()):
+        assert (filter.GetParameters() == lazy_filter.GetParameters()).all()
+
+def _SyntheticGrammar(n):
+    """A chain of n nonterminals, each with its own terminal, start last."""
+
+    def block(shape, type):
+        return {
+            'w': numpy.zeros(shape, dtype=numpy.float32),
+            'lb': numpy.zeros((0,), dtype=numpy.float32),
+            'learn': 1.0,
+            'reg_mult': 1.0,
+            'dim': int(numpy.prod(shape)),
+            'type': type,
+        }
+
+    symbols = []
+    rules = []
+    for i in xrange(n):
+        symbols += [{'type': 'T', 'filter': i + 1}, {'type': 'N', 'filter': None}]
+        rhs = [2 * i + 1] + ([2 * i] if i > 0 else [])
+        rules += [[], [{
+            'type': 'S',
+            'lhs': 2 * i + 2,
+            'rhs': rhs,
+            'detwindow': (2, 2),
+            'shiftwindow': (0, 0),
+            'i': 1,
+            'anchor': [(0, 0, 0)] * len(rhs),
+            'offset': {'blocklabel': 1},
+            'loc': {'blocklabel': 1},
+            'blocks': [1],
+        }]]
+
+    return {
+        'clss': 'synthetic',
+        'year': '',
+        'note': '',
+        'start': 2 * n,
+        'maxsize': (2, 2),
+        'minsize': (2, 2),
+        'interval': 10,
+        'sbin': 8,
+        'thresh': 0.0,
+        'type': 'G',
+        'features': {'sbin': 8, 'dim': 32, 'truncation_dim': 32, 'extra_octave': False, 'bias': 10},
+        'stats': {'slave_problem_time': [], 'data_mining_time': [], 'pos_latent_time': [], 'filter_usage': []},
+        'blocks': [block((1,), 'O')] + [block((2, 2, 32), 'F') for i in xrange(n)],
+        'filters': [{'blocklabel': i + 2, 'size': (2, 2), 'flip': False, 'symbol': 2 * i + 1} for i in xrange(n)],
+        'symbols': symbols,
+        'rules': rules,
+    }
+
+def synthetic_grammar_test():
+    n = 4000
+    model = _normalize_model(_SyntheticGrammar(n))
+
+    depth = 0
+    symbol = model.start
+    while symbol.type != 'T':
+        rule, = symbol.rules
+        assert rule.lhs() is symbol
+        symbol = rule.rhs[-1]
+        depth += 1
+    assert depth == n
+
+    denormalized = _denormalize_model(model)
+    assert len(denormalized['filters']) == n
+    assert len(denormalized['symbols']) == 2 * n
+    again = _denormalize_model(_normalize_model(denormalized))
+    assert len(again['symbols']) == 2 * n
+
+    cyclic = _SyntheticGrammar(2)
+    cyclic['rules'][1][0]['rhs'] = [1, 4]
+    try:
+        _normalize_model(cyclic)
+    except Exception as e:
+        assert 'cycle' in str(e)
+    else:
+        assert False
+
+def registry_test():
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'model.dpm')
+        shutil.copy('tests/example.dpm', filename)
+
+        registry = ModelRegistry()
+        models = []
+        threads = [threading.Thread(target=lambda: models.append(registry.Get(filename)))
+                   for i in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(models) == 4
+        assert all(model is models[0] for model in models)
+        assert registry.Stats()['loads'] == 1
+
+        # a newer mtime with the same content keeps the model
+        os.utime(filename, (time.time() + 10, time.time() + 10))
+        assert registry.Get(filename) is models[0]
+        assert registry.Stats()['reloads'] == 0
+
+        SaveModel(filename, models[0], mapped=True)
+        reloaded = registry.Get(filename)
+        assert reloaded is not models[0]
+        assert registry.Get(filename) is reloaded
+
+        # a mapped model stays usable when the file is saved over again
+        before = [block.w.copy() for block in reloaded.GetBlocks()]
+        changed = LoadModel('tests/example.dpm')
+        for block in changed.GetBlocks():
+            block.w = block.w * 2
+        SaveModel(filename, changed, mapped=True)
+        for block, w in itertools.izip(reloaded.GetBlocks(), before):
+            assert (block.w == w).all()
+        assert registry.Get(filename) is not reloaded
+
+        stats = registry.Stats()
+        assert stats['reloads'] == 2
+        assert stats['hits'] == 5
+        assert stats['models'] == 1
+        assert stats['load_seconds'] > 0
+    finally:
+        shutil.rmtree(directory)
+
+def artifacts_test():
+    # the example has no mirrored components, so mirror a filter and a
+    # deformation
+    denormalized = _denormalize_model(LoadModel('tests/example.dpm'))
+    denormalized['filters'][0]['flip'] = True
+    for rules in denormalized['rules']:
+        for rule in rules:
+            if rule['type'] == 'D':
+                rule['df']['flip'] = True
+                break
+    model = _normalize_model(denormalized)
+
+    SaveModel('tests/mapped_test.dpm', model, mapped=True, artifacts=True)
+    loaded = LoadModel('tests/mapped_test.dpm')
+
+    flipped = [filter for filter in loaded.GetFilters() if filter.flip]
+    assert len(flipped) > 0
+    for filter, reference in itertools.izip(loaded.GetFilters(), model.GetFilters()):
+        assert (filter.GetParameters() == reference.GetParameters()).all()
+    for filter in flipped:
+        # a view of the saved artifact rather than a recomputed copy
+        assert not filter.GetParameters().flags.owndata
+
+    denormalized = _denormalize_model(model, artifacts=True)
+    flipped, deformations = _LoadArtifacts(denormalized)
+    assert len(flipped) > 0 and len(deformations) > 0
+
+    blocklabel = denormalized['filters'][flipped.keys()[0] - 1]['blocklabel']
+    denormalized['blocks'][blocklabel - 1]['w'] = \
+        denormalized['blocks'][blocklabel - 1]['w'] + 1
+    assert _LoadArtifacts(denormalized) == ({}, {})
+
+def pyramid_storage_test():
+    model = LoadModel('tests/example.dpm')
+    image = scipy.misc.imresize(scipy.misc.imread('tests/000034.jpg'), 0.3)
+    pyramid = BuildPyramid(image, model=model)
+    filtered = model.Filter(pyramid)
+
+    directory = tempfile.mkdtemp()
+    try:
+        for compress in (0, 6):
+            pyramid_file = os.path.join(directory, 'pyramid')
+            responses_file = os.path.join(directory, 'responses')
+            SavePyramid(pyramid_file, pyramid, compress)
+            SaveResponses(responses_file, filtered, compress)
+
+            loaded = LoadPyramid(pyramid_file)
+            assert len(loaded.levels) == len(pyramid.levels)
+            assert loaded.roi is None
+            for level, reference in itertools.izip(loaded.levels, pyramid.levels):
+                assert level.scale == reference.scale
+                assert level.features.strides == reference.features.strides
+                assert (level.features == reference.features).all()
+
+            responses = LoadResponses(responses_file, model)
+            assert len(responses) == len(filtered.responses)
+
+            refiltered = model.Filter(loaded, responses=responses)
+            for level, reference in itertools.izip(refiltered.start.score, filtered.start.score):
+                assert (level.score == reference.score).all()
+
+        roi = BuildPyramid(image, model=model, roi=[(0, 0, 40, 40)])
+        SavePyramid(pyramid_file, roi)
+        assert (LoadPyramid(pyramid_file).roi == roi.roi).all()
+
+        # pyramids saved before they had a region of interest
+        structure = {
+            'levels': [{'scale': level.scale, 'features': level.features}
+                       for level in pyramid.levels],
+            'image': pyramid.image,
+            'pady': pyramid.pady,
+            'padx': pyramid.padx,
+            'sbin': pyramid.sbin,
+            'interval': pyramid.interval,
+        }
+        _SaveContainer(pyramid_file, _pyramid_magic, structure)
+        assert LoadPyramid(pyramid_file).roi is None
+
+        # and built without one
+        unbounded = Pyramid(pyramid.levels, pyramid.image, pyramid.pady,
+                            pyramid.padx, pyramid.sbin, pyramid.interval)
+        assert unbounded.roi is None
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,57 @@
+import scipy.misc
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+
+from pydro.detection import *
+from pydro.features import *
+from pydro.io import *
+from pydro.serve import *
+
+def serve_test():
+    model = LoadModel('tests/example.dpm')
+    image = scipy.misc.imresize(scipy.misc.imread('tests/000034.jpg'), 0.5)
+
+    pyramid = BuildPyramid(image, model=model)
+    reference = list(NMS(model.Filter(pyramid).Detect(-1), 0.5))
+    assert len(reference) > 0
+
+    service = DetectionService([model], threshold=-1, workers=2, batch_size=4)
+    service.Start()
+
+    directory = tempfile.mkdtemp()
+    try:
+        address = os.path.join(directory, 'pydro.sock')
+        server = MakeServer(service, address)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        with open(os.path.join(directory, 'image.png'), 'wb') as f:
+            scipy.misc.imsave(f, image, format='png')
+        with open(os.path.join(directory, 'image.png'), 'rb') as f:
+            data = f.read()
+
+        detections = Request(address, data)
+        assert len(detections) == len(reference)
+        for detection, expected in itertools.izip(detections, reference):
+            assert detection['model'] == model.clss
+            assert abs(detection['score'] - expected.s) < 1e-5
+            assert detection['x1'] == expected.x1 and detection['y2'] == expected.y2
+
+        result = Benchmark(address, data, requests=8, concurrency=4)
+        assert result['errors'] == 0
+        assert result['throughput'] > 0
+
+        stats = service.Stats()
+        assert stats['requests'] == 9
+        assert stats['errors'] == 0
+        assert stats['batches'] <= stats['requests']
+
+        server.shutdown()
+        server.server_close()
+    finally:
+        service.Stop()
+        shutil.rmtree(directory)
@@ -0,0 +1,79 @@
+import scipy.misc
+import numpy
+
+from pydro.detection import *
+from pydro.features import *
+from pydro.io import *
+from pydro.tiling import *
+from pydro import features, tiling
+
+def spans_test():
+    for length, size in ((1000, 300), (301, 300), (250, 300), (2000, 672)):
+        spans = tiling._Spans(length, size)
+        assert spans[0][0] is None
+        assert spans[-1][1] is None
+        for a in xrange(length):
+            assert sum(tiling._Inside(a, span) for span in spans) == 1
+        for start, end in spans:
+            assert (end or length) - (start or 0) <= size
+
+def window_features_test():
+    model = LoadModel('tests/example.dpm')
+    image = scipy.misc.imread('tests/000034.jpg')
+    pyramid = BuildPyramid(image, model=model)
+    plan = sorted(tiling._PyramidPlan(image.shape[0:2], model.sbin,
+                                      model.interval,
+                                      model.features.extra_octave),
+                  key=lambda spec: -spec.scale)
+
+    pady, padx = model.maxsize[0] + 1, model.maxsize[1] + 1
+    for index in (0, 10, len(plan) - 1):
+        level = pyramid.levels[index].features
+        assert plan[index].scale == pyramid.levels[index].scale
+        for ywindow, xwindow in (((0, 12), (5, 30)), ((3, 15), (17, 35)),
+                                 ((0, level.shape[0]), (0, level.shape[1]))):
+            expected = level[ywindow[0]:ywindow[1], xwindow[0]:xwindow[1]]
+            for max_pixels in (None, 2000):
+                features = tiling._WindowFeatures(image, plan[index], pady, padx,
+                                                  ywindow, xwindow, max_pixels)
+                assert features.shape == expected.shape
+                assert (features == expected).all()
+
+def tiled_detection_test():
+    model = LoadModel('tests/example.dpm')
+    image = scipy.misc.imresize(scipy.misc.imread('tests/000034.jpg'), 1.5)
+
+    max_bytes = 90 << 20
+    assert tiling._PyramidBytes(image.shape[0:2], model, None) > max_bytes
+    size = tiling._Plan(model, image.shape[0:2], max_bytes)
+    assert size < image.shape[1]
+
+    pyramid = BuildPyramid(image, model=model)
+    reference = list(NMS(model.Filter(pyramid).Detect(0), 0.5))
+    assert len(reference) > 0
+
+    # tiles resize crops of the image, never a float copy of all of it
+    assert image.dtype == numpy.uint8
+    image.flags.writeable = False
+    sources = []
+    resize = features.ResizeImage
+    def spy(source, *args):
+        sources.append(source)
+        return resize(source, *args)
+    features.ResizeImage = spy
+    try:
+        tiled = list(DetectTiled(model, image, 0, 0.5, max_bytes=max_bytes))
+    finally:
+        features.ResizeImage = resize
+    assert len(sources) > 0
+    for source in sources:
+        assert source.dtype == numpy.float32
+        assert source.shape[0] * source.shape[1] < image.shape[0] * image.shape[1]
+        assert source.base is not image
+
+    assert len(tiled) == len(reference)
+    for a, b in zip(reference, tiled):
+        assert a.l == b.l
+        assert numpy.fabs(a.s - b.s) < 1e-4
+        assert numpy.allclose((a.x1, a.y1, a.x2, a.y2),
+                              (b.x1, b.y1, b.x2, b.y2))
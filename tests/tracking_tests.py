@@ -0,0 +1,27 @@
+import scipy.misc
+import numpy
+
+from pydro.detection import *
+from pydro.features import *
+from pydro.io import *
+from pydro.tracking import *
+
+def tracker_test():
+    model = LoadModel('tests/example.dpm')
+    image = scipy.misc.imresize(scipy.misc.imread('tests/000034.jpg'), 0.5)
+    moved = numpy.ascontiguousarray(numpy.roll(image, 3, axis=1))
+
+    tracker = Tracker(model, -0.7, full_every=2)
+    first = tracker.Track(image)
+    assert len(first) > 0
+
+    masks = SearchMasks(model, BuildPyramid(moved, model=model), first)
+    assert 0 < sum(mask.sum() for mask in masks) < sum(mask.size for mask in masks) / 10
+
+    tracked = tracker.Track(moved)
+    dense = list(NMS(model.Filter(BuildPyramid(moved, model=model)).Parse(-0.7), 0.5))
+
+    assert len(tracked) == len(dense)
+    for a, b in zip(tracked, dense):
+        assert (a.x1, a.y1, a.x2, a.y2) == (b.x1, b.y1, b.x2, b.y2)
+        assert abs(a.s - b.s) < 1e-4
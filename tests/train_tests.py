@@ -3,8 +3,11 @@ from pydro.train import *
 from pydro.features import *
 from pydro.core import *
 from pydro.detection import *
+from pydro.train import _block_sections, _pack_examples, _objective, _native_objective
+from pydro.train import __TrainingExample__
 
 import itertools
+import os
 
 import scipy.misc
 
@@ -33,8 +36,6 @@ def loss_adjustment_test():
     filtered_model = model.Filter(pyramid, loss_adjustment=loss_adjustment)
 
     detections = [d for i,d in itertools.izip(xrange(1), filtered_model.Parse(-1))]
-    print(detections[0].loss)
-    print(detections[0].s)
     assert math.fabs(detections[0].loss - 9) < 1e-5
 
 def neg_latent_test():
@@ -50,7 +51,6 @@ def neg_latent_test():
 
     for entry in example:
         new_score = score_vector(entry)
-        print(entry.score, entry.loss)
         assert math.fabs(entry.score - new_score) < 1e-4
 
 def pos_latent_test():
@@ -72,7 +72,6 @@ def pos_latent_test():
 
     for entry in example:
         new_score = score_vector(entry)
-        print(entry.score, entry.loss)
         assert math.fabs(entry.score - new_score) < 1e-4
 
 def overlap_loss_test():
@@ -99,7 +98,6 @@ def overlap_loss_test():
 
     for entry in example:
         new_score = score_vector(entry)
-        print(entry.score, entry.loss)
         assert math.fabs(entry.score - new_score) < 1e-4
 
 def optimize_test():
@@ -125,7 +123,223 @@ def optimize_test():
 
     for entry in example:
         new_score = score_vector(entry)
-        print(entry.score, entry.loss)
         assert math.fabs(entry.score - new_score) < 1e-4
 
     optimize (model, examples=[example], svm_c=0.001)
+
+def _synthetic_examples(model):
+    blocks = model.GetBlocks()
+
+    examples = []
+    for i in xrange(2):
+        features = [{block: numpy.ones(block.w.size, dtype=numpy.float32) * (j - i)
+                     for block in blocks[j::7]} for j in xrange(2)]
+        examples += [[
+            __TrainingExample__(features=features[0], belief=True, loss=0, score=None),
+            __TrainingExample__(features=features[1], belief=False, loss=1, score=None),
+        ]]
+
+    return examples
+
+def chunked_optimize_test():
+    reference = LoadModel('tests/example.dpm')
+    optimize(reference, examples=_synthetic_examples(reference), svm_c=0.001)
+
+    SaveModel('tests/chunked_test.dpm', LoadModel('tests/example.dpm'), chunked=True)
+    for kwargs in ({}, {'threads': 1}, {'lazy': True}):
+        model = LoadModel('tests/chunked_test.dpm', **kwargs)
+        optimize(model, examples=_synthetic_examples(model), svm_c=0.001)
+
+        for block, reference_block in itertools.izip(model.GetBlocks(), reference.GetBlocks()):
+            assert not block.w.flags.writeable
+            assert numpy.allclose(block.w, reference_block.w)
+
+    os.remove('tests/chunked_test.dpm')
+
+def mapped_optimize_test():
+    reference = LoadModel('tests/example.dpm')
+    optimize(reference, examples=_synthetic_examples(reference), svm_c=0.001)
+
+    SaveModel('tests/mapped_test.dpm', LoadModel('tests/example.dpm'), mapped=True)
+    model = LoadModel('tests/mapped_test.dpm')
+    optimize(model, examples=_synthetic_examples(model), svm_c=0.001)
+
+    for block, reference_block in itertools.izip(model.GetBlocks(), reference.GetBlocks()):
+        assert not block.w.flags.writeable
+        assert numpy.allclose(block.w, reference_block.w)
+
+    # flipped filters follow the trained weights
+    for filter in model.GetFilters():
+        w = filter.blocklabel.w
+        if filter.flip:
+            w = w[:, ::-1, Filter._p]
+        assert (filter.GetParameters() == w).all()
+
+    os.remove('tests/mapped_test.dpm')
+
+def _loop_objective(examples, blocks, block_sections, solution, svm_c):
+    """Entry by entry objective value and gradient, for reference."""
+
+    w = {block: solution[start:end] for block, (start, end) in block_sections.iteritems()}
+
+    def score(entry):
+        return sum(entry.features[block].flatten().dot(w[block]) for block in entry.features)
+
+    gradient = numpy.zeros(solution.shape)
+    objective_value = 0
+    for example in examples:
+        max_entry = max(example, key=lambda entry: score(entry) + entry.loss)
+        belief_entry, = [entry for entry in example if entry.belief]
+
+        objective_value += svm_c * (score(max_entry) + max_entry.loss - score(belief_entry))
+
+        if max_entry is not belief_entry:
+            for block in max_entry.features:
+                start, end = block_sections[block]
+                gradient[start:end] += svm_c * max_entry.features[block].flatten()
+            for block in belief_entry.features:
+                start, end = block_sections[block]
+                gradient[start:end] -= svm_c * belief_entry.features[block].flatten()
+
+    for block in blocks:
+        start, end = block_sections[block]
+        objective_value += 0.5 * block.reg_mult * w[block].dot(w[block])
+        gradient[start:end] += block.reg_mult * w[block]
+
+    return objective_value, gradient
+
+def shared_block_test():
+    model = LoadModel('tests/example.dpm')
+
+    filters = [f for f in model.GetFilters() if f.size == [6, 6] and not f.flip]
+    shared = filters[0].blocklabel
+    filters[1].blocklabel = shared
+    filters[1]._w = None
+    assert len(set(id(block) for block in model.GetBlocks())) == len(model.GetBlocks()) - 1
+
+    x = numpy.ones(shared.w.size, dtype=numpy.float32)
+    example = [
+        __TrainingExample__(features={shared: 0 * x}, belief=True, loss=0, score=None),
+        __TrainingExample__(features={shared: x}, belief=False, loss=1, score=None),
+    ]
+
+    # the packed objective treats a shared block like the loop over blocks
+    blocks = model.GetBlocks()
+    block_sections, num_parms = _block_sections(blocks)
+    packed = _pack_examples([example], blocks, block_sections, num_parms)
+    numpy.random.seed(0)
+    solution = numpy.random.randn(num_parms)
+    loop_value, loop_gradient = _loop_objective([example], blocks, block_sections, solution, 0.0005)
+    for objective in (_objective, _native_objective):
+        value, gradient = objective(packed, solution, 0.0005)
+        assert math.fabs(value - loop_value) < 1e-8 * math.fabs(loop_value)
+        assert numpy.allclose(gradient, loop_gradient, rtol=1e-8, atol=1e-10)
+
+    # optimize regularizes a shared block once, so at the optimum
+    # svm_c * x + w = 0
+    optimize(model, examples=[example], svm_c=0.0005)
+
+    assert filters[1].blocklabel is shared
+    assert numpy.allclose(shared.w, -0.0005, rtol=1e-3)
+    assert (filters[1].GetParameters() == shared.w).all()
+
+def _packed_examples():
+    model = LoadModel('tests/example.dpm')
+
+    image = scipy.misc.imread('tests/000034.jpg')
+    pyramid = BuildPyramid (image, model=model)
+    detection = model.Filter (pyramid).Parse(-1).next()
+
+    bbox = __BBox__(x1=detection.x1, y1=detection.y1, x2=detection.x2, y2=detection.y2)
+
+    loss_adjustment = overlap_loss_adjustment(model, pyramid, 0.5, 1, model.start.rules, bbox)
+    belief_adjustment = overlap_loss_adjustment(model, pyramid, 0.7, -numpy.inf, model.start.rules, bbox)
+
+    examples = [
+        get_positive_latent_features (model, pyramid, belief_adjustment, loss_adjustment, 3),
+        get_negative_latent_features (model, pyramid, 4),
+    ]
+
+    blocks = model.GetBlocks()
+    block_sections, num_parms = _block_sections(blocks)
+    packed = _pack_examples(examples, blocks, block_sections, num_parms)
+    assert packed.features.shape == (sum(len(e) for e in examples), num_parms)
+
+    solution = numpy.zeros((num_parms,))
+    for block in blocks:
+        start, end = block_sections[block]
+        solution[start:end] = block.w.flatten()
+
+    return examples, blocks, block_sections, packed, solution
+
+def objective_test():
+    examples, blocks, block_sections, packed, solution = _packed_examples()
+
+    numpy.random.seed(0)
+    for scale in (0, 0.01, 0.1):
+        perturbed = solution + scale * numpy.random.randn(len(solution))
+        value, gradient = _objective(packed, perturbed, 0.001)
+        loop_value, loop_gradient = _loop_objective(examples, blocks, block_sections, perturbed, 0.001)
+
+        assert math.fabs(value - loop_value) < 1e-4 * max(1, math.fabs(loop_value))
+        assert numpy.allclose(gradient, loop_gradient, rtol=1e-4, atol=1e-6)
+
+def native_objective_test():
+    examples, blocks, block_sections, packed, solution = _packed_examples()
+
+    numpy.random.seed(0)
+    for scale in (0, 0.01, 0.1):
+        perturbed = solution + scale * numpy.random.randn(len(solution))
+        value, gradient = _native_objective(packed, perturbed, 0.001)
+        python_value, python_gradient = _objective(packed, perturbed, 0.001)
+
+        # the same sums in the same order every time
+        again, again_gradient = _native_objective(packed, perturbed, 0.001)
+        assert again == value
+        assert (again_gradient == gradient).all()
+
+        assert math.fabs(value - python_value) < 1e-8 * max(1, math.fabs(python_value))
+        assert numpy.allclose(gradient, python_gradient, rtol=1e-8, atol=1e-10)
+
+        # central differences along a few random directions
+        for i in xrange(3):
+            direction = numpy.random.randn(len(solution))
+            direction /= numpy.linalg.norm(direction)
+            eps = 1e-6
+            forward, _ = _native_objective(packed, perturbed + eps * direction, 0.001)
+            backward, _ = _native_objective(packed, perturbed - eps * direction, 0.001)
+            numerical = (forward - backward) / (2 * eps)
+            assert math.fabs(numerical - gradient.dot(direction)) < 1e-4 * max(1, math.fabs(numerical))
+
+def incremental_refilter_test():
+    model = LoadModel('tests/example.dpm')
+
+    image = scipy.misc.imresize(scipy.misc.imread('tests/000034.jpg'), 0.5)
+    pyramid = BuildPyramid (image, model=model)
+
+    def belief_adjustment (rule, score):
+        if rule not in model.start.rules:
+            return score
+        return [Score(scale=s.scale, score=s.score-1) for s in score]
+
+    def loss_adjustment (rule, score):
+        if rule not in model.start.rules:
+            return score
+        return [Score(scale=s.scale, score=s.score+1) for s in score]
+
+    filtered_model_belief = model.Filter(pyramid, loss_adjustment=belief_adjustment)
+    filtered_model_loss = filtered_model_belief.Filter(loss_adjustment=loss_adjustment)
+    filtered_model_fresh = model.Filter(pyramid, loss_adjustment=loss_adjustment)
+
+    for refiltered, fresh in itertools.izip(filtered_model_loss.start.score, filtered_model_fresh.start.score):
+        assert (refiltered.score == fresh.score).all()
+
+    for refiltered, belief in itertools.izip(filtered_model_loss.start.rules, filtered_model_belief.start.rules):
+        assert refiltered.score_original is belief.score_original
+        for refiltered_child, belief_child in itertools.izip(refiltered.rhs, belief.rhs):
+            assert refiltered_child.score is belief_child.score
+
+    refiltered = filtered_model_loss.Parse(-1).next()
+    fresh = filtered_model_fresh.Parse(-1).next()
+    assert refiltered.s == fresh.s
+    assert refiltered.loss == fresh.loss
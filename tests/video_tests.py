@@ -0,0 +1,38 @@
+import scipy.misc
+
+from pydro.detection import *
+from pydro.features import *
+from pydro.io import *
+from pydro.video import *
+
+def video_pipeline_test():
+    model = LoadModel('tests/example.dpm')
+    image = scipy.misc.imread('tests/000034.jpg')
+    frames = [
+        scipy.misc.imresize(image, 0.4),
+        scipy.misc.imresize(image[:, ::-1], 0.4),
+        scipy.misc.imresize(image, 0.3),
+        scipy.misc.imresize(image[20:, 30:], 0.4),
+    ]
+
+    reference = [
+        list(NMS(model.Filter(BuildPyramid(frame, model=model)).Parse(-1), 0.5))
+        for frame in frames
+    ]
+
+    pipeline = VideoPipeline(model, -1, 0.5, workers={'pyramid': 2, 'parse': 2}, queue_depth=1)
+    results = list(pipeline.Run(iter(frames)))
+
+    assert len(results) == len(reference)
+    for trees, expected in zip(results, reference):
+        assert [(t.x1, t.y1, t.x2, t.y2, t.s) for t in trees] == \
+            [(t.x1, t.y1, t.x2, t.y2, t.s) for t in expected]
+
+    stats = pipeline.Stats()
+    for stage in VideoPipeline.stages:
+        assert stats[stage]['frames'] == len(frames)
+    assert stats['pyramid']['workers'] == 2
+
+    results = pipeline.Run(iter(frames))
+    next(results)
+    results.close()